@@ -2,9 +2,15 @@ import xarray as xr
 import os
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
-import cartopy.feature as cfeature
 import glob
+import sys
 import numpy as np
+import dask
+
+# The handbook utilities live in ../shared/utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'shared'))
+from utils.chunk_planner import plan_chunks_for_files
+from utils.map_rendering import data_bounds, prepare_basemap, render_figure, render_figures, show_images
 
 
 plot_params = {
@@ -199,16 +205,49 @@ plot_params = {
 
 
 
-def visualise_variable_annually(ds_monthly, variable_name, year):    
-    fig, axes = plt.subplots(nrows=4, ncols=3, figsize=(15, 15), subplot_kw={'projection': ccrs.PlateCarree()})
+def load_driver_dataset(files, query='map', memory_budget=64e6, concat_dim='valid_time'):
+    # Read chunks follow the on-disk chunking of the files ('map' for monthly maps, 'timeseries' for long series)
+    chunks = plan_chunks_for_files(files, query=query, memory_budget=memory_budget, concat_dim=concat_dim)
+    return xr.open_mfdataset(files, chunks=chunks, concat_dim=concat_dim, combine='nested', parallel=False)
+
+
+def draw_field_panel(ax, panel):
+    panel['data'].plot(ax=ax, transform=ccrs.PlateCarree(), cmap=panel['cmap'], center=panel['center'], cbar_kwargs={'label': panel['label']})
+    ax.set_title(panel['title'])
+
+
+def prepare_annual_figure(ds_monthly, variable_name, year, basemap_root=None):
+    # Figure spec of utils.map_rendering: the twelve fields are computed together before drawing, and the
+    # coastlines and borders are projected once for the extent
+    data = ds_monthly[plot_params[variable_name]["short_name"]]
     months = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"]
-    for i, ax in enumerate(axes.flatten()):
-        (ds_monthly[plot_params[variable_name]["short_name"]].sel(valid_time=f'{year}-{i + 1:02d}', method='nearest')).plot(ax=ax, transform=ccrs.PlateCarree(),cmap=plot_params[variable_name]['cmap'], cbar_kwargs={'label': plot_params[variable_name]["plot_title"]})
-        ax.coastlines()
-        ax.add_feature(cfeature.BORDERS)
-        ax.set_title(f'{plot_params[variable_name]["plot_title"]} for {months[i]} {year}')
-    fig.tight_layout()
-    plt.show()
+    fields = dask.compute(*[data.sel(valid_time=f'{year}-{i + 1:02d}', method='nearest') for i in range(12)])
+    basemap = prepare_basemap(data_bounds(data), cache_root=basemap_root)
+    panels = [{'draw': draw_field_panel, 'data': field, 'cmap': plot_params[variable_name]['cmap'], 'center': None,
+               'label': plot_params[variable_name]["plot_title"], 'title': f'{plot_params[variable_name]["plot_title"]} for {months[i]} {year}',
+               'basemap': basemap} for i, field in enumerate(fields)]
+    return {'name': f'{variable_name}_{year}_annual', 'nrows': 4, 'ncols': 3, 'figsize': (15, 15), 'projection': ccrs.PlateCarree(),
+            'suptitle': None, 'rect': None, 'panels': panels}
+
+
+def render_driver_figures(specs, output_dir=None, workers=1, per_panel=False, show=True):
+    # Without output_dir, figures are drawn here and shown as before; otherwise they are rendered to files in
+    # `workers` processes (each panel separately with per_panel) and the images are shown inline
+    if output_dir is None:
+        if workers > 1 or per_panel:
+            raise ValueError("Rendering in worker processes or per panel writes the figures to files; give an output_dir.")
+        for spec in specs:
+            render_figure(spec)
+            plt.show()
+        return None
+    paths = render_figures(specs, output_dir, workers=workers, per_panel=per_panel)
+    if show:
+        show_images(paths)
+    return paths
+
+
+def visualise_variable_annually(ds_monthly, variable_name, year, output_dir=None, workers=1, per_panel=False, show=True, basemap_root=None):
+    return render_driver_figures([prepare_annual_figure(ds_monthly, variable_name, year, basemap_root)], output_dir, workers, per_panel, show)
 
 
 def create_monthly_baseline(ds_monthly, ignore_years=[2020]):
@@ -217,36 +256,56 @@ def create_monthly_baseline(ds_monthly, ignore_years=[2020]):
     return monthly_baseline
 
 
-def make_comparisons(ds_annual, ds_monthly_baseline, variable_name, year, show_diff_plots=True, show_box_plots=True, show_hists=True, show_extremes_plot=True, extreme_perc=5):
+def draw_box_panel(ax, panel):
+    ax.boxplot([panel['baseline'], panel['annual']], tick_labels=panel['tick_labels'], notch=True)
+    ax.set_title(panel['title'])
+    ax.grid(True)
+
+
+def draw_hist_panel(ax, panel):
+    ax.hist(panel['baseline'], bins=30, alpha=0.5, label='Baseline', color='blue')
+    ax.hist(panel['annual'], bins=30, alpha=0.5, label=panel['title'], color='red')
+    ax.set_title(panel['title'])
+    ax.legend(loc='upper right')
+
+
+def draw_extremes_panel(ax, panel):
+    high_baseline, high_annual = panel['high_baseline'], panel['high_annual']
+    low_baseline, low_annual = panel['low_baseline'], panel['low_annual']
+
+    # Scatter plot for the high 2%
+    ax.scatter(high_baseline, high_annual, color='red', label=f'High {panel["extreme_perc"]}%')
+    ax.plot([min(high_baseline), max(high_baseline)],
+            [min(high_baseline), max(high_baseline)], 'k--')
+
+    # Scatter plot for the low 2%
+    ax.scatter(low_baseline, low_annual, color='blue', label=f'Low {panel["extreme_perc"]}%')
+    ax.plot([min(low_baseline), max(low_baseline)],
+            [min(low_baseline), max(low_baseline)], 'k--')
+
+    ax.set_xlabel('Baseline')
+    ax.set_ylabel(f'{panel["year"]}')
+    ax.set_title(panel['title'])
+    ax.grid(True)
+    ax.legend()
+
+
+def prepare_comparison_figures(ds_annual, ds_monthly_baseline, variable_name, year, show_diff_plots=True, show_box_plots=True, show_hists=True, show_extremes_plot=True, extreme_perc=5, basemap_root=None):
     ds_annual_variable = ds_annual[plot_params[variable_name]["short_name"]]
     ds_monthly_variable = ds_annual_variable.groupby('valid_time.month').mean(dim='valid_time')
 
     ds_monthly_baseline_variable = ds_monthly_baseline[plot_params[variable_name]["short_name"]]
 
+    # Both monthly means are computed once, rather than once per panel of each figure
+    ds_monthly_variable, ds_monthly_baseline_variable = dask.compute(ds_monthly_variable, ds_monthly_baseline_variable)
+
     months = ["January", "February", "March", "April", "May", "June",
               "July", "August", "September", "October", "November", "December"]
 
-    # Create subplots
     if show_diff_plots:
-        fig_plot, axes_plot = plt.subplots(nrows=4, ncols=3, figsize=(15, 15), subplot_kw={'projection': ccrs.PlateCarree()})
-        fig_plot.suptitle(f'Comparisons for {variable_name} in {year}', fontsize=16)
-    
-    # Box Plots in a 3x4 layout
-    if show_box_plots:
-        fig_box, axes_box = plt.subplots(nrows=3, ncols=4, figsize=(20, 15))
-        fig_box.suptitle(f'{variable_name} Box Plot Comparisons for {year}', fontsize=16)
-
-    # Histogram Plots in a 3x4 layout
-    if show_hists:
-        fig_hist, axes_hist = plt.subplots(nrows=3, ncols=4, figsize=(20, 15))
-        fig_hist.suptitle(f'{variable_name} Histogram Comparisons for {year}', fontsize=16)
-
-    if show_extremes_plot:
-        # Focus on Extremes in a 3x4 layout
-        fig_extremes, axes_extremes = plt.subplots(nrows=3, ncols=4, figsize=(20, 15))
-        fig_extremes.suptitle(f'{variable_name} Focus on Extremes for {year}', fontsize=16)
-
+        basemap = prepare_basemap(data_bounds(ds_monthly_variable), cache_root=basemap_root)
 
+    panels = {'diff': [], 'box': [], 'hist': [], 'extremes': []}
     for i in range(12):
         month = i + 1
 
@@ -256,80 +315,69 @@ def make_comparisons(ds_annual, ds_monthly_baseline, variable_name, year, show_d
 
         if show_diff_plots:
             # Absolute Difference Map
-            abs_diff = annual_month - baseline_month
-            ax_plot = axes_plot.flatten()[i]
-            abs_diff.plot(ax=ax_plot, transform=ccrs.PlateCarree(), cmap=plot_params[variable_name]["abs_diff_cmap"], center=0, cbar_kwargs={'label': f'Abs Diff {variable_name} ({months[i]})'})
-            ax_plot.coastlines()
-            ax_plot.add_feature(cfeature.BORDERS)
-            ax_plot.set_title(f'Abs Diff {months[i]} {year}')
-
-        
+            panels['diff'].append({'draw': draw_field_panel, 'data': annual_month - baseline_month, 'cmap': plot_params[variable_name]["abs_diff_cmap"],
+                                   'center': 0, 'label': f'Abs Diff {variable_name} ({months[i]})', 'title': f'Abs Diff {months[i]} {year}',
+                                   'basemap': basemap})
+
         # Ensure only valid pixels are compared (non-NaN in both datasets)
         if show_box_plots or show_hists or show_extremes_plot:
             annual_month_flat = annual_month.to_numpy().flatten()
             baseline_month_flat = baseline_month.to_numpy().flatten()
-    
+
             valid_data = ~np.isnan(annual_month_flat) & ~np.isnan(baseline_month_flat)
-    
+
             annual_month_valid = annual_month_flat[valid_data]
             baseline_month_valid = baseline_month_flat[valid_data]
-        
+
         # Focus on Extremes Plot
         if show_extremes_plot:
-            ax_extremes = axes_extremes.flatten()[i]
             top_2_percent_threshold = np.percentile(baseline_month_valid, 100-extreme_perc)
             bottom_2_percent_threshold = np.percentile(baseline_month_valid, extreme_perc)
-    
+
             # Identify the top and bottom 2% pixels
-            high_baseline = baseline_month_valid[baseline_month_valid >= top_2_percent_threshold]
-            high_annual = annual_month_valid[baseline_month_valid >= top_2_percent_threshold]
-    
-            low_baseline = baseline_month_valid[baseline_month_valid <= bottom_2_percent_threshold]
-            low_annual = annual_month_valid[baseline_month_valid <= bottom_2_percent_threshold]
-    
-            # Scatter plot for the high 2%
-            ax_extremes.scatter(high_baseline, high_annual, color='red', label=f'High {extreme_perc}%')
-            ax_extremes.plot([min(high_baseline), max(high_baseline)],
-                             [min(high_baseline), max(high_baseline)], 'k--')
-    
-            # Scatter plot for the low 2%
-            ax_extremes.scatter(low_baseline, low_annual, color='blue', label=f'Low {extreme_perc}%')
-            ax_extremes.plot([min(low_baseline), max(low_baseline)],
-                             [min(low_baseline), max(low_baseline)], 'k--')
-    
-            ax_extremes.set_xlabel('Baseline')
-            ax_extremes.set_ylabel(f'{year}')
-            ax_extremes.set_title(f'{months[i]}')
-            ax_extremes.grid(True)
-            ax_extremes.legend()
-        
+            panels['extremes'].append({
+                'draw': draw_extremes_panel, 'title': f'{months[i]}', 'year': year, 'extreme_perc': extreme_perc,
+                'high_baseline': baseline_month_valid[baseline_month_valid >= top_2_percent_threshold],
+                'high_annual': annual_month_valid[baseline_month_valid >= top_2_percent_threshold],
+                'low_baseline': baseline_month_valid[baseline_month_valid <= bottom_2_percent_threshold],
+                'low_annual': annual_month_valid[baseline_month_valid <= bottom_2_percent_threshold],
+            })
+
         # Box Plot
         if show_box_plots:
-            ax_box = axes_box.flatten()[i]
-            ax_box.boxplot([baseline_month_valid, annual_month_valid], tick_labels=[f'Baseline', f'{months[i]} {year}'], notch=True)
-            ax_box.set_title(f'{months[i]}')
-            ax_box.grid(True)
+            panels['box'].append({'draw': draw_box_panel, 'baseline': baseline_month_valid, 'annual': annual_month_valid,
+                                  'tick_labels': [f'Baseline', f'{months[i]} {year}'], 'title': f'{months[i]}'})
 
         # Histogram Plot
         if show_hists:
-            ax_hist = axes_hist.flatten()[i]
-            ax_hist.hist(baseline_month_valid, bins=30, alpha=0.5, label='Baseline', color='blue')
-            ax_hist.hist(annual_month_valid, bins=30, alpha=0.5, label=months[i], color='red')
-            ax_hist.set_title(f'{months[i]}')
-            ax_hist.legend(loc='upper right')
+            panels['hist'].append({'draw': draw_hist_panel, 'baseline': baseline_month_valid, 'annual': annual_month_valid, 'title': f'{months[i]}'})
 
+    specs = []
     if show_diff_plots:
-        fig_plot.tight_layout(rect=[0, 0.03, 1, 0.95])
-        plt.show()
+        specs.append({'name': f'{variable_name}_{year}_diff', 'nrows': 4, 'ncols': 3, 'figsize': (15, 15), 'projection': ccrs.PlateCarree(),
+                      'suptitle': f'Comparisons for {variable_name} in {year}', 'rect': [0, 0.03, 1, 0.95], 'panels': panels['diff']})
+    # Box plots, histograms and extremes in a 3x4 layout
+    for kind, show, title in [('box', show_box_plots, 'Box Plot Comparisons'), ('hist', show_hists, 'Histogram Comparisons'),
+                              ('extremes', show_extremes_plot, 'Focus on Extremes')]:
+        if show:
+            specs.append({'name': f'{variable_name}_{year}_{kind}', 'nrows': 3, 'ncols': 4, 'figsize': (20, 15), 'projection': None,
+                          'suptitle': f'{variable_name} {title} for {year}', 'rect': [0, 0.03, 1, 0.95], 'panels': panels[kind]})
+    return specs
+
 
-    if show_box_plots:
-        fig_box.tight_layout(rect=[0, 0.03, 1, 0.95])
-        plt.show()
+def make_comparisons(ds_annual, ds_monthly_baseline, variable_name, year, show_diff_plots=True, show_box_plots=True, show_hists=True, show_extremes_plot=True, extreme_perc=5,
+                     output_dir=None, workers=1, per_panel=False, show=True, basemap_root=None):
+    specs = prepare_comparison_figures(ds_annual, ds_monthly_baseline, variable_name, year, show_diff_plots, show_box_plots, show_hists, show_extremes_plot, extreme_perc,
+                                       basemap_root)
+    return render_driver_figures(specs, output_dir, workers, per_panel, show)
 
-    if show_hists:
-        fig_hist.tight_layout(rect=[0, 0.03, 1, 0.95])
-        plt.show()
 
-    if show_extremes_plot:
-        fig_extremes.tight_layout(rect=[0, 0.03, 1, 0.95])
-        plt.show()
\ No newline at end of file
+def export_driver_figures(ds_monthly, ds_monthly_baseline, variable_names, year, output_dir, workers=4, per_panel=False, show=False, basemap_root=None,
+                          **comparison_options):
+    # Annual maps and comparisons of several variables rendered in one pool, e.g. the 20 variables of plot_params
+    ds_target = ds_monthly.sel(valid_time=ds_monthly['valid_time'].dt.year == year)
+    specs = []
+    for variable_name in variable_names:
+        specs.append(prepare_annual_figure(ds_monthly, variable_name, year, basemap_root))
+        specs.extend(prepare_comparison_figures(ds_target, ds_monthly_baseline, variable_name, year, basemap_root=basemap_root, **comparison_options))
+    return render_driver_figures(specs, output_dir, workers, per_panel, show)
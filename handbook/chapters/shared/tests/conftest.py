@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The utilities are imported as `utils.<module>`, as from the notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
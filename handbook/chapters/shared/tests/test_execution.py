@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from utils.execution import compute_stats_blocked
+
+
+def make_cube(n_times, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(n_times, 6, 5)).astype('float32')
+    values[:, 0, :] = np.nan
+    times = pd.date_range('2000-01-01', periods=n_times, freq='MS')
+    return xr.DataArray(values, coords={'time': times, 'lat': np.arange(6) * 0.25, 'lon': np.arange(5) * 0.25},
+                        dims=('time', 'lat', 'lon')).chunk({'time': 4})
+
+
+def test_resume_ignores_blocks_of_another_selection(tmp_path):
+    # A longer run with larger blocks leaves its results in the scratch folder
+    compute_stats_blocked(make_cube(40, seed=1), scratch_dir=str(tmp_path), time_block=31)
+
+    data = make_cube(10)
+    resumed = compute_stats_blocked(data, scratch_dir=str(tmp_path), time_block=4, resume=True)
+    expected = compute_stats_blocked(data, time_block=4)
+
+    assert resumed['times'].size == 10
+    np.testing.assert_array_equal(resumed['times'], data['time'].values)
+    for key in expected:
+        np.testing.assert_array_equal(resumed[key], expected[key])
+
+
+def test_resume_reuses_matching_blocks(tmp_path):
+    data = make_cube(10)
+    first = compute_stats_blocked(data, scratch_dir=str(tmp_path), time_block=4)
+    resumed = compute_stats_blocked(data, scratch_dir=str(tmp_path), time_block=4, resume=True)
+    for key in first:
+        np.testing.assert_array_equal(resumed[key], first[key])
+
+
+def test_resume_ignores_blocks_of_another_region(tmp_path):
+    region_a = make_cube(10) * 0
+    region_b = (make_cube(10) * 0 - 2).assign_coords(lat=np.arange(6) * 0.25 + 10, lon=np.arange(5) * 0.25 + 20)
+    compute_stats_blocked(region_a, scratch_dir=str(tmp_path), time_block=4)
+
+    resumed = compute_stats_blocked(region_b, scratch_dir=str(tmp_path), time_block=4, resume=True)
+    expected = compute_stats_blocked(region_b, time_block=4)
+    for key in expected:
+        np.testing.assert_array_equal(resumed[key], expected[key])
@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from utils.reference_index import build_reference_index, open_reference_index
+
+
+def write_month(path, month, lat, lon):
+    values = np.random.default_rng(month).normal(size=(1, lat.size, lon.size)).astype('float32')
+    times = pd.date_range(f'2020-{month:02d}-01', periods=1)
+    data = xr.Dataset({'SPEI12': (('time', 'lat', 'lon'), values)}, coords={'time': times, 'lat': lat, 'lon': lon})
+    data.to_netcdf(path, encoding={'SPEI12': {'zlib': True, 'chunksizes': (1, lat.size, lon.size)}})
+
+
+def test_index_keeps_zero_coordinates(tmp_path):
+    # The grid crosses the equator and the prime meridian
+    lat = np.arange(1.0, -1.25, -0.25)
+    lon = np.arange(-1.0, 1.25, 0.25)
+    files = []
+    for month in (1, 2):
+        path = str(tmp_path / f'SPEI12_genlogistic_global_era5_moda_ref1991to2020_2020{month:02d}.nc')
+        write_month(path, month, lat, lon)
+        files.append(path)
+
+    index_path = str(tmp_path / 'index' / 'spei12.json')
+    build_reference_index(files, index_path, 'SPEI12')
+    with open_reference_index(index_path) as ds:
+        np.testing.assert_array_equal(ds['lat'].values, lat)
+        np.testing.assert_array_equal(ds['lon'].values, lon)
+        assert ds['time'].notnull().all()
+        with xr.open_mfdataset(files) as expected:
+            np.testing.assert_array_equal(ds['SPEI12'].values, expected['SPEI12'].values)
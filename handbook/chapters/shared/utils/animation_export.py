@@ -0,0 +1,411 @@
+"""
+Animation export of SPEI map sequences.
+
+Renders one map per month of an accumulation window over a region, styled as in `plot_geographical_distribution`
+(BrBG, -2 to 2, coastlines and borders), and encodes the maps into an MP4 or GIF with ffmpeg. From the
+`handbook/chapters/shared` folder:
+
+    python -m utils.animation_export 12 --bounds 43 -26 51 -11 --years 1980 2020 --output madagascar_spei12.mp4 --workers 4
+
+Each worker process reads the months it draws from their own files and gets the basemap of the region once
+(utils.map_rendering). Frames go to PNG files in '<output name>_frames' as they are drawn, and ffmpeg reads them
+one at a time from there, so neither the fields nor the frames are ever all in memory. An interrupted export
+resumes with the frames that are missing. Frames of months whose file changed since are drawn again. The frames
+of an MP4 also serve a GIF of the same name.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+import xarray as xr
+from concurrent.futures import ProcessPoolExecutor
+from utils.data_preprocess import (DATA_ROOT, parse_file_month, list_spei_files, is_readable_nc, preprocess, replace_invalid_values,
+                                   file_signature)
+from utils.coordinates_retrieve import longitude_extent
+from utils.map_rendering import BASEMAP_ROOT, prepare_basemap, add_basemap, get_basemaps, init_worker
+
+
+SPEI_CLIM = (-2.0, 2.0)         # Colour limits of plot_geographical_distribution
+SPEI_CMAP = 'BrBG'
+FRAME_SIZE = (8, 6)             # Inches; 800 x 600 pixels at FRAME_DPI, as the interactive maps
+FRAME_DPI = 100
+DEFAULT_FPS = 6                 # Half a year per second
+
+
+
+def get_frames_dir(output):
+    """
+    Get the folder of the frames of an animation, shared by the MP4 and GIF of the same name.
+
+    Parameters:
+    output (str): The path of the animation.
+
+    Returns:
+    str: The path of the folder.
+    """
+    return os.path.splitext(output)[0] + '_frames'
+
+
+
+def frame_path(frames_dir, index):
+    """
+    Get the PNG file of a frame, numbered from 0 for the image sequence read by ffmpeg.
+
+    Parameters:
+    frames_dir (str): The folder of the frames.
+    index (int): The position of the frame.
+
+    Returns:
+    str: The path of the frame.
+    """
+    return os.path.join(frames_dir, f'frame_{index:05d}.png')
+
+
+
+def map_projection(bounds) -> tuple:
+    """
+    Get the projection and extent of the maps of a region: PlateCarree, centred on the antimeridian for a box
+    crossing it so the region is drawn in one piece.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+
+    Returns:
+    tuple: The projection, and the extent (x0, x1, y0, y1) in its coordinates.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    if min_lon <= max_lon:
+        return ccrs.PlateCarree(), (min_lon, max_lon, min_lat, max_lat)
+    return ccrs.PlateCarree(central_longitude=180), (min_lon - 180, max_lon + 180, min_lat, max_lat)
+
+
+
+def list_frame_months(accumulation_window, start_year=None, end_year=None, data_root=DATA_ROOT) -> list:
+    """
+    Lists the readable monthly files of a window, one per month, in time order.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    data_root (str): The root folder of the SPEI archive.
+
+    Returns:
+    list: (year, month) and file of each month.
+    """
+    by_month = {}
+    for file in list_spei_files(accumulation_window, start_year, end_year, data_root):
+        by_month.setdefault(parse_file_month(file), file)
+    return [(month, by_month[month]) for month in sorted(by_month) if is_readable_nc(by_month[month])]
+
+
+
+def read_frame_field(file, accumulation_window, bounds) -> xr.DataArray:
+    """
+    Reads and cleans the field of one monthly file over a region.
+
+    Parameters:
+    file (str): The monthly file.
+    accumulation_window (str): The accumulation window in months.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+
+    Returns:
+    xr.DataArray: The field with NaN in place of invalid values; longitudes in 0..360 for a box crossing the
+                  antimeridian, so the two sides join.
+    """
+    with xr.open_dataset(file) as ds:
+        field = preprocess(ds, bounds)[f'SPEI{accumulation_window}'].isel(time=0).load()
+    field, _, _ = replace_invalid_values(field)
+    if bounds[0] > bounds[2]:
+        field = field.assign_coords(lon=np.mod(field['lon'], 360)).sortby('lon')
+    return field
+
+
+
+def render_frame(task) -> str:
+    """
+    Draws one frame and writes it to its PNG file. The file appears complete or not at all, so an interrupted
+    export never leaves a truncated frame behind.
+
+    Parameters:
+    task (dict): The frame: 'path', 'title', 'label', 'basemap', 'bounds', 'clim', 'cmap', 'figsize', 'dpi', and
+                 either the 'field' to draw or the 'file' and 'accumulation_window' to read it from.
+
+    Returns:
+    str: The path of the frame.
+    """
+    field = task.get('field')
+    if field is None:
+        field = read_frame_field(task['file'], task['accumulation_window'], task['bounds'])
+    projection, extent = map_projection(task['bounds'])
+
+    fig = plt.figure(figsize=task['figsize'])
+    ax = fig.add_subplot(projection=projection)
+    field.plot(ax=ax, transform=ccrs.PlateCarree(), cmap=task['cmap'], vmin=task['clim'][0], vmax=task['clim'][1],
+               cbar_kwargs={'label': task['label']})
+    add_basemap(ax, task['basemap'])
+    ax.set_extent(extent, crs=projection)
+    ax.set_title(task['title'])
+    # A fixed figure size (no tight bounding box), as every frame of a video must have the same size
+    fig.savefig(task['path'] + '.partial', format='png', dpi=task['dpi'])
+    plt.close(fig)
+    os.replace(task['path'] + '.partial', task['path'])
+    return task['path']
+
+
+
+def sync_frames(frames_dir, settings, frame_keys) -> list:
+    """
+    Compares the frames on disk with the ones wanted, removes those that no longer match, and records the wanted
+    ones in the manifest of the folder.
+
+    Parameters:
+    frames_dir (str): The folder of the frames.
+    settings (dict): The settings shared by all frames (region, colours, size), with JSON values; all frames are
+                     drawn again if they changed.
+    frame_keys (list): What each frame shows (month and version of its source), in order.
+
+    Returns:
+    list: The positions of the frames still to draw.
+    """
+    manifest_path = os.path.join(frames_dir, 'manifest.json')
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            previous = json.load(file)
+    kept = previous.get('frames', []) if previous.get('settings') == settings else []
+
+    for path in glob.glob(os.path.join(frames_dir, 'frame_*.png*')):
+        name = os.path.basename(path)
+        index = int(name[len('frame_'):len('frame_') + 5])
+        if name.endswith('.partial') or index >= len(frame_keys) or index >= len(kept) or kept[index] != frame_keys[index]:
+            os.remove(path)
+
+    os.makedirs(frames_dir, exist_ok=True)
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump({'settings': settings, 'frames': frame_keys}, file)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return [index for index in range(len(frame_keys)) if not os.path.exists(frame_path(frames_dir, index))]
+
+
+
+def render_frames(tasks, workers=1):
+    """
+    Draws frames, in worker processes that receive the basemaps once if `workers` > 1.
+
+    Parameters:
+    tasks (list): The frames, see `render_frame`.
+    workers (int): The number of rendering processes; 1 draws in this process.
+
+    Returns:
+    int: The number of frames drawn.
+    """
+    start_time = time.time()
+    if workers <= 1:
+        for task in tasks:
+            render_frame(task)
+    else:
+        basemaps = get_basemaps({task['basemap'] for task in tasks})
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(basemaps,)) as executor:
+            # Tasks of the archive hold file names only; fields are read by the workers
+            for _ in executor.map(render_frame, tasks, chunksize=max(1, len(tasks) // (8 * workers))):
+                pass
+    if tasks:
+        print(f"{len(tasks)} frames drawn in {time.time() - start_time:.1f} s")
+    return len(tasks)
+
+
+
+def encode_frames(frames_dir, output, fps=DEFAULT_FPS):
+    """
+    Encodes the frames of a folder into an MP4 (H.264) or a GIF, by extension, with ffmpeg reading them one by one.
+
+    A GIF takes two passes over the frames: one for a palette fitted to them, one to encode. The output is written
+    under a temporary name and renamed when complete.
+
+    Parameters:
+    frames_dir (str): The folder of the frames.
+    output (str): The path of the animation, ending in .mp4 or .gif.
+    fps (float): Frames per second. Defaults to 6.
+
+    Returns:
+    str: The path of the animation.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise ValueError(f"ffmpeg is needed to encode the animation; the frames are kept in {frames_dir}.")
+    extension = os.path.splitext(output)[1].lower()
+    sequence = ['-framerate', str(fps), '-i', os.path.join(frames_dir, 'frame_%05d.png')]
+    partial = os.path.splitext(output)[0] + '.partial' + extension
+
+    if extension == '.mp4':
+        # yuv420p for common players, which also needs even dimensions
+        commands = [[ffmpeg, '-y', '-loglevel', 'error', *sequence, '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                     '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-movflags', '+faststart', partial]]
+    elif extension == '.gif':
+        palette = os.path.join(frames_dir, 'palette.png')
+        commands = [[ffmpeg, '-y', '-loglevel', 'error', *sequence, '-vf', 'palettegen', palette],
+                    [ffmpeg, '-y', '-loglevel', 'error', *sequence, '-i', palette, '-lavfi', 'paletteuse', partial]]
+    else:
+        raise ValueError("The animation must be an .mp4 or a .gif file.")
+
+    for command in commands:
+        subprocess.run(command, check=True)
+    os.replace(partial, output)
+    return output
+
+
+
+def export_frames(tasks, frame_keys, settings, output, fps=DEFAULT_FPS, workers=1, keep_frames=False) -> str:
+    """
+    Draws the frames missing from the frames folder of an animation and encodes them.
+
+    Parameters:
+    tasks (list): The frames, see `render_frame`, without their 'path'.
+    frame_keys (list): What each frame shows, see `sync_frames`.
+    settings (dict): The settings shared by all frames, see `sync_frames`.
+    output (str): The path of the animation, ending in .mp4 or .gif.
+    fps (float): Frames per second.
+    workers (int): The number of rendering processes.
+    keep_frames (bool): If True, the frames are kept after encoding, e.g. to export the other format.
+
+    Returns:
+    str: The path of the animation.
+    """
+    frames_dir = get_frames_dir(output)
+    missing = sync_frames(frames_dir, settings, frame_keys)
+    print(f"{output}: {len(tasks) - len(missing)} of {len(tasks)} frames already drawn")
+    render_frames([{**tasks[index], 'path': frame_path(frames_dir, index)} for index in missing], workers)
+    encode_frames(frames_dir, output, fps)
+    if not keep_frames:
+        shutil.rmtree(frames_dir)
+    return output
+
+
+
+def export_animation(accumulation_window, bounds, output, start_year=None, end_year=None, fps=DEFAULT_FPS, workers=1,
+                     data_root=DATA_ROOT, clim=SPEI_CLIM, cmap=SPEI_CMAP, keep_frames=False, basemap_root=None) -> str:
+    """
+    Exports the monthly SPEI maps of a region from the archive as an MP4 or GIF animation.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat); min_lon > max_lon across
+                    the antimeridian.
+    output (str): The path of the animation, ending in .mp4 or .gif.
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    fps (float): Frames per second. Defaults to 6.
+    workers (int): The number of rendering processes. Defaults to 1.
+    data_root (str): The root folder of the SPEI archive.
+    clim (tuple): The colour limits. Defaults to (-2, 2).
+    cmap (str): The colormap. Defaults to 'BrBG'.
+    keep_frames (bool): If True, the frames are kept after encoding.
+    basemap_root (str, optional): The folder of the projected basemaps (utils.map_rendering); memory only if None.
+
+    Returns:
+    str: The path of the animation.
+    """
+    accumulation_window = str(accumulation_window)
+    months = list_frame_months(accumulation_window, start_year, end_year, data_root)
+    if not months:
+        raise ValueError(f"No readable NetCDF files found for SPEI{accumulation_window}.")
+    bounds = tuple(float(value) for value in bounds)
+    basemap = prepare_basemap(bounds, map_projection(bounds)[0], cache_root=basemap_root)
+
+    settings = {'accumulation_window': accumulation_window, 'bounds': list(bounds), 'clim': list(clim), 'cmap': cmap,
+                'figsize': list(FRAME_SIZE), 'dpi': FRAME_DPI}
+    frame_keys = [[year, month, *file_signature(file).values()] for (year, month), file in months]
+    tasks = [{'file': file, 'accumulation_window': accumulation_window, 'title': f'SPEI{accumulation_window} {year}-{month:02d}',
+              'label': f'SPEI{accumulation_window}', 'basemap': basemap, 'bounds': bounds, 'clim': clim, 'cmap': cmap,
+              'figsize': FRAME_SIZE, 'dpi': FRAME_DPI} for (year, month), file in months]
+    return export_frames(tasks, frame_keys, settings, output, fps, workers, keep_frames)
+
+
+
+def export_data_animation(data: xr.DataArray, output, fps=DEFAULT_FPS, workers=1, clim=SPEI_CLIM, cmap=SPEI_CMAP,
+                          keep_frames=False, basemap_root=None) -> str:
+    """
+    Exports the maps of a loaded selection, e.g. the subset shown by `plot_geographical_distribution`, as an MP4 or
+    GIF animation. Each frame gets its own month of the selection.
+
+    Parameters:
+    data (xr.DataArray): The cleaned values with dimensions ('time', 'lat', 'lon').
+    output (str): The path of the animation, ending in .mp4 or .gif.
+    fps (float): Frames per second. Defaults to 6.
+    workers (int): The number of rendering processes. Defaults to 1.
+    clim (tuple): The colour limits. Defaults to (-2, 2).
+    cmap (str): The colormap. Defaults to 'BrBG'.
+    keep_frames (bool): If True, the frames are kept after encoding.
+    basemap_root (str, optional): The folder of the projected basemaps (utils.map_rendering); memory only if None.
+
+    Returns:
+    str: The path of the animation.
+    """
+    # A selection read across the antimeridian has west > east
+    west, east = longitude_extent(data['lon'].values)
+    bounds = (float(west), float(data['lat'].min()), float(east), float(data['lat'].max()))
+    basemap = prepare_basemap(bounds, map_projection(bounds)[0], cache_root=basemap_root)
+    if west > east:
+        data = data.assign_coords(lon=np.mod(data['lon'], 360)).sortby('lon')
+
+    times = [str(np.datetime_as_string(time, unit='M')) for time in data['time'].values]
+    name = data.name or 'SPEI'
+    settings = {'name': name, 'bounds': list(bounds), 'clim': list(clim), 'cmap': cmap, 'figsize': list(FRAME_SIZE), 'dpi': FRAME_DPI}
+    tasks = [{'field': data.isel(time=i), 'title': f'{name} {month}', 'label': name, 'basemap': basemap, 'bounds': bounds,
+              'clim': clim, 'cmap': cmap, 'figsize': FRAME_SIZE, 'dpi': FRAME_DPI} for i, month in enumerate(times)]
+    # The month alone would keep the frames of an earlier selection with other values, e.g. another base window
+    frame_keys = [[month, hashlib.sha1(np.ascontiguousarray(data.isel(time=i).values).tobytes()).hexdigest()]
+                  for i, month in enumerate(times)]
+    return export_frames(tasks, frame_keys, settings, output, fps, workers, keep_frames)
+
+
+
+def main(argv=None):
+    """
+    Command line entry point of the animation export.
+
+    Parameters:
+    argv (list, optional): The command line arguments; `sys.argv[1:]` if not given.
+
+    Returns:
+    int: The exit code.
+    """
+    parser = argparse.ArgumentParser(description='Export the monthly SPEI maps of a region as an MP4 or GIF animation.')
+    parser.add_argument('accumulation_window', help='accumulation window in months (e.g. 12)')
+    parser.add_argument('--bounds', nargs=4, type=float, required=True, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                        help='region to map; MIN_LON > MAX_LON across the antimeridian')
+    parser.add_argument('--years', nargs=2, type=int, metavar=('START', 'END'), help='first and last year')
+    parser.add_argument('--output', required=True, help='animation file, .mp4 or .gif')
+    parser.add_argument('--fps', type=float, default=DEFAULT_FPS, help='frames per second')
+    parser.add_argument('--workers', type=int, default=1, help='number of rendering processes')
+    parser.add_argument('--data-root', default=DATA_ROOT, help='root folder of the SPEI archive')
+    parser.add_argument('--basemap-root', default=None,
+                        help=f'folder of the projected coastlines and borders, e.g. {BASEMAP_ROOT}; not saved if omitted')
+    parser.add_argument('--keep-frames', action='store_true', help='keep the frames after encoding')
+    args = parser.parse_args(argv)
+
+    start_year, end_year = args.years or (None, None)
+    try:
+        export_animation(args.accumulation_window, args.bounds, args.output, start_year, end_year, args.fps, args.workers,
+                         args.data_root, keep_frames=args.keep_frames, basemap_root=args.basemap_root)
+    except (ValueError, subprocess.CalledProcessError) as e:
+        print(f"Export failed: {e}")
+        return 1
+    except KeyboardInterrupt:
+        print("Export interrupted; run the same command again to resume.")
+        return 1
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+"""
+Background execution of widget callbacks.
+
+A button callback submits its work to a `CallbackRunner` and returns at once, so the kernel keeps serving widget
+events. Progress messages are appended to the output area, and submitting a new job, or changing a selection once
+`cancel_jobs_on_change` (utils.widgets_handler) is registered, cancels the one still running: its remaining stages
+are skipped and its result is discarded. Typical use in a notebook:
+
+    from utils.async_callbacks import CallbackRunner, snapshot_selectors, load_and_compute_stats
+    from utils.widgets_handler import cancel_jobs_on_change
+
+    runner = CallbackRunner(output_area)
+    cancel_jobs_on_change(selectors, runner)
+
+    def on_button_clicked(btn):
+        ...  # validate the selections and compute the bounding box as before
+        runner.submit(load_and_compute_stats, btn.custom_name, bounding_box, snapshot_selectors(selectors), placeholders, months,
+                      accumulation_windows, on_done=lambda stats: output_area.append_display_data(
+                          create_scatterplot(stats, accumulation_windows, selected, placeholders, show=False)))
+"""
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import plotly.graph_objects as go
+from utils.data_preprocess import get_xarray_data, process_datarray, spatial_sample, compute_stats
+from utils.charts import create_stripechart, update_stripechart
+
+
+class JobCancelled(Exception):
+    """
+    Raised inside a job when a newer job has been submitted.
+    """
+
+
+
+class JobContext:
+    """
+    Handle passed to a running job to report progress and check for cancellation.
+
+    Parameters:
+    runner (CallbackRunner): The runner executing the job.
+    generation (int): The submission number of the job.
+    """
+    def __init__(self, runner, generation):
+        self.runner = runner
+        self.generation = generation
+
+    @property
+    def cancelled(self):
+        """
+        bool: True if a newer job has been submitted or the runner was cancelled.
+        """
+        return self.generation != self.runner.generation
+
+    def check(self):
+        """
+        Raise `JobCancelled` if the job has been superseded. Jobs call it between stages.
+        """
+        if self.cancelled:
+            raise JobCancelled()
+
+    def progress(self, message):
+        """
+        Append a progress message to the output area, unless the job has been superseded.
+
+        Parameters:
+        message (str): The message to show.
+        """
+        self.check()
+        self.runner.write(message)
+
+
+
+class CallbackRunner:
+    """
+    Runs widget callbacks on a background thread, keeping only the latest submission alive.
+
+    Parameters:
+    output_area (object): The output area used for progress and error messages (an ipywidgets Output).
+    max_workers (int): Number of background threads. With one thread a new job starts as soon as the stage
+                       running in the superseded job returns. Defaults to 1.
+    """
+    def __init__(self, output_area, max_workers=1):
+        self.output_area = output_area
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.future = None
+
+    def write(self, message):
+        """
+        Append a line to the output area; safe to call from the background thread.
+
+        Parameters:
+        message (str): The message to show.
+        """
+        self.output_area.append_stdout(f"{message}\n")
+
+    def submit(self, job, *args, on_done=None, clear=True, **kwargs):
+        """
+        Cancel the running job, if any, and run `job(*args, context=..., **kwargs)` in the background.
+
+        Parameters:
+        job (callable): The function to run; it receives a `JobContext` as the `context` keyword argument.
+        args: Positional arguments of the job.
+        on_done (callable, optional): Called with the result of the job if it completes without being superseded.
+        clear (bool): If True, the output area is cleared before the job starts. Defaults to True.
+        kwargs: Keyword arguments of the job.
+
+        Returns:
+        concurrent.futures.Future: The future of the job.
+        """
+        with self.lock:
+            self.generation += 1
+            context = JobContext(self, self.generation)
+        if clear:
+            self.output_area.clear_output(wait=True)
+
+        def run():
+            try:
+                result = job(*args, context=context, **kwargs)
+                context.check()
+                if on_done is not None:
+                    on_done(result)
+                return result
+            except JobCancelled:
+                return None
+            except Exception as e:
+                if not context.cancelled:
+                    self.write(f"An error occurred: {e}")
+                    self.output_area.append_stderr(traceback.format_exc())
+                return None
+
+        self.future = self.executor.submit(run)
+        return self.future
+
+    def cancel(self):
+        """
+        Cancel the running job without starting a new one.
+        """
+        with self.lock:
+            self.generation += 1
+
+    @property
+    def busy(self):
+        """
+        bool: True while a submitted job is running.
+        """
+        return self.future is not None and not self.future.done()
+
+    def shutdown(self):
+        """
+        Cancel the running job and stop the background threads.
+        """
+        self.cancel()
+        self.executor.shutdown(wait=False)
+
+
+
+def snapshot_selectors(selectors):
+    """
+    Copy the current values of the widget selectors, so a background job is not affected by later changes.
+
+    Parameters:
+    selectors (dict): Dictionary containing widget selectors.
+
+    Returns:
+    dict: Objects with a `value` attribute holding the values at the time of the call.
+    """
+    return {key: SimpleNamespace(value=selector.value) for key, selector in selectors.items()}
+
+
+
+def load_and_compute_stats(btn_name, bounds, selectors, placeholders, months, accumulation_windows, full_stats=True,
+                           context=None):
+    """
+    Background version of the notebook pipeline `get_xarray_data` -> `process_datarray` -> `compute_stats`, reporting
+    each stage and stopping between stages when superseded.
+
+    Parameters:
+    btn_name (str): Button name to determine the type of data fetching.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    selectors (dict): Dictionary containing widget selectors, preferably copied with `snapshot_selectors` when the
+                      job is submitted.
+    placeholders (dict): Placeholder values for widgets.
+    months (dict): Dictionary of month abbreviations to numbers.
+    accumulation_windows (dict): Dictionary of available accumulation_windows.
+    full_stats (bool): If True, computes all statistics. Defaults to True.
+    context (JobContext, optional): Provided by `CallbackRunner.submit`.
+
+    Returns:
+    dict or None: The statistics returned by `compute_stats`, or None if no data were found.
+    """
+    context = context or JobContext(SimpleNamespace(generation=0, write=print), 0)
+    index = f"SPEI{accumulation_windows[selectors['accumulation_window'].value]}"
+
+    context.progress("Reading the SPEI files...")
+    subset_data = get_xarray_data(btn_name, bounds, selectors, placeholders, months, accumulation_windows)
+    if subset_data is None:
+        return None
+
+    context.progress(f"Cleaning {index} ({subset_data.sizes['time']} months)...")
+    processed_subset, _ = process_datarray(subset_data[index])
+
+    context.progress("Computing the statistics...")
+    stats = compute_stats(processed_subset, full_stats)
+    context.progress("Done.")
+    return stats
+
+
+
+def load_and_compute_progressive_stats(btn_name, bounds, selectors, placeholders, months, accumulation_windows, on_update,
+                                       max_cells=256, full_stats=False, context=None):
+    """
+    Coarse-first version of `load_and_compute_stats` for long periods: statistics of a strided sample of the grid
+    (see `spatial_sample`) are delivered first, then the exact statistics of the whole area.
+
+    Parameters:
+    btn_name (str): Button name to determine the type of data fetching.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    selectors (dict): Dictionary containing widget selectors, preferably copied with `snapshot_selectors`.
+    placeholders (dict): Placeholder values for widgets.
+    months (dict): Dictionary of month abbreviations to numbers.
+    accumulation_windows (dict): Dictionary of available accumulation_windows.
+    on_update (callable): Called as `on_update(stats, approximate)`, once with the sampled statistics (if the area
+                          is larger than `max_cells`) and once with the exact ones, unless superseded.
+    max_cells (int): Target number of sampled cells per time step for the first pass. Defaults to 256.
+    full_stats (bool): If True, computes all statistics. Defaults to False (medians, as used by the stripe chart).
+    context (JobContext, optional): Provided by `CallbackRunner.submit`.
+
+    Returns:
+    dict or None: The exact statistics, or None if no data were found.
+    """
+    context = context or JobContext(SimpleNamespace(generation=0, write=print), 0)
+    index = f"SPEI{accumulation_windows[selectors['accumulation_window'].value]}"
+
+    context.progress("Reading the SPEI files...")
+    subset_data = get_xarray_data(btn_name, bounds, selectors, placeholders, months, accumulation_windows)
+    if subset_data is None:
+        return None
+
+    sample, step = spatial_sample(subset_data[index], max_cells)
+    if step > 1:
+        context.progress(f"Computing approximate statistics from 1 in {step * step} cells...")
+        processed_sample, _ = process_datarray(sample)
+        approximate_stats = compute_stats(processed_sample, full_stats)
+        context.check()
+        on_update(approximate_stats, True)
+
+    context.progress("Computing the exact statistics...")
+    processed_subset, _ = process_datarray(subset_data[index])
+    stats = compute_stats(processed_subset, full_stats)
+    context.check()
+    on_update(stats, False)
+    context.progress("Done.")
+    return stats
+
+
+
+def submit_progressive_stripechart(runner, btn_name, bounds, selectors, selected, placeholders, months, accumulation_windows,
+                                   aggregate_by='month', max_cells=256):
+    """
+    Show a stripe chart of a year range as soon as sampled statistics are available, and recolour it in place when
+    the exact statistics arrive.
+
+    Parameters:
+    runner (CallbackRunner): The runner of the notebook; its output area receives the chart.
+    btn_name (str): Button name to determine the type of data fetching (normally 'year_range_widgets_btn').
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    selectors (dict): Dictionary containing widget selectors.
+    selected (dict): Dictionary containing the selected values, used for the chart labels.
+    placeholders (dict): Placeholder values for widgets.
+    months (dict): Dictionary of month abbreviations to numbers.
+    accumulation_windows (dict): Dictionary of available accumulation_windows.
+    aggregate_by (str): Aggregation level of the stripe chart. Defaults to 'month'.
+    max_cells (int): Target number of sampled cells per time step for the first pass. Defaults to 256.
+
+    Returns:
+    concurrent.futures.Future: The future of the job.
+    """
+    selected = dict(selected)
+    figure = {}
+
+    def on_update(stats, approximate):
+        if 'widget' not in figure:
+            fig = create_stripechart(stats, accumulation_windows, selected, placeholders, aggregate_by, show=False)
+            figure['widget'] = go.FigureWidget(fig)
+            update_stripechart(figure['widget'], stats, aggregate_by, approximate)
+            runner.output_area.append_display_data(figure['widget'])
+        else:
+            update_stripechart(figure['widget'], stats, aggregate_by, approximate)
+
+    return runner.submit(load_and_compute_progressive_stats, btn_name, bounds, snapshot_selectors(selectors), placeholders,
+                         months, accumulation_windows, on_update, max_cells)
@@ -0,0 +1,398 @@
+"""
+Headless batch runner for the SPEI pipeline.
+
+Runs a list of selections (area, accumulation window and period) without widgets and writes the statistics and
+charts to disk. From the `handbook/chapters/shared` folder:
+
+    python -m utils.batch_runner jobs.yaml --output-dir reports --workers 4
+
+where jobs.yaml looks like:
+
+    jobs:
+      - name: madagascar-spei12
+        country: Madagascar
+        accumulation_window: 12 months
+        period: {year_range: [1980, 2024]}
+      - name: kenya-january
+        country: Kenya
+        adm1_subarea: Turkana
+        accumulation_window: 3 months
+        period: {month: January}
+      - name: ethiopia-windows
+        country: Ethiopia
+        accumulation_windows_multiple: [1 month, 12 months, 48 months]
+        period: {twenty_years: 2001-2020}
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import yaml
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from types import SimpleNamespace
+from utils.widgets_handler import read_json_to_dict, read_json_to_sorted_dict, find_missing_selections
+from utils.coordinates_retrieve import get_boundaries, calculate_bounding_box
+from utils.data_preprocess import (DATA_ROOT, parse_file_month, list_spei_files, filter_valid_nc_files,
+                                   load_and_preprocess_dataset, process_datarray, compute_stats)
+from utils.charts import create_scatterplot, create_boxplot, create_linechart, create_stripechart, create_combined_areachart
+from utils.instrumentation import record_cache
+
+
+# Same placeholder texts as the notebook widgets
+PLACEHOLDERS = {
+    'country': 'no country selected...',
+    'adm1_subarea': 'no adm1 subarea selected...',
+    'adm2_subarea': 'no adm2 subarea selected...',
+    'accumulation_window': 'no accumulation window selected...',
+    'month': 'no month selected...',
+    'year': 'no year selected...',
+    'twenty_years': 'no period selected...',
+}
+
+# Button each kind of period corresponds to in the notebooks
+PERIOD_BUTTONS = {
+    'month': 'month_widgets_btn',
+    'year': 'year_widgets_btn',
+    'year_range': 'year_range_widgets_btn',
+    'twenty_years': 'accumulation_windows_widgets_btn',
+}
+
+
+
+def read_jobs(file_path):
+    """
+    Read the list of jobs from a YAML or JSON file.
+
+    Parameters:
+    file_path (str): Path of the file; it holds either a list of jobs or a mapping with a 'jobs' key.
+
+    Returns:
+    list: The list of job dictionaries.
+    """
+    with open(file_path, 'r') as file:
+        content = json.load(file) if file_path.endswith('.json') else yaml.safe_load(file)
+    jobs = content['jobs'] if isinstance(content, dict) else content
+    for i, job in enumerate(jobs):
+        job.setdefault('name', f'job-{i + 1:03d}')
+    return jobs
+
+
+
+def build_selection(job, placeholders=PLACEHOLDERS):
+    """
+    Translate a job into the button name and the `selected` dictionary used by the notebook pipeline.
+
+    Parameters:
+    job (dict): The job, with 'country', optional 'adm1_subarea'/'adm2_subarea', 'accumulation_window' or
+                'accumulation_windows_multiple', and a 'period' mapping with one of 'month', 'year', 'year_range'
+                or 'twenty_years'.
+    placeholders (dict): Placeholder values for the selections that are not set.
+
+    Returns:
+    tuple: The button name (str) and the selected dictionary.
+
+    Raises:
+    ValueError: If the period is unknown or required selections are missing.
+    """
+    period = job.get('period', {})
+    if len(period) != 1 or next(iter(period)) not in PERIOD_BUTTONS:
+        raise ValueError(f"Job {job['name']}: the period must have exactly one of {', '.join(PERIOD_BUTTONS)}.")
+    kind, value = next(iter(period.items()))
+    btn_name = PERIOD_BUTTONS[kind]
+
+    selected = dict(placeholders)
+    selected.update({
+        'country': job.get('country', placeholders['country']),
+        'adm1_subarea': job.get('adm1_subarea', placeholders['adm1_subarea']),
+        'adm2_subarea': job.get('adm2_subarea', placeholders['adm2_subarea']),
+        'accumulation_window': job.get('accumulation_window', placeholders['accumulation_window']),
+        'accumulation_windows_multiple': job.get('accumulation_windows_multiple', []),
+        'year_range': [str(year) for year in value] if kind == 'year_range' else [],
+    })
+    if kind in ('month', 'year', 'twenty_years'):
+        selected[kind] = str(value)
+
+    missing = find_missing_selections(btn_name, selected, placeholders)
+    if missing:
+        raise ValueError(f"Job {job['name']}: please select a value for " + ", ".join(missing))
+    return btn_name, selected
+
+
+
+def make_selectors(selected):
+    """
+    Wrap selected values in objects exposing a `value` attribute, like the widgets the pipeline expects.
+
+    Parameters:
+    selected (dict): The selected values.
+
+    Returns:
+    dict: Dictionary of selector-like objects.
+    """
+    return {key: SimpleNamespace(value=value) for key, value in selected.items()}
+
+
+
+def select_catalog_files(catalog, btn_name, selected, months, placeholders=PLACEHOLDERS):
+    """
+    Select the files of a period from a catalog, with the same rules as `generate_file_patterns`.
+
+    Parameters:
+    catalog (list): Validated file paths of one accumulation window.
+    btn_name (str): Button name to determine the type of period.
+    selected (dict): The selected values.
+    months (dict): Dictionary of month names to numbers.
+    placeholders (dict): Placeholder values for the selections.
+
+    Returns:
+    list: The files of the period, sorted by date.
+    """
+    if btn_name == 'year_range_widgets_btn':
+        start_year, end_year = map(int, selected['year_range'])
+        keep = lambda year, month: start_year <= year <= end_year
+    elif btn_name == 'accumulation_windows_widgets_btn':
+        start_year, end_year = map(int, selected['twenty_years'].split('-'))
+        keep = lambda year, month: start_year <= year <= end_year
+    elif btn_name == 'month_widgets_btn':
+        selected_month = int(months[selected['month']])
+        keep = lambda year, month: month == selected_month
+    else:
+        selected_year = int(selected['year'])
+        keep = lambda year, month: year == selected_year
+    return [file for file in catalog if keep(*parse_file_month(file))]
+
+
+
+def build_catalog(accumulation_window_values, data_root=DATA_ROOT):
+    """
+    List and validate the files of each accumulation window once, to be shared by all jobs.
+
+    Parameters:
+    accumulation_window_values (iterable): The accumulation windows in months (e.g. ['1', '12']).
+    data_root (str): The root folder of the SPEI archive.
+
+    Returns:
+    dict: Dictionary mapping an accumulation window to its readable files sorted by date.
+    """
+    return {window: filter_valid_nc_files(list_spei_files(window, data_root=data_root))
+            for window in sorted(set(accumulation_window_values), key=int)}
+
+
+
+def resolve_bounds(selected, country_list, cache, placeholders=PLACEHOLDERS):
+    """
+    Retrieve the bounding box of the selected area, reusing boundaries already fetched for another job.
+
+    Parameters:
+    selected (dict): The selected values.
+    country_list (list): List of country dictionaries.
+    cache (dict): Bounds already resolved, keyed by (country, adm1_subarea, adm2_subarea).
+    placeholders (dict): Placeholder values for the selections.
+
+    Returns:
+    tuple or None: The bounds (min_lon, min_lat, max_lon, max_lat), or None if no boundary was found.
+    """
+    key = (selected['country'], selected['adm1_subarea'], selected['adm2_subarea'])
+    record_cache('bounds', key in cache)
+    if key not in cache:
+        coordinates = get_boundaries(selected, country_list, placeholders)
+        cache[key] = calculate_bounding_box(coordinates) if coordinates else None
+    return cache[key]
+
+
+
+def compute_window_stats(files, bounds, accumulation_window, full_stats):
+    """
+    Load, clean and summarise the data of one accumulation window.
+
+    Parameters:
+    files (list): The files to load.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    accumulation_window (str): The accumulation window in months.
+    full_stats (bool): If True, quartiles, minima and maxima are computed as well.
+
+    Returns:
+    tuple: The statistics dictionary from `compute_stats` and the cleaning report from `process_datarray`.
+    """
+    data = load_and_preprocess_dataset(files, bounds)[f'SPEI{accumulation_window}']
+    data, report = process_datarray(data)
+    return compute_stats(data, full_stats=full_stats), report
+
+
+
+def stats_to_frame(values):
+    """
+    Convert a statistics dictionary from `compute_stats` into a table.
+
+    Parameters:
+    values (dict): The statistics dictionary.
+
+    Returns:
+    pd.DataFrame: The statistics indexed by time.
+    """
+    columns = {key: value for key, value in values.items() if key != 'times' and value is not None}
+    return pd.DataFrame(columns, index=pd.DatetimeIndex(values['times'], name='time'))
+
+
+
+def run_job(job, bounds, catalog, output_dir, image_format=None, placeholders=PLACEHOLDERS):
+    """
+    Run one job: compute the statistics of the selection and write them, with the matching charts, to disk.
+
+    Parameters:
+    job (dict): The job.
+    bounds (tuple): Geographic boundary coordinates of the selected area.
+    catalog (dict): Validated files per accumulation window, from `build_catalog`.
+    output_dir (str): The folder where the job outputs are written (one sub-folder per job).
+    image_format (str, optional): Also export the charts as static images in this format (e.g. 'png'), using kaleido.
+    placeholders (dict): Placeholder values for the selections.
+
+    Returns:
+    dict: A summary with the job name, status, written files, cleaning reports and elapsed time.
+    """
+    start_time = time.perf_counter()
+    accumulation_windows = read_json_to_dict('accumulation_windows.json')
+    months = read_json_to_dict('months.json')
+    btn_name, selected = build_selection(job, placeholders)
+    job_dir = os.path.join(output_dir, job['name'])
+    os.makedirs(job_dir, exist_ok=True)
+
+    if btn_name == 'accumulation_windows_widgets_btn':
+        windows = selected['accumulation_windows_multiple']
+    else:
+        windows = [selected['accumulation_window']]
+    full_stats = btn_name == 'month_widgets_btn'
+
+    stat_values = {}
+    reports = {}
+    written = []
+    for window in windows:
+        files = select_catalog_files(catalog[accumulation_windows[window]], btn_name, selected, months, placeholders)
+        if not files:
+            return {'name': job['name'], 'status': 'no data', 'files': written, 'seconds': time.perf_counter() - start_time}
+        stat_values[window], reports[window] = compute_window_stats(files, bounds, accumulation_windows[window], full_stats)
+        stats_path = os.path.join(job_dir, f"stats_spei{accumulation_windows[window]}.csv")
+        stats_to_frame(stat_values[window]).to_csv(stats_path)
+        written.append(stats_path)
+
+    values = stat_values[windows[0]]
+    if btn_name == 'month_widgets_btn':
+        figures = {'scatterplot': create_scatterplot(values, accumulation_windows, selected, placeholders, show=False),
+                   'boxplot': create_boxplot(values, accumulation_windows, selected, placeholders, show=False)}
+    elif btn_name == 'year_widgets_btn':
+        figures = {'linechart': create_linechart(values, accumulation_windows, selected, placeholders, show=False)}
+    elif btn_name == 'year_range_widgets_btn':
+        figures = {'stripechart': create_stripechart(values, accumulation_windows, selected, placeholders, show=False)}
+    else:
+        figures = {'areachart': create_combined_areachart(stat_values, selected, placeholders, show=False)}
+
+    for chart_name, fig in figures.items():
+        chart_path = os.path.join(job_dir, f'{chart_name}.html')
+        fig.write_html(chart_path, include_plotlyjs='cdn')
+        written.append(chart_path)
+        if image_format:
+            image_path = os.path.join(job_dir, f'{chart_name}.{image_format}')
+            fig.write_image(image_path)
+            written.append(image_path)
+
+    with open(os.path.join(job_dir, 'job.json'), 'w') as file:
+        json.dump({'job': job, 'selected': selected, 'bounds': [float(b) for b in bounds], 'cleaning': reports}, file, indent=2, default=str)
+    return {'name': job['name'], 'status': 'ok', 'files': written, 'cleaning': reports, 'seconds': time.perf_counter() - start_time}
+
+
+
+def run_batch(jobs, output_dir, workers=1, data_root=DATA_ROOT, country_list=None, image_format=None, placeholders=PLACEHOLDERS):
+    """
+    Run a list of jobs with a shared file catalog and boundary cache, in parallel worker processes.
+
+    The catalog of every accumulation window used by the jobs is built and validated once, and the boundaries of
+    each area are fetched once, in the main process; the jobs themselves then run on a process pool.
+
+    Parameters:
+    jobs (list): The job dictionaries (see `read_jobs`).
+    output_dir (str): The folder where the outputs are written.
+    workers (int): Number of worker processes; 1 runs the jobs in the current process. Defaults to 1.
+    data_root (str): The root folder of the SPEI archive.
+    country_list (list, optional): List of country dictionaries; read from 'country_list.json' if not given.
+    image_format (str, optional): Also export the charts as static images in this format (e.g. 'png').
+    placeholders (dict): Placeholder values for the selections.
+
+    Returns:
+    list: One summary dictionary per job, in the order of `jobs`. Failed jobs have status 'error' and a message.
+    """
+    accumulation_windows = read_json_to_dict('accumulation_windows.json')
+    country_list = country_list if country_list is not None else read_json_to_sorted_dict('country_list.json')
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = {}
+    runnable = []
+    bounds_cache = {}
+    used_windows = set()
+    for job in jobs:
+        try:
+            btn_name, selected = build_selection(job, placeholders)
+            bounds = resolve_bounds(selected, country_list, bounds_cache, placeholders)
+            if bounds is None:
+                raise ValueError(f"Job {job['name']}: no boundaries found for the selected area.")
+        except Exception as e:
+            results[job['name']] = {'name': job['name'], 'status': 'error', 'message': str(e)}
+            continue
+        windows = selected['accumulation_windows_multiple'] if btn_name == 'accumulation_windows_widgets_btn' else [selected['accumulation_window']]
+        used_windows.update(accumulation_windows[window] for window in windows)
+        runnable.append((job, bounds))
+
+    catalog = build_catalog(used_windows, data_root)
+
+    if workers <= 1:
+        for job, bounds in runnable:
+            try:
+                results[job['name']] = run_job(job, bounds, catalog, output_dir, image_format, placeholders)
+            except Exception as e:
+                results[job['name']] = {'name': job['name'], 'status': 'error', 'message': str(e)}
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_job, job, bounds, catalog, output_dir, image_format, placeholders): job
+                       for job, bounds in runnable}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    results[job['name']] = future.result()
+                except Exception as e:
+                    results[job['name']] = {'name': job['name'], 'status': 'error', 'message': str(e)}
+
+    summary = [results[job['name']] for job in jobs]
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as file:
+        json.dump(summary, file, indent=2, default=str)
+    return summary
+
+
+
+def main(argv=None):
+    """
+    Command line entry point of the batch runner.
+
+    Parameters:
+    argv (list, optional): The command line arguments; `sys.argv[1:]` if not given.
+
+    Returns:
+    int: The exit code, 1 if any job failed.
+    """
+    parser = argparse.ArgumentParser(description='Run SPEI selections headlessly and write statistics and charts to disk.')
+    parser.add_argument('jobs', help='YAML or JSON file with the list of jobs')
+    parser.add_argument('--output-dir', default='reports', help='folder where the outputs are written')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--data-root', default=DATA_ROOT, help='root folder of the SPEI archive')
+    parser.add_argument('--image-format', default=None, help='also export charts as images (e.g. png)')
+    args = parser.parse_args(argv)
+
+    summary = run_batch(read_jobs(args.jobs), args.output_dir, args.workers, args.data_root, image_format=args.image_format)
+    for result in summary:
+        print(f"{result['name']}: {result['status']}" + (f" - {result['message']}" if 'message' in result else ''))
+    return int(any(result['status'] == 'error' for result in summary))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
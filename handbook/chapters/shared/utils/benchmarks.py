@@ -0,0 +1,432 @@
+"""
+Benchmark suite of the SPEI pipeline on synthetic archives.
+
+Generates a synthetic archive shaped like the ERA5-Drought monthly files (same names, folders, variables, a
+descending 0.25 degree latitude axis, -9999 fills over the sea and scattered cells, duplicated time steps and
+cftime-stamped months), then times each stage of the pipeline across region sizes and period lengths. From the
+`handbook/chapters/shared` folder:
+
+    python -m utils.benchmarks --archive /tmp/spei_benchmark --output benchmark_results.json --save-baseline
+    ...  # change the code
+    python -m utils.benchmarks --archive /tmp/spei_benchmark --output benchmark_results.json --baseline benchmark_baseline.json
+
+The second run exits with code 1 if a stage became slower than the baseline by more than the threshold. Timings are
+the fastest of several repeats with a warm page cache, so they measure the code rather than the disk.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import cftime
+import netCDF4 as nc
+import numpy as np
+import pandas as pd
+import dask
+import xarray as xr
+from utils.data_preprocess import (get_data_path, list_spei_files, filter_valid_nc_files,
+                                   load_and_preprocess_dataset, process_datarray, compute_stats)
+from utils.charts import prepare_stripe_data
+from utils.instrumentation import enable_instrumentation, disable_instrumentation, instrumentation_report
+
+
+MANIFEST_NAME = 'synthetic_archive.json'
+DEFAULT_ARCHIVE = {
+    'accumulation_windows': ['12'],
+    'start_year': 1991,
+    'end_year': 2020,
+    'extent': [30.0, -20.0, 50.0, 0.0],     # (min_lon, min_lat, max_lon, max_lat) of the synthetic grid
+    'resolution': 0.25,
+    'storage_chunks': [1, 40, 40],           # (time, lat, lon) on-disk chunks; None for the library default
+    'sea_fraction': 0.2,                     # Share of the grid filled with -9999 at every time step
+    'invalid_fraction': 0.01,                # Share of land cells filled with -9999 at random
+    'duplicate_months': 2,                   # Files holding their time step twice
+    'cftime_months': 2,                      # Files whose time axis is stamped with a pre-1678 reference date
+    'seed': 0,
+}
+REGION_SIZES = {'small': 2.0, 'medium': 5.0, 'large': 15.0}     # Side of the square regions, in degrees
+PERIOD_LENGTHS = (1, 10, 30)                                    # Years, ending with the last year of the archive
+STAGES = ('discover', 'validate', 'load', 'clean', 'compute_stats', 'chart_preparation')
+DEFAULT_REPEATS = 3
+DEFAULT_THRESHOLD = 1.25          # A stage regresses when it takes 25% longer than in the baseline ...
+DEFAULT_MIN_SECONDS = 0.05        # ... and at least this much longer, to ignore the noise of very short stages
+INVALID_VALUE = -9999.0
+CFTIME_UNITS = 'days since 0001-01-01 00:00:00'
+TIME_UNITS = 'days since 1940-01-01 00:00:00'
+
+
+
+def archive_grid(extent, resolution):
+    """
+    Builds the coordinates of a synthetic grid on multiples of the resolution, latitudes descending as in ERA5.
+
+    Parameters:
+    extent (list): (min_lon, min_lat, max_lon, max_lat) of the grid.
+    resolution (float): The grid spacing in degrees.
+
+    Returns:
+    tuple: The latitude and longitude arrays.
+    """
+    min_lon, min_lat, max_lon, max_lat = extent
+    lat = np.round(np.arange(round(max_lat / resolution), round(min_lat / resolution) - 1, -1) * resolution, 6)
+    lon = np.round(np.arange(round(min_lon / resolution), round(max_lon / resolution) + 1) * resolution, 6)
+    return lat, lon
+
+
+
+def write_synthetic_file(file_path, variable, dates, values, lat, lon, units=TIME_UNITS, storage_chunks=None):
+    """
+    Writes one monthly file laid out like the ERA5-Drought files.
+
+    Parameters:
+    file_path (str): The destination path.
+    variable (str): The variable name (e.g. 'SPEI12').
+    dates (list): The time stamps of the file, as cftime dates.
+    values (np.ndarray): The values of shape (time, lat, lon), with -9999 for invalid cells.
+    lat (np.ndarray): The latitudes.
+    lon (np.ndarray): The longitudes.
+    units (str): The units of the time axis.
+    storage_chunks (list, optional): The on-disk chunk shape, clipped to the array shape.
+    """
+    with nc.Dataset(file_path, 'w') as dataset:
+        dataset.createDimension('time', None)
+        dataset.createDimension('lat', lat.size)
+        dataset.createDimension('lon', lon.size)
+        time_var = dataset.createVariable('time', 'f8', ('time',))
+        time_var.units = units
+        time_var.calendar = 'standard'
+        time_var[:] = nc.date2num(dates, units, 'standard')
+        dataset.createVariable('lat', 'f8', ('lat',))[:] = lat
+        dataset.createVariable('lon', 'f8', ('lon',))[:] = lon
+        chunksizes = None
+        if storage_chunks:
+            chunksizes = [min(chunk, size) for chunk, size in zip(storage_chunks, values.shape)]
+        var = dataset.createVariable(variable, 'f4', ('time', 'lat', 'lon'), zlib=True, shuffle=True, chunksizes=chunksizes)
+        var[:] = values
+
+
+
+def generate_synthetic_archive(archive_root, **config):
+    """
+    Generates a synthetic SPEI archive, or reuses the one already in `archive_root` if it was generated with the
+    same configuration.
+
+    Values are drawn from a standard normal distribution, like SPEI. A fixed sea mask and a random share of the land
+    cells are filled with -9999, some files hold their time step twice and some are stamped with a reference date
+    before 1678, like the January and February 2024 files of the real archive.
+
+    Parameters:
+    archive_root (str): The root folder of the archive, used as `data_root` by the pipeline.
+    config: Overrides of DEFAULT_ARCHIVE (accumulation_windows, start_year, end_year, extent, resolution,
+            storage_chunks, sea_fraction, invalid_fraction, duplicate_months, cftime_months, seed).
+
+    Returns:
+    dict: The manifest of the archive: its configuration, grid size, number of files and the injected months.
+    """
+    unknown = set(config) - set(DEFAULT_ARCHIVE)
+    if unknown:
+        raise ValueError(f"Unknown archive settings: {', '.join(sorted(unknown))}.")
+    config = {**DEFAULT_ARCHIVE, **config}
+    config['accumulation_windows'] = [str(window) for window in config['accumulation_windows']]
+    config['extent'] = [float(value) for value in config['extent']]
+    manifest_path = os.path.join(archive_root, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        if manifest['config'] == config:
+            return manifest
+
+    rng = np.random.default_rng(config['seed'])
+    lat, lon = archive_grid(config['extent'], config['resolution'])
+    months = pd.date_range(f"{config['start_year']}-01", f"{config['end_year']}-12", freq='MS')
+    n_injected = config['duplicate_months'] + config['cftime_months']
+    if n_injected > len(months):
+        raise ValueError("More injected months than months in the archive.")
+    injected = rng.choice(len(months), size=n_injected, replace=False)
+    duplicated = sorted(f'{months[i]:%Y%m}' for i in injected[:config['duplicate_months']])
+    cftime_stamped = sorted(f'{months[i]:%Y%m}' for i in injected[config['duplicate_months']:])
+
+    # A smooth random field thresholded at its quantile gives a compact "sea" instead of scattered cells
+    field = rng.normal(size=(lat.size // 8 + 2, lon.size // 8 + 2))
+    field = np.kron(field, np.ones((8, 8)))[:lat.size, :lon.size]
+    sea = field < np.quantile(field, config['sea_fraction']) if config['sea_fraction'] > 0 else np.zeros(field.shape, bool)
+
+    start_time = time.time()
+    for window in config['accumulation_windows']:
+        data_path = get_data_path(window, archive_root)
+        os.makedirs(data_path, exist_ok=True)
+        variable = f'SPEI{window}'
+        for month in months:
+            stamp = f'{month:%Y%m}'
+            date = cftime.DatetimeGregorian(month.year, month.month, 1)
+            dates = [date, date] if stamp in duplicated else [date]
+            values = rng.standard_normal((len(dates), lat.size, lon.size), dtype='float32')
+            values[:, rng.random((lat.size, lon.size)) < config['invalid_fraction']] = INVALID_VALUE
+            values[:, sea] = INVALID_VALUE
+            file_name = f'{variable}_genlogistic_global_era5_moda_ref1991to2020_{stamp}.nc'
+            write_synthetic_file(os.path.join(data_path, file_name), variable, dates, values, lat, lon,
+                                 CFTIME_UNITS if stamp in cftime_stamped else TIME_UNITS, config['storage_chunks'])
+
+    manifest = {
+        'config': config,
+        'shape': {'lat': int(lat.size), 'lon': int(lon.size)},
+        'files_per_window': len(months),
+        'duplicated_months': duplicated,
+        'cftime_months': cftime_stamped,
+    }
+    with open(manifest_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    print(f"Synthetic archive of {len(months) * len(config['accumulation_windows'])} files written to {archive_root} "
+          f"in {time.time() - start_time:.1f} s")
+    return manifest
+
+
+
+def restamp_cftime_months(data: xr.DataArray, months) -> xr.DataArray:
+    """
+    Turns the time stamps of the given months back into cftime.DatetimeGregorian objects.
+
+    Recent xarray versions decode every in-range date of a standard calendar to datetime64, whatever the reference
+    date of the file, so the cftime stamps of the real archive only appear with older versions. Restamping them
+    keeps the cleaning stage doing the same work on every version.
+
+    Parameters:
+    data (xr.DataArray): The loaded data with a 'time' dimension.
+    months (list): The 'YYYYMM' months to restamp.
+
+    Returns:
+    xr.DataArray: The data with an object time axis if any month was restamped, unchanged otherwise.
+    """
+    times = pd.DatetimeIndex(data['time'].values) if np.issubdtype(data['time'].dtype, np.datetime64) else None
+    if times is None or not months:
+        return data
+    restamp = times.strftime('%Y%m').isin(months)
+    if not restamp.any():
+        return data
+    stamps = np.array([cftime.DatetimeGregorian(t.year, t.month, t.day) if flag else t.to_datetime64()
+                       for t, flag in zip(times, restamp)], dtype=object)
+    return data.assign_coords(time=('time', stamps))
+
+
+
+def region_bounds(extent, size):
+    """
+    Returns a square region of the given side centred in the extent of the archive.
+
+    Parameters:
+    extent (list): (min_lon, min_lat, max_lon, max_lat) of the archive grid.
+    size (float): The side of the region in degrees, clipped to the extent.
+
+    Returns:
+    tuple: The bounds (min_lon, min_lat, max_lon, max_lat), on multiples of 0.25 degrees.
+    """
+    min_lon, min_lat, max_lon, max_lat = extent
+    centre_lon, centre_lat = (min_lon + max_lon) / 2, (min_lat + max_lat) / 2
+    half = min(size, max_lon - min_lon, max_lat - min_lat) / 2
+    snap = lambda value: round(value * 4) / 4
+    return (snap(centre_lon - half), snap(centre_lat - half), snap(centre_lon + half), snap(centre_lat + half))
+
+
+
+def run_case(manifest, archive_root, accumulation_window, bounds, start_year, end_year, full_stats=True):
+    """
+    Runs the pipeline once for one region and period, timing every stage.
+
+    Parameters:
+    manifest (dict): The manifest of the archive.
+    archive_root (str): The root folder of the archive.
+    accumulation_window (str): The accumulation window in months.
+    bounds (tuple): The region (min_lon, min_lat, max_lon, max_lat).
+    start_year (int): First year of the period.
+    end_year (int): Last year of the period.
+    full_stats (bool): If True, all statistics are computed. Defaults to True.
+
+    Returns:
+    dict: The seconds of each stage, the cleaning report and the pipeline counters.
+    """
+    seconds = {}
+    enable_instrumentation(reset=True)
+    try:
+        start_time = time.perf_counter()
+        files = list_spei_files(accumulation_window, start_year, end_year, archive_root)
+        seconds['discover'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        files = filter_valid_nc_files(files)
+        seconds['validate'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        data = load_and_preprocess_dataset(files, bounds)[f'SPEI{accumulation_window}']
+        seconds['load'] = time.perf_counter() - start_time
+        data = restamp_cftime_months(data, manifest['cftime_months'])
+
+        start_time = time.perf_counter()
+        data, report = process_datarray(data)
+        seconds['clean'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        values = compute_stats(data, full_stats=full_stats)
+        seconds['compute_stats'] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        prepare_stripe_data(values, 'month')
+        seconds['chart_preparation'] = time.perf_counter() - start_time
+    finally:
+        counters = instrumentation_report()['counters']
+        disable_instrumentation()
+    return {'seconds': seconds, 'cleaning': report, 'counters': counters}
+
+
+
+def run_benchmarks(archive_root, region_sizes=REGION_SIZES, period_lengths=PERIOD_LENGTHS, repeats=DEFAULT_REPEATS,
+                   full_stats=True, **archive_config):
+    """
+    Generates (or reuses) a synthetic archive and times the pipeline for every accumulation window, region size and
+    period length.
+
+    Each case is run `repeats` times and the fastest time of every stage is kept; the first run also warms the page
+    cache.
+
+    Parameters:
+    archive_root (str): The root folder of the synthetic archive.
+    region_sizes (dict): Region names and sides in degrees. Defaults to REGION_SIZES.
+    period_lengths (tuple): Period lengths in years. Defaults to PERIOD_LENGTHS.
+    repeats (int): Number of runs of each case. Defaults to 3.
+    full_stats (bool): If True, all statistics are computed. Defaults to True.
+    archive_config: Settings of the synthetic archive, see `generate_synthetic_archive`.
+
+    Returns:
+    dict: The environment, the archive manifest and, per case, the timings, cleaning report and counters.
+    """
+    manifest = generate_synthetic_archive(archive_root, **archive_config)
+    config = manifest['config']
+    cases = {}
+    for window in config['accumulation_windows']:
+        for region, size in region_sizes.items():
+            bounds = region_bounds(config['extent'], size)
+            for years in period_lengths:
+                start_year = max(config['start_year'], config['end_year'] - int(years) + 1)
+                runs = [run_case(manifest, archive_root, window, bounds, start_year, config['end_year'], full_stats)
+                        for _ in range(max(1, int(repeats)))]
+                name = f'spei{window}/{region}/{years}y'
+                cases[name] = {
+                    'bounds': list(bounds),
+                    'years': [start_year, config['end_year']],
+                    'seconds': {stage: min(run['seconds'][stage] for run in runs) for stage in STAGES},
+                    'cleaning': runs[-1]['cleaning'],
+                    'counters': runs[-1]['counters'],
+                }
+                timings = ', '.join(f"{stage} {seconds:.3f}" for stage, seconds in cases[name]['seconds'].items())
+                print(f"{name}: {sum(cases[name]['seconds'].values()):.3f} s ({timings})")
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'xarray': xr.__version__,
+            'dask': dask.__version__,
+            'netCDF4': nc.__version__,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'archive': manifest,
+        'repeats': int(repeats),
+        'cases': cases,
+    }
+
+
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Compares benchmark results with a baseline, stage by stage.
+
+    Parameters:
+    results (dict): The results of `run_benchmarks`.
+    baseline (dict): Earlier results of `run_benchmarks` on the same archive configuration.
+    threshold (float): The largest allowed ratio between the current and the baseline time. Defaults to 1.25.
+    min_seconds (float): Slowdowns smaller than this are ignored. Defaults to 0.05 s.
+
+    Returns:
+    dict: A dictionary containing:
+        - comparisons (list): For every stage of every case found in both, the baseline and current seconds,
+          their ratio and whether it is a regression.
+        - regressions (list): The comparisons flagged as regressions.
+        - missing_cases (list): Baseline cases absent from the results.
+    """
+    if baseline['archive']['config'] != results['archive']['config']:
+        print("Warning: the baseline was measured on a differently configured archive; the comparison is indicative only.")
+    comparisons = []
+    for name, case in baseline['cases'].items():
+        if name not in results['cases']:
+            continue
+        for stage, before in case['seconds'].items():
+            after = results['cases'][name]['seconds'].get(stage)
+            if after is None:
+                continue
+            ratio = after / before if before > 0 else float('inf') if after > 0 else 1.0
+            comparisons.append({
+                'case': name,
+                'stage': stage,
+                'baseline_seconds': before,
+                'seconds': after,
+                'ratio': ratio,
+                'regression': ratio > threshold and after - before > min_seconds,
+            })
+    return {
+        'comparisons': comparisons,
+        'regressions': [comparison for comparison in comparisons if comparison['regression']],
+        'missing_cases': [name for name in baseline['cases'] if name not in results['cases']],
+    }
+
+
+
+def main(argv=None):
+    """
+    Command line entry point of the benchmark suite.
+
+    Parameters:
+    argv (list, optional): The command line arguments; `sys.argv[1:]` if not given.
+
+    Returns:
+    int: The exit code, 1 if a stage regressed against the baseline.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the SPEI pipeline on a synthetic archive.')
+    parser.add_argument('--archive', default='spei_benchmark_archive', help='folder of the synthetic archive (generated if missing)')
+    parser.add_argument('--windows', nargs='+', default=DEFAULT_ARCHIVE['accumulation_windows'], help='accumulation windows in months')
+    parser.add_argument('--start-year', type=int, default=DEFAULT_ARCHIVE['start_year'])
+    parser.add_argument('--end-year', type=int, default=DEFAULT_ARCHIVE['end_year'])
+    parser.add_argument('--extent', type=float, nargs=4, default=DEFAULT_ARCHIVE['extent'], metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'))
+    parser.add_argument('--periods', type=int, nargs='+', default=list(PERIOD_LENGTHS), help='period lengths in years')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--output', default='benchmark_results.json', help='file where the results are written')
+    parser.add_argument('--baseline', default=None, help='results of an earlier run to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='also write the results as benchmark_baseline.json')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.archive, period_lengths=args.periods, repeats=args.repeats,
+                             accumulation_windows=args.windows, start_year=args.start_year, end_year=args.end_year,
+                             extent=args.extent)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2, default=str)
+    if args.save_baseline:
+        with open('benchmark_baseline.json', 'w') as file:
+            json.dump(results, file, indent=2, default=str)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as file:
+        comparison = compare_to_baseline(results, json.load(file), args.threshold)
+    for item in comparison['regressions']:
+        print(f"Regression: {item['case']} {item['stage']} {item['baseline_seconds']:.3f} s -> {item['seconds']:.3f} s (x{item['ratio']:.2f})")
+    for name in comparison['missing_cases']:
+        print(f"Warning: case {name} of the baseline was not run.")
+    if not comparison['regressions']:
+        print(f"No regression in {len(comparison['comparisons'])} stage timings.")
+    return int(bool(comparison['regressions']))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
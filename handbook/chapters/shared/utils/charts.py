@@ -11,8 +11,10 @@ import cartopy.crs as ccrs
 import hvplot.xarray
 from utils.widgets_handler import read_json_to_dict
 from utils.widgets_handler import get_adm_level_and_area_name
+from utils.instrumentation import instrumented
 
 color_palette_json = 'color_palette_bright.json'
+APPROXIMATE_TITLE_SUFFIX = ' (approximate, sampled grid)'
 
 def assign_colors(values):
     """
@@ -56,6 +58,7 @@ def assign_colors(values):
 
 
 
+@instrumented('figure_map')
 def plot_geographical_distribution(ds):
     """
     Plots a geographical map showing the distribution of SPEI (Standardized Precipitation-Evapotranspiration Index) values
@@ -97,7 +100,8 @@ def plot_geographical_distribution(ds):
 
 
 
-def create_scatterplot(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict):
+@instrumented('figure_scatterplot')
+def create_scatterplot(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict, show: bool = True):
     """
     Creates and displays a scatterplot of the Standardized Precipitation-Evapotranspiration Index (SPEI)
     over time, using provided data points for both mean and median values. The plot marks mean values
@@ -118,9 +122,10 @@ def create_scatterplot(values: dict, accumulation_windows: dict, selected: dict,
         - 'month': The month for which the data is visualized.
     - placeholders (dict): A dictionary containing placeholder values for additional
                            configuration, such as ADM level and area names.
+    - show (bool): If True, the figure is displayed. Defaults to True.
 
     Returns:
-    - None: This function creates and displays the scatterplot directly using the Plotly visualization library.
+    - go.Figure: The scatterplot, also displayed directly when `show` is True.
     """
     times = values['times']
     means = values['means']
@@ -205,12 +210,15 @@ def create_scatterplot(values: dict, accumulation_windows: dict, selected: dict,
     )
 
     # Display the figure
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
 
 
 
-def create_boxplot(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict):
+@instrumented('figure_boxplot')
+def create_boxplot(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict, show: bool = True):
     """
     Creates a boxplot chart using the provided boxplot statistics, where boxes are colored 
     based on SPEI index values. This function also configures the plot with custom labels 
@@ -232,9 +240,10 @@ def create_boxplot(values: dict, accumulation_windows: dict, selected: dict, pla
         - 'month': The month for which the data is plotted.
     - placeholders (dict): A dictionary containing placeholder values for additional 
       configuration, such as ADM level and area names.
+    - show (bool): If True, the figure is displayed. Defaults to True.
 
     Returns:
-    - None: This function directly displays the boxplot using Plotly's visualization library.
+    - go.Figure: The boxplot, also displayed directly when `show` is True.
     """
     times = values['times']
     medians = values['medians']
@@ -292,11 +301,14 @@ def create_boxplot(values: dict, accumulation_windows: dict, selected: dict, pla
         showlegend=True
     )
 
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
     
     
-def create_linechart(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict):
+@instrumented('figure_linechart')
+def create_linechart(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict, show: bool = True):
     """
     Creates and displays a line chart with markers to depict Median SPEI (Standardized Precipitation-Evapotranspiration Index) trends 
     over the months of a selected year within a specified region and area. Each point on the line chart is color-coded based on its 
@@ -315,9 +327,10 @@ def create_linechart(values: dict, accumulation_windows: dict, selected: dict, p
         - 'year': The year for which the data is visualized.
     - placeholders (dict): Contains placeholder values and additional configuration data,
                            such as administrative level and area names, which are used in labeling and tooltips.
+    - show (bool): If True, the figure is displayed. Defaults to True.
 
     Returns:
-    - None: The function directly displays the line chart using the Plotly visualization library.
+    - go.Figure: The line chart, also displayed directly when `show` is True.
 
     The line chart includes a custom tooltip for each data point that shows the month and year along with the median SPEI value, enhancing 
     user interaction by providing detailed context. Additionally, a legend for SPEI categories is included to assist with interpretation of the SPEI values.
@@ -374,37 +387,27 @@ def create_linechart(values: dict, accumulation_windows: dict, selected: dict, p
         legend_title="SPEI Categories"
     )
 
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
     
     
-def create_stripechart(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict, aggregate_by: str = 'month'):
+def prepare_stripe_data(values: dict, aggregate_by: str = 'month'):
     """
-    Generates a vertical bar (stripe) chart that visualizes the median SPEI (Standardized Precipitation-Evapotranspiration Index) values over a specified time period. 
-    Each bar represents a specific period (month or year based on aggregation) and is color-coded based on the median SPEI value, facilitating an intuitive understanding 
-    of drought severity over time. The chart features tooltips that provide detailed information about the median SPEI for each period when hovered over. 
+    Prepares the bars of the stripe chart: the x-axis labels, the colors and the tooltips, sorted by date.
 
     Parameters:
         values (dict): Contains the time points (`times`) and their corresponding median SPEI values (`medians`).
-        accumulation_windows (dict): Maps accumulation_window identifiers to their SPEI calculation descriptions, used for labeling the chart.
-        selected (dict): Stores user-selected filters including:
-            - 'accumulation_window': The SPEI accumulation_window (e.g., monthly, annual).
-            - 'country': The country for the data.
-            - 'area': Specific area within the country.
-            - 'year_range': Tuple of (start_year, end_year) defining the range for visualization.
-        placeholders (dict): Holds placeholder data and additional configuration items for display purposes.
-        aggregate_by (str): Determines the aggregation level for data points (default 'month'). 
-                            'year' is the other possible value, allowing for annual aggregation.
+        aggregate_by (str): 'month' for one label per month, 'year' for year labels. Defaults to 'month'.
 
     Returns:
-        None: The function directly creates and displays the stripe chart using Plotly's visualization capabilities.
+        tuple: The lists of x-axis labels, colors and tooltip texts.
     """
     times = values['times']
     medians = values['medians']
-    cmap = read_json_to_dict(color_palette_json)
     colors = assign_colors(medians)
-    _, area = get_adm_level_and_area_name(selected, placeholders)
-    
+
     # Convert numpy datetime64 to datetime64[M] for sorting
     date_transform = [np.datetime64(time, 'M') for time in times]
 
@@ -413,14 +416,43 @@ def create_stripechart(values: dict, accumulation_windows: dict, selected: dict,
     sorted_dates = [date for date, _, _ in paired_data]
     sorted_colors = [color for _, color, _ in paired_data]
     sorted_medians = [median for _, _, median in paired_data]
-    
+
     # Generate tooltip texts
+    tooltip_texts = [f"{date.astype(object).strftime('%B %Y')}, median: {median:.2f}" for date, median in zip(sorted_dates, sorted_medians)]
     if aggregate_by == 'month':
-        tooltip_texts = [f"{date.astype(object).strftime('%B %Y')}, median: {median:.2f}" for date, median in zip(sorted_dates, sorted_medians)]
         sorted_dates = [str(date) for date in sorted_dates]  # Convert to string for plotting
     else:
-        tooltip_texts = [f"{date.astype(object).strftime('%B %Y')}, median: {median:.2f}" for date, median in zip(sorted_dates, sorted_medians)]
         sorted_dates = [date.astype('datetime64[Y]').astype(str)[:4] for date in sorted_dates]  # Show year on x-axis
+    return sorted_dates, sorted_colors, tooltip_texts
+
+
+
+@instrumented('figure_stripechart')
+def create_stripechart(values: dict, accumulation_windows: dict, selected: dict, placeholders: dict, aggregate_by: str = 'month', show: bool = True):
+    """
+    Generates a vertical bar (stripe) chart that visualizes the median SPEI (Standardized Precipitation-Evapotranspiration Index) values over a specified time period. 
+    Each bar represents a specific period (month or year based on aggregation) and is color-coded based on the median SPEI value, facilitating an intuitive understanding 
+    of drought severity over time. The chart features tooltips that provide detailed information about the median SPEI for each period when hovered over. 
+
+    Parameters:
+        values (dict): Contains the time points (`times`) and their corresponding median SPEI values (`medians`).
+        accumulation_windows (dict): Maps accumulation_window identifiers to their SPEI calculation descriptions, used for labeling the chart.
+        selected (dict): Stores user-selected filters including:
+            - 'accumulation_window': The SPEI accumulation_window (e.g., monthly, annual).
+            - 'country': The country for the data.
+            - 'area': Specific area within the country.
+            - 'year_range': Tuple of (start_year, end_year) defining the range for visualization.
+        placeholders (dict): Holds placeholder data and additional configuration items for display purposes.
+        aggregate_by (str): Determines the aggregation level for data points (default 'month'). 
+                            'year' is the other possible value, allowing for annual aggregation.
+        show (bool): If True, the figure is displayed. Defaults to True.
+
+    Returns:
+        go.Figure: The stripe chart, also displayed directly when `show` is True.
+    """
+    cmap = read_json_to_dict(color_palette_json)
+    _, area = get_adm_level_and_area_name(selected, placeholders)
+    sorted_dates, sorted_colors, tooltip_texts = prepare_stripe_data(values, aggregate_by)
 
 
     # Filter dates to show only specific years in ten-year intervals
@@ -482,13 +514,45 @@ def create_stripechart(values: dict, accumulation_windows: dict, selected: dict,
         legend_title="SPEI Categories"
     )
     fig.update_yaxes(visible=False)
-    fig.show()   
+    if show:
+        fig.show()
+    return fig
+
+
+
+@instrumented('figure_stripechart_update')
+def update_stripechart(fig, values: dict, aggregate_by: str = 'month', approximate: bool = False):
+    """
+    Updates the stripes of a chart created by `create_stripechart` in place, e.g. when exact statistics replace
+    a fast approximation. Wrap the figure in `go.FigureWidget` so the displayed chart follows the update.
+
+    Parameters:
+        fig (go.Figure or go.FigureWidget): The stripe chart to update.
+        values (dict): Contains the time points (`times`) and their corresponding median SPEI values (`medians`).
+        aggregate_by (str): The aggregation level used to create the chart. Defaults to 'month'.
+        approximate (bool): If True, the title is marked as approximate; otherwise the mark is removed.
+
+    Returns:
+        go.Figure or go.FigureWidget: The updated figure.
+    """
+    sorted_dates, sorted_colors, tooltip_texts = prepare_stripe_data(values, aggregate_by)
+    title = fig.layout.title.text or ''
+    if title.endswith(APPROXIMATE_TITLE_SUFFIX):
+        title = title[:-len(APPROXIMATE_TITLE_SUFFIX)]
+    with fig.batch_update():
+        fig.data[0].x = sorted_dates
+        fig.data[0].y = [1] * len(sorted_dates)
+        fig.data[0].marker.color = sorted_colors
+        fig.data[0].hovertext = tooltip_texts
+        fig.layout.title.text = title + (APPROXIMATE_TITLE_SUFFIX if approximate else '')
+    return fig
 
 
 
     
     
-def create_combined_areachart(stat_values: dict, selected: dict, placeholders: dict):
+@instrumented('figure_areachart')
+def create_combined_areachart(stat_values: dict, selected: dict, placeholders: dict, show: bool = True):
     """
     Creates a combined area chart for multiple time series data, each representing a different accumulation window.
 
@@ -504,12 +568,13 @@ def create_combined_areachart(stat_values: dict, selected: dict, placeholders: d
     - selected (dict): A dictionary containing selection parameters such as the accumulation window and 
       country. This information is used to customize the chart's title and other textual content.
     - placeholders (dict): A dictionary used to handle dynamic placeholders in the widget system.
+    - show (bool): If True, the figure is displayed. Defaults to True.
 
     The charts are displayed using Plotly library, with each area chart's fill extending down to the zero y-axis. 
     The colors are predefined in a list and are cycled through for each timescale if more than seven timescales are present.
 
     Returns:
-    None: The function directly displays the figure using `fig.show()`.
+    go.Figure: The combined area chart, also displayed directly using `fig.show()` when `show` is True.
     """
     
     # List of 7 distinct colors for the 7 different accumulation windows
@@ -569,4 +634,6 @@ def create_combined_areachart(stat_values: dict, selected: dict, placeholders: d
         )
     )
 
-    fig.show()
+    if show:
+        fig.show()
+    return fig
@@ -0,0 +1,135 @@
+import netCDF4 as nc
+import numpy as np
+
+
+DEFAULT_MEMORY_BUDGET = 64e6          # Bytes per read chunk, small enough for several threads per core
+TIME_DIMS = ('time', 'valid_time')
+SPATIAL_DIMS = ('lat', 'lon', 'latitude', 'longitude', 'cell')     # 'cell': land cells of utils.land_storage
+
+
+
+def read_storage_layout(file_path, variable=None):
+    """
+    Reads the on-disk layout of a variable of a NetCDF file: its dimensions, shape, chunks and compression.
+
+    Parameters:
+    file_path (str): The path of the NetCDF file.
+    variable (str, optional): The variable to inspect; by default the data variable with the most values.
+
+    Returns:
+    dict: A dictionary containing:
+        - variable (str): The inspected variable.
+        - dims (tuple): Its dimension names.
+        - shape (tuple): Its shape.
+        - chunks (tuple): The on-disk chunk shape; for contiguous storage, one slab along the first dimension,
+          which is a single contiguous read.
+        - itemsize (int): Bytes per value.
+        - compression (dict): The filters reported by netCDF4 (zlib, shuffle, complevel, ...).
+    """
+    with nc.Dataset(file_path, 'r') as dataset:
+        if variable is None:
+            candidates = [name for name, var in dataset.variables.items() if name not in var.dimensions or len(var.dimensions) > 1]
+            variable = max(candidates, key=lambda name: dataset.variables[name].size)
+        var = dataset.variables[variable]
+        chunking = var.chunking()
+        return {
+            'variable': variable,
+            'dims': tuple(var.dimensions),
+            'shape': tuple(var.shape),
+            'chunks': (1,) + tuple(var.shape[1:]) if chunking == 'contiguous' and var.ndim else tuple(chunking or var.shape),
+            'itemsize': var.dtype.itemsize,
+            'compression': var.filters() or {},
+        }
+
+
+
+def plan_chunks(dims, shape, storage_chunks, itemsize, query='map', memory_budget=DEFAULT_MEMORY_BUDGET, fixed=None, limits=None):
+    """
+    Chooses read chunks that are whole multiples of the storage chunks and fit in a memory budget.
+
+    Every read chunk starts as one storage chunk (never less, so no compressed chunk is decompressed twice) and is
+    grown dimension by dimension in the order suited to the query: the spatial dimensions first for maps and
+    spatial reductions, the time dimension first for time series at points or small areas.
+
+    Parameters:
+    dims (tuple): The dimension names.
+    shape (tuple): The sizes of the dimensions.
+    storage_chunks (tuple): The on-disk chunk shape.
+    itemsize (int): Bytes per value.
+    query (str): 'map' or 'timeseries'. Defaults to 'map'.
+    memory_budget (float): Largest size of a read chunk, in bytes. Defaults to 64 MB.
+    fixed (dict, optional): Chunk sizes imposed on some dimensions.
+    limits (dict, optional): Largest chunk sizes of some dimensions (e.g. the length of one file).
+
+    Returns:
+    dict: The chunk size of every dimension.
+    """
+    if query not in ('map', 'timeseries'):
+        raise ValueError("The query must be 'map' or 'timeseries'.")
+    fixed = fixed or {}
+    limits = limits or {}
+    sizes = {dim: min(size, limits.get(dim, size)) for dim, size in zip(dims, shape)}
+    chunks = {dim: int(fixed.get(dim, min(chunk, sizes[dim]))) for dim, chunk in zip(dims, storage_chunks)}
+    steps = dict(chunks)
+
+    time_dims = [dim for dim in dims if dim in TIME_DIMS]
+    spatial_dims = [dim for dim in dims if dim not in TIME_DIMS]
+    order = spatial_dims + time_dims if query == 'map' else time_dims + spatial_dims
+
+    for dim in order:
+        if dim in fixed:
+            continue
+        other_bytes = itemsize * np.prod([chunks[other] for other in dims if other != dim])
+        multiple = int(memory_budget // (other_bytes * steps[dim])) if other_bytes * steps[dim] > 0 else 1
+        chunks[dim] = int(min(sizes[dim], max(1, multiple) * steps[dim]))
+    return chunks
+
+
+
+def plan_chunks_for_files(files, variable=None, query='map', memory_budget=DEFAULT_MEMORY_BUDGET, concat_dim='time'):
+    """
+    Plans the `chunks` argument of `xr.open_mfdataset` for files concatenated along a dimension, from the storage
+    layout of the first file.
+
+    Along the concatenation dimension a chunk cannot span several files, so it is limited to the length of one file.
+    The time steps of a file are read together when the budget allows it.
+
+    Parameters:
+    files (list): The NetCDF files, all with the same layout.
+    variable (str, optional): The variable to plan for; by default the largest one.
+    query (str): 'map' or 'timeseries'. Defaults to 'map'.
+    memory_budget (float): Largest size of a read chunk, in bytes. Defaults to 64 MB.
+    concat_dim (str): The dimension the files are concatenated along. Defaults to 'time'.
+
+    Returns:
+    dict: The chunk size of every dimension of the variable.
+    """
+    layout = read_storage_layout(files[0], variable)
+    limits = {}
+    if concat_dim in layout['dims'] and len(files) > 1:
+        limits[concat_dim] = layout['shape'][layout['dims'].index(concat_dim)]
+    return plan_chunks(layout['dims'], layout['shape'], layout['chunks'], layout['itemsize'], query, memory_budget, limits=limits)
+
+
+
+def plan_chunks_for_array(data, query='map', memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    Plans the chunks of a loaded dask-backed DataArray for a computation, as whole multiples of its current chunks
+    (which follow the storage layout when it was opened with planned chunks).
+
+    For 'map' queries the spatial dimensions are kept in one chunk, as required by the median and quantile
+    reductions over them, and time steps are grouped up to the memory budget.
+
+    Parameters:
+    data (xr.DataArray): The data, e.g. with dimensions ('time', 'lat', 'lon').
+    query (str): 'map' or 'timeseries'. Defaults to 'map'.
+    memory_budget (float): Largest size of a chunk, in bytes. Defaults to 64 MB.
+
+    Returns:
+    dict: The chunk size of every dimension.
+    """
+    current = {dim: (max(sizes) if sizes else 1) for dim, sizes in zip(data.dims, data.chunks)} if data.chunks else dict(data.sizes)
+    fixed = {}
+    if query == 'map':
+        fixed = {dim: data.sizes[dim] for dim in data.dims if dim in SPATIAL_DIMS}
+    return plan_chunks(data.dims, data.shape, [current[dim] for dim in data.dims], data.dtype.itemsize, query, memory_budget, fixed)
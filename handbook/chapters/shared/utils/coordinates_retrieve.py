@@ -6,6 +6,10 @@ import requests
 import folium
 from IPython.display import display, IFrame
 from utils.widgets_handler import get_adm_level_and_area_name
+from utils.instrumentation import instrumented, count
+
+
+EARTH_RADIUS_KM = 6371.0
 
 
 def get_isocode_for_country(country_list, country_name):
@@ -38,6 +42,7 @@ def fetch_geojson_data(base_url, isocode, adm_level, selected, selected_area):
     dict: GeoJSON data for the selected area.
     """
     api_url = f"{base_url}/{isocode}/{adm_level}/"
+    count('http_requests')
     response = requests.get(api_url)
     if response.status_code == 200:
         data = response.json()
@@ -59,6 +64,7 @@ def download_geojson_data(geojson_url):
     Returns:
     dict: GeoJSON data or None if download fails.
     """
+    count('http_requests')
     geojson_response = requests.get(geojson_url)
     if geojson_response.status_code == 200:
         return geojson_response.json()
@@ -74,7 +80,7 @@ def display_map(bounds, zoom_start=8):
     
     Parameters:
     bounds (tuple): A tuple containing the coordinates of the bounding box 
-                   in the format (min_lon, min_lat, max_lon, max_lat).
+                   in the format (min_lon, min_lat, max_lon, max_lat); min_lon > max_lon across the antimeridian.
     
     Returns:
     folium.Map: A folium map object with the bounding box displayed.
@@ -84,18 +90,19 @@ def display_map(bounds, zoom_start=8):
     """
     min_lon, min_lat, max_lon, max_lat = bounds
     
-    # Create a map centered around the middle of the bounds
+    # Create a map centered around the middle of the bounds, which may lie across the antimeridian
     center_lat = (min_lat + max_lat) / 2
-    center_lon = (min_lon + max_lon) / 2
+    center_lon = (min_lon + longitude_span(min_lon, max_lon) / 2 + 180) % 360 - 180
     folium_map = folium.Map(location=[center_lat, center_lon], zoom_start=zoom_start)
     
-    # Add a rectangle to represent the bounding box
-    folium.Rectangle(
-        bounds=[(min_lat, min_lon), (max_lat, max_lon)],
-        color='blue',
-        fill=True,
-        fill_opacity=0.5
-    ).add_to(folium_map)
+    # Add a rectangle to represent the bounding box, one on each side of the antimeridian if it crosses it
+    for west, south, east, north in split_bounding_box(bounds):
+        folium.Rectangle(
+            bounds=[(south, west), (north, east)],
+            color='blue',
+            fill=True,
+            fill_opacity=0.5
+        ).add_to(folium_map)
     
     return folium_map
 
@@ -140,6 +147,7 @@ def handle_fallbacks(adm_level, selected):
 
 
 
+@instrumented('get_boundaries')
 def get_boundaries(selected, country_list, placeholders):
     """
     Fetch geographic boundaries data for the selected area and return standardized coordinates.
@@ -199,6 +207,7 @@ def get_boundaries(selected, country_list, placeholders):
 
 
 
+@instrumented('bounding_box')
 def calculate_bounding_box(coordinates):
     """
     Calculate the bounding box from a list of coordinate tuples.
@@ -212,7 +221,8 @@ def calculate_bounding_box(coordinates):
 
     Returns:
     tuple: A tuple containing the coordinates of the bounding box in the format 
-           (min_lon, min_lat, max_lon, max_lat).
+           (min_lon, min_lat, max_lon, max_lat). For areas spanning the antimeridian (Fiji, Kiribati, eastern
+           Russia, ...), min_lon > max_lon and the box runs east from min_lon across 180 to max_lon.
 
     Example:
     >>> coordinates = [
@@ -230,7 +240,8 @@ def calculate_bounding_box(coordinates):
     Notes:
     - The function handles irregular nesting levels in the input coordinates.
     - The coordinates are first converted to a NumPy array and then flattened.
-    - The minimum and maximum longitude and latitude values are computed.
+    - The minimum and maximum latitude values are computed; the longitude extent is the shortest arc holding all
+      the points (see `longitude_extent`), which crosses the antimeridian when that is shorter.
     - The values are adjusted to the nearest grid points using `nearest_grid_point` function.
     """
     # Convert to numpy array for efficient processing and flatten
@@ -244,8 +255,7 @@ def calculate_bounding_box(coordinates):
         raise ValueError("Flattened coordinates should be a 2D array with shape (n, 2).")
 
     # Calculate the min and max values for longitude and latitude
-    min_lon = np.min(all_coords[:, 0])
-    max_lon = np.max(all_coords[:, 0])
+    min_lon, max_lon = longitude_extent(all_coords[:, 0])
     min_lat = np.min(all_coords[:, 1])
     max_lat = np.max(all_coords[:, 1])
 
@@ -269,7 +279,74 @@ def calculate_bounding_box(coordinates):
 
 
 
-            
+def longitude_extent(lons) -> tuple:
+    """
+    Finds the shortest range of longitudes holding all the given ones, which may cross the antimeridian.
+
+    The range is the complement of the largest gap between consecutive longitudes around the circle, so a country
+    spanning 180 degrees gets a box a few degrees wide instead of a near-global one.
+
+    Parameters:
+    lons (np.ndarray): The longitudes, in -180..180 or 0..360.
+
+    Returns:
+    tuple: (west, east) in -180..180; west > east when the range crosses the antimeridian.
+    """
+    ordered = np.unique(np.mod(np.asarray(lons, dtype='float64') + 180, 360) - 180)
+    gaps = np.diff(ordered)
+    wrap_gap = ordered[0] + 360 - ordered[-1]
+    if gaps.size and gaps.max() > wrap_gap:
+        largest = int(gaps.argmax())
+        return ordered[largest + 1], ordered[largest]
+    return ordered[0], ordered[-1]
+
+
+
+def split_bounding_box(bounds, grid_lon=None) -> list:
+    """
+    Splits a bounding box into the boxes that are contiguous in the longitudes of the grid: two for a box crossing
+    the antimeridian (min_lon > max_lon) on a -180..180 grid, or crossing the prime meridian on a 0..360 grid.
+
+    Parameters:
+    bounds (tuple or list): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat), or a list of them,
+                            split one by one.
+    grid_lon (np.ndarray, optional): The longitudes of the grid; -180..180 is assumed if not given.
+
+    Returns:
+    list: The boxes from west to east, with longitudes in the convention of the grid.
+    """
+    if len(bounds) and isinstance(bounds[0], (tuple, list)):
+        return [box for sub_bounds in bounds for box in split_bounding_box(sub_bounds, grid_lon)]
+    min_lon, min_lat, max_lon, max_lat = bounds
+    if grid_lon is not None and np.max(grid_lon) > 180:
+        grid_west, grid_east = float(np.min(grid_lon)), float(np.max(grid_lon))
+        if min_lon <= max_lon and max_lon - min_lon >= grid_east - grid_west:
+            return [(grid_west, min_lat, grid_east, max_lat)]
+        west, east = float(np.mod(min_lon, 360)), float(np.mod(max_lon, 360))
+        if west <= east:
+            return [(west, min_lat, east, max_lat)]
+        return [(west, min_lat, grid_east, max_lat), (grid_west, min_lat, east, max_lat)]
+    if min_lon <= max_lon:
+        return [tuple(bounds)]
+    return [(min_lon, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon, max_lat)]
+
+
+
+def longitude_span(min_lon, max_lon) -> float:
+    """
+    Get the width in degrees of a range of longitudes, which may cross the antimeridian (min_lon > max_lon).
+
+    Parameters:
+    min_lon (float): The western longitude.
+    max_lon (float): The eastern longitude.
+
+    Returns:
+    float: The width of the range.
+    """
+    return max_lon - min_lon if min_lon <= max_lon else max_lon - min_lon + 360
+
+
+
 def nearest_grid_point(coord, grid_resolution=0.25):
     """
     Adjust the given coordinate value to the nearest multiple of 0.25.
@@ -304,3 +381,24 @@ def generate_coordinate_values(start_coord, end_coord):
     coordinate_values = np.arange(adjusted_start, adjusted_end + 0.25, 0.25)      # Generate values within the range
     return coordinate_values.tolist()
 
+
+
+def cell_areas_km2(lat, lon):
+    """
+    Computes the surface area of each cell of a regular latitude/longitude grid.
+
+    Parameters:
+    lat (np.ndarray): Latitude values of the cell centres, in degrees.
+    lon (np.ndarray): Longitude values of the cell centres, in degrees.
+
+    Returns:
+    np.ndarray: Array of shape (lat, lon) with the cell areas in square kilometres.
+    """
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    dlat = np.abs(np.diff(lat)).min() if lat.size > 1 else 0.25
+    dlon = np.abs(np.diff(lon)).min() if lon.size > 1 else 0.25
+    south = np.deg2rad(np.clip(lat - dlat / 2, -90, 90))
+    north = np.deg2rad(np.clip(lat + dlat / 2, -90, 90))
+    band = EARTH_RADIUS_KM ** 2 * np.abs(np.sin(north) - np.sin(south)) * np.deg2rad(dlon)
+    return np.repeat(band[:, None], lon.size, axis=1)
@@ -8,8 +8,19 @@ import os
 import time
 from datetime import datetime
 import cftime
+import re
 from IPython.display import display
-from utils.coordinates_retrieve import generate_coordinate_values
+from utils.coordinates_retrieve import generate_coordinate_values, split_bounding_box
+from utils.weighted_stats import compute_weighted_stats
+from utils.chunk_planner import plan_chunks_for_files, plan_chunks_for_array
+from utils.instrumentation import instrumented, count, count_dask_tasks
+from utils.reference_index import (get_index_path, open_reference_index, chunk_indexed_dataset, select_months,
+                                   changed_indexed_files)
+from utils.quantization import is_quantized, dequantize, quantized_stats
+
+
+DATA_ROOT = '/data1/drought_dataset/spei/'
+MIDDLE_PATTERN = '*global_era5*_moda_ref1991to2020_'
 
 
     
@@ -23,6 +34,7 @@ def is_readable_nc(file_path):
     Returns:
     bool: True if the file is readable, False otherwise.
     """
+    count('files_probed')
     try:
         with nc.Dataset(file_path, 'r') as dataset:
             pass  # File opened successfully
@@ -33,13 +45,18 @@ def is_readable_nc(file_path):
 
     
     
+@instrumented('preprocess')
 def preprocess(ds, bounds):
     """
     Preprocess the dataset by subsetting it within the given geographic bounds.
 
+    A box crossing the antimeridian (min_lon > max_lon) is read as its two sides, each a contiguous block of
+    longitudes, joined from west to east; only the cells of the box are read. Longitudes keep their values, so
+    they jump from 180 to -180 across the dateline. A list of boxes sharing the same latitudes is read the same way.
+
     Parameters:
     ds (xarray.Dataset): The dataset to preprocess.
-    bounds (tuple): A tuple containing the geographic bounds (min_lon, min_lat, max_lon, max_lat).
+    bounds (tuple or list): A tuple containing the geographic bounds (min_lon, min_lat, max_lon, max_lat), or a list of them.
 
     Returns:
     xarray.Dataset: The subset of the original dataset within the specified bounds.
@@ -47,19 +64,28 @@ def preprocess(ds, bounds):
     Raises:
     ValueError: If generated coordinates do not match any available in the dataset.
     """
-    min_lon, min_lat, max_lon, max_lat = bounds
-    latitude_list = generate_coordinate_values(min_lat, max_lat)
-    longitude_list = generate_coordinate_values(min_lon, max_lon)
-    # Ensure only existing coordinates are used for subsetting
-    latitude_list = [lat for lat in latitude_list if lat in ds.lat.values]
-    longitude_list = [lon for lon in longitude_list if lon in ds.lon.values]
-    if not latitude_list or not longitude_list:
+    boxes = split_bounding_box(bounds, ds.lon.values)
+    subsets = []
+    for min_lon, min_lat, max_lon, max_lat in boxes:
+        latitude_list = generate_coordinate_values(min_lat, max_lat)
+        longitude_list = generate_coordinate_values(min_lon, max_lon)
+        # Ensure only existing coordinates are used for subsetting
+        latitude_list = [lat for lat in latitude_list if lat in ds.lat.values]
+        longitude_list = [lon for lon in longitude_list if lon in ds.lon.values]
+        if latitude_list and longitude_list:
+            subsets.append(ds.sel(lat=latitude_list, lon=longitude_list))
+    if not subsets:
         raise ValueError("Generated coordinates do not match any available in the dataset.")    
-    ds_subset = ds.sel(lat=latitude_list, lon=longitude_list)
-    return ds_subset
+    if len(subsets) == 1:
+        return subsets[0]
+    if any(not np.array_equal(subset.lat.values, subsets[0].lat.values) for subset in subsets):
+        raise ValueError("The boxes of a split selection must cover the same latitudes.")
+    # One read per side, so each is a single contiguous block of the files
+    return xr.concat(subsets, dim='lon', data_vars='minimal', coords='minimal', compat='override')
 
 
 
+@instrumented('discover_files')
 def generate_file_patterns(btn_name, selectors, placeholders, months, selected_accumulation_window, middle_pattern, data_path):
     """
     Generate file patterns to match NetCDF files based on the selected criteria.
@@ -101,6 +127,82 @@ def generate_file_patterns(btn_name, selectors, placeholders, months, selected_a
 
 
 
+def get_data_path(selected_accumulation_window, data_root=DATA_ROOT):
+    """
+    Get the folder holding the monthly SPEI files of an accumulation window.
+
+    Parameters:
+    selected_accumulation_window (str): The accumulation window in months (e.g. '12').
+    data_root (str): The root folder of the SPEI archive.
+
+    Returns:
+    str: The folder of the accumulation window.
+    """
+    return os.path.join(data_root, f'spei{selected_accumulation_window}/')
+
+
+
+def parse_file_month(file_path):
+    """
+    Extract the year and month encoded in the name of a monthly SPEI file.
+
+    Parameters:
+    file_path (str): The path of the NetCDF file (e.g. '.../SPEI12_genlogistic_global_era5_moda_ref1991to2020_202001.nc').
+
+    Returns:
+    tuple: A tuple (year, month) of integers, or None if the name does not contain a date.
+    """
+    match = re.search(r'ref\d{4}to\d{4}_(\d{4})(\d{2})[^/]*\.nc$', os.path.basename(file_path))
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+
+@instrumented('discover_files')
+def list_spei_files(selected_accumulation_window, start_year=None, end_year=None, data_root=DATA_ROOT):
+    """
+    List the monthly SPEI files of an accumulation window, optionally restricted to a year range, with a single glob.
+
+    Parameters:
+    selected_accumulation_window (str): The accumulation window in months (e.g. '12').
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    data_root (str): The root folder of the SPEI archive.
+
+    Returns:
+    list: The matching file paths sorted by date.
+    """
+    data_path = get_data_path(selected_accumulation_window, data_root)
+    files = glob.glob(os.path.join(data_path, f'SPEI{selected_accumulation_window}{MIDDLE_PATTERN}*.nc'))
+    dated_files = []
+    for file in files:
+        year_month = parse_file_month(file)
+        if year_month is None:
+            continue
+        if (start_year is not None and year_month[0] < int(start_year)) or (end_year is not None and year_month[0] > int(end_year)):
+            continue
+        dated_files.append((year_month, file))
+    return [file for _, file in sorted(dated_files)]
+
+
+
+def file_signature(path) -> dict:
+    """
+    Get the size and modification time of a file, which identify its version.
+
+    Parameters:
+    path (str): The file.
+
+    Returns:
+    dict: The 'size' and 'mtime' of the file.
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+
+@instrumented('validate_files')
 def filter_valid_nc_files(file_patterns):
     """
     Filter out valid NetCDF files from the given file patterns.
@@ -115,27 +217,65 @@ def filter_valid_nc_files(file_patterns):
 
 
 
-def load_and_preprocess_dataset(valid_files, bounds):
+@instrumented('open_mfdataset')
+def load_and_preprocess_dataset(valid_files, bounds, chunks=None, query='map'):
     """
     Load and preprocess the dataset from the valid NetCDF files.
 
     Parameters:
     valid_files (list): List of valid NetCDF files.
     bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    chunks (dict, optional): Read chunks; by default planned from the on-disk layout with `plan_chunks_for_files`.
+    query (str, optional): 'map' or 'timeseries', the access pattern the chunks are planned for. Defaults to 'map'.
 
     Returns:
     xarray.Dataset: The processed dataset.
     """
+    if chunks is None:
+        chunks = plan_chunks_for_files(valid_files, query=query)
+    count('files_opened', len(valid_files))
     return xr.open_mfdataset(
         valid_files,
         concat_dim='time',
         combine='nested',
+        chunks=chunks,
         parallel=False,   # If kernel returns an error set parallel to False
         preprocess=lambda ds: preprocess(ds, bounds)
     )
 
 
-def get_xarray_data(btn_name, bounds, selectors, placeholders, months, accumulation_windows):
+def load_indexed_dataset(file_patterns, bounds, index_path):
+    """
+    Load the months of the selected files from the reference index of their accumulation window, without opening
+    the files one by one.
+
+    Parameters:
+    file_patterns (list): The selected monthly files.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    index_path (str): The reference file of the accumulation window (see `get_index_path`).
+
+    Returns:
+    xarray.Dataset or None: The processed dataset, or None if some selected months are not indexed yet or their files
+                            changed since they were indexed.
+    """
+    year_months = {year_month for year_month in map(parse_file_month, file_patterns) if year_month is not None}
+    if not year_months:
+        return None
+    # The byte ranges of a rewritten file point at other data, or past its end
+    changed = changed_indexed_files(index_path, year_months)
+    if changed:
+        print(f"{len(changed)} indexed files changed since they were indexed, reading the files.")
+        return None
+    ds = select_months(open_reference_index(index_path), year_months)
+    indexed = set(zip(ds['time'].dt.year.values.tolist(), ds['time'].dt.month.values.tolist()))
+    if indexed != year_months:
+        print(f"{len(year_months - indexed)} selected months are not in the index yet, reading the files.")
+        return None
+    return chunk_indexed_dataset(preprocess(ds, bounds))
+
+
+
+def get_xarray_data(btn_name, bounds, selectors, placeholders, months, accumulation_windows, data_root=DATA_ROOT, index_root=None):
     """
     Load and process a dataset of climate data for a specified month, year, and geographic area.
 
@@ -146,17 +286,25 @@ def get_xarray_data(btn_name, bounds, selectors, placeholders, months, accumulat
     placeholders (dict): Placeholder values for widgets.
     months (dict): Dictionary of month abbreviations to numbers.
     accumulation_windows (dict): Dictionary of available accumulation_windows.
+    data_root (str): The root folder of the SPEI archive.
+    index_root (str, optional): The root folder of the reference indexes; if the index of the accumulation window
+                                exists and covers the selection, the data are opened through it.
 
     Returns:
     xarray.Dataset or None: The processed dataset or None if no readable files are found.
     """
     selected_accumulation_window = accumulation_windows[selectors['accumulation_window'].value]
-    data_path = f'/data1/drought_dataset/spei/spei{selected_accumulation_window}/'
-    middle_pattern = '*global_era5*_moda_ref1991to2020_'
+    data_path = get_data_path(selected_accumulation_window, data_root)
+    middle_pattern = MIDDLE_PATTERN
     
     file_patterns = generate_file_patterns(btn_name, selectors, placeholders, months, selected_accumulation_window, middle_pattern, data_path)
     
     try:
+        if index_root is not None and os.path.exists(get_index_path(selected_accumulation_window, index_root)):
+            data = load_indexed_dataset(file_patterns, bounds, get_index_path(selected_accumulation_window, index_root))
+            if data is not None:
+                return data
+
         valid_files = filter_valid_nc_files(file_patterns)
         if not valid_files:
             print("No readable NetCDF files found.")
@@ -305,6 +453,7 @@ def convert_cftime_to_datetime64(dataset: xr.DataArray, time_dim='time') -> (xr.
 
 
 
+@instrumented('clean')
 def process_datarray(data_array: xr.DataArray) -> (xr.DataArray, dict):
     """
     Processes an xarray DataArray through a sequence of data cleaning and transformation steps
@@ -331,14 +480,42 @@ def process_datarray(data_array: xr.DataArray) -> (xr.DataArray, dict):
 
 
 
-def compute_stats(data: xr.DataArray, full_stats: bool = True) -> dict:
+def spatial_sample(data: xr.DataArray, max_cells: int = 256) -> (xr.DataArray, int):
+    """
+    Takes every k-th grid cell along lat and lon so that at most about `max_cells` cells remain, for a fast
+    approximation of the regional statistics. Only the chunks holding the sampled cells are read.
+
+    Parameters:
+    - data (xr.DataArray): The input DataArray with 'lat' and 'lon' dimensions.
+    - max_cells (int, optional): Target number of sampled cells per time step. Defaults to 256.
+
+    Returns:
+    - xr.DataArray: The strided sample.
+    - int: The stride k (1 if the area is already small enough).
+    """
+    n_cells = data.sizes['lat'] * data.sizes['lon']
+    step = max(1, int(np.ceil(np.sqrt(n_cells / max_cells))))
+    if step == 1:
+        return data, 1
+    # Start half a stride in, so the sample is centred in the area, but never past a short side
+    offsets = {dim: min(step // 2, data.sizes[dim] - 1) for dim in ('lat', 'lon')}
+    return data.isel({dim: slice(offset, None, step) for dim, offset in offsets.items()}), step
+
+
+
+@instrumented('compute_stats')
+def compute_stats(data: xr.DataArray, full_stats: bool = True, weights=None, coverage: xr.DataArray = None) -> dict:
     """
     Computes the basic statistics from the SPEI data over latitude and longitude.
     These statistics include the median, lower and upper quantiles (25th and 75th percentiles), minimum, and maximum values.
 
     Parameters:
     data (xr.DataArray): The DataArray containing the SPEI data with dimensions including 'lat', 'lon', and 'time'.
+                         Quantized int16 data (utils.quantization) are reduced on their codes where unweighted.
     full_stats (bool): If True, computes all statistics. If False, computes only mean and median.
+    weights (xr.DataArray or str, optional): If given, cells are weighted by area ('cos_lat', 'area' or an array of
+                                             (lat, lon) weights) with `compute_weighted_stats`. Defaults to unweighted.
+    coverage (xr.DataArray, optional): Fraction of each cell inside the selected area, combined with the weights.
 
     Returns:
     dict: A dictionary containing:
@@ -350,27 +527,53 @@ def compute_stats(data: xr.DataArray, full_stats: bool = True) -> dict:
         - mins (np.ndarray): The array of minimum values (only if full_stats is True).
         - maxs (np.ndarray): The array of maximum values (only if full_stats is True).
     """
-    # Chunk the data along latitude and longitude to spped up the calculation
-    data = data.chunk({'lat': 'auto', 'lon': 'auto'})
+    if weights is not None or coverage is not None:
+        return compute_weighted_stats(dequantize(data), weights, full_stats, coverage)
+
+    # Group time steps into chunks aligned with the read chunks, each holding whole maps for the spatial reductions
+    data = data.chunk(plan_chunks_for_array(data, query='map'))
+    if is_quantized(data):
+        # Missing codes need no dropping: the statistics of the codes skip them
+        return quantized_stats(data, full_stats, dims=[dim for dim in data.dims if dim != 'time'])
+    if 'cell' in data.dims:
+        # Land-only data (utils.land_storage) have no grid rows or columns to drop
+        return compute_spatial_stats(data, full_stats, dims=['cell'])
     
     # Remove NaN values across lat and lon dimensions for more robust stats
     valid_data = data.dropna(dim='lat', how='all').dropna(dim='lon', how='all')
-    
+    return compute_spatial_stats(valid_data, full_stats)
+
+
+
+def compute_spatial_stats(valid_data: xr.DataArray, full_stats: bool = True, dims=('lat', 'lon')) -> dict:
+    """
+    Computes the statistics of `compute_stats` over latitude and longitude, without any rechunking or cleaning,
+    so a time block of a larger selection gives exactly the values of the whole selection for its time steps.
+
+    Parameters:
+    valid_data (xr.DataArray): The cleaned SPEI data with dimensions including 'lat', 'lon', and 'time'.
+    full_stats (bool): If True, computes all statistics. If False, computes only the median.
+    dims (tuple): The spatial dimensions reduced; ('cell',) for land-only data. Defaults to ('lat', 'lon').
+
+    Returns:
+    dict: The same dictionary as `compute_stats`.
+    """
     # Initialize the result dictionary
     result = {}
 
     # Compute the median and mean together to avoid recomputation
-    median = valid_data.median(dim=['lat', 'lon'], skipna=True)
-    mean = valid_data.mean(dim=['lat', 'lon'], skipna=True)
+    median = valid_data.median(dim=list(dims), skipna=True)
+    mean = valid_data.mean(dim=list(dims), skipna=True)
 
     # Compute additional statistics if full_stats is True
     if full_stats:
-        q1 = valid_data.quantile(0.25, dim=['lat', 'lon'], skipna=True)
-        q3 = valid_data.quantile(0.75, dim=['lat', 'lon'], skipna=True)
-        min_val = valid_data.min(dim=['lat', 'lon'], skipna=True)
-        max_val = valid_data.max(dim=['lat', 'lon'], skipna=True)
+        q1 = valid_data.quantile(0.25, dim=list(dims), skipna=True)
+        q3 = valid_data.quantile(0.75, dim=list(dims), skipna=True)
+        min_val = valid_data.min(dim=list(dims), skipna=True)
+        max_val = valid_data.max(dim=list(dims), skipna=True)
         
         # Compute all stats at once, parallelized
+        count_dask_tasks(median, mean, q1, q3, min_val, max_val)
         median_computed, mean_computed, q1_computed, q3_computed, min_computed, max_computed = dask.compute(
             median, mean, q1, q3, min_val, max_val
         )
@@ -383,6 +586,7 @@ def compute_stats(data: xr.DataArray, full_stats: bool = True) -> dict:
             'maxs': max_computed.values,
         })
     else:
+        count_dask_tasks(median, mean)
         median_computed, mean_computed = dask.compute(median, mean)
 
     # Update the result dictionary with median and time values
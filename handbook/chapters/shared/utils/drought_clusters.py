@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import ndimage
+from utils.drought_events import DROUGHT_THRESHOLD
+from utils.coordinates_retrieve import cell_areas_km2
+
+
+
+def find_root(parent, label):
+    """
+    Finds the representative label of a union-find forest, compressing the path on the way.
+
+    Parameters:
+    parent (dict): Mapping from a label to its parent label.
+    label (int): The label to resolve.
+
+    Returns:
+    int: The root label.
+    """
+    root = label
+    while parent.get(root, root) != root:
+        root = parent[root]
+    while parent.get(label, label) != root:
+        parent[label], label = root, parent[label]
+    return root
+
+
+
+def union_labels(parent, first, second):
+    """
+    Merges the union-find sets of two labels, keeping the smallest label as root.
+
+    Parameters:
+    parent (dict): Mapping from a label to its parent label.
+    first (np.ndarray): Labels to merge.
+    second (np.ndarray): Labels to merge, pairwise with `first`.
+    """
+    for a, b in set(zip(first.tolist(), second.tolist())):
+        root_a, root_b = find_root(parent, a), find_root(parent, b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+
+def label_block(dry, offset, wrap_lon):
+    """
+    Labels the 3D connected components of a (time, lat, lon) boolean block with face connectivity.
+
+    Parameters:
+    dry (np.ndarray): Boolean block, True where the cell is in drought.
+    offset (int): Value added to the labels so they are unique across blocks.
+    wrap_lon (bool): If True, components touching the first and last longitude are merged.
+
+    Returns:
+    tuple: The labelled block (0 for non-dry cells) and the list of label pairs to merge across the dateline.
+    """
+    labels, _ = ndimage.label(dry)
+    labels = np.where(labels > 0, labels + offset, 0)
+    pairs = None
+    if wrap_lon:
+        both = (labels[..., 0] > 0) & (labels[..., -1] > 0)
+        pairs = (labels[..., 0][both], labels[..., -1][both])
+    return labels, pairs
+
+
+
+def circular_mean_lon(sin_sum, cos_sum, grid_lon):
+    """
+    Turns weighted sums of the sine and cosine of longitudes into their mean longitude on the circle, so the mean of
+    cells on both sides of the dateline lies between them rather than on the opposite side of the globe.
+
+    Parameters:
+    sin_sum (np.ndarray): Weighted sums of the sines of the longitudes.
+    cos_sum (np.ndarray): Weighted sums of the cosines of the longitudes.
+    grid_lon (np.ndarray): Longitudes of the grid, whose convention (-180..180 or 0..360) the result follows.
+
+    Returns:
+    np.ndarray: The mean longitudes in degrees.
+    """
+    mean = np.rad2deg(np.arctan2(sin_sum, cos_sum))
+    return np.mod(mean, 360) if np.max(grid_lon) > 180 else mean
+
+
+
+def summarise_block(labels, values, threshold, areas, lat, lon, times):
+    """
+    Computes, for one labelled block, the area, centroid and deficit of every label at every time step.
+
+    Parameters:
+    labels (np.ndarray): Labelled (time, lat, lon) block.
+    values (np.ndarray): SPEI values of the block.
+    threshold (float): Drought threshold used to compute the deficit.
+    areas (np.ndarray): Cell areas of shape (lat, lon).
+    lat (np.ndarray): Latitude values.
+    lon (np.ndarray): Longitude values.
+    times (np.ndarray): Time values of the block.
+
+    Returns:
+    pd.DataFrame: One row per (label, time) with columns label, time, area_km2, cells, centroid_lat, lon_sin, lon_cos
+                  (area-weighted sums of the sine and cosine of the longitudes, see `circular_mean_lon`) and deficit.
+    """
+    t_idx, y_idx, x_idx = np.nonzero(labels)
+    if t_idx.size == 0:
+        return pd.DataFrame(columns=['label', 'time', 'area_km2', 'cells', 'centroid_lat', 'lon_sin', 'lon_cos', 'deficit'])
+    cell_labels = labels[t_idx, y_idx, x_idx]
+    cell_areas = areas[y_idx, x_idx]
+    deficit = (threshold - values[t_idx, y_idx, x_idx]) * cell_areas
+
+    # Group by (label, time) through a single integer key and bincount-style sums
+    keys, inverse = np.unique(np.column_stack([cell_labels, t_idx]), axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    area_sum = np.bincount(inverse, weights=cell_areas)
+    return pd.DataFrame({
+        'label': keys[:, 0],
+        'time': times[keys[:, 1]],
+        'area_km2': area_sum,
+        'cells': np.bincount(inverse),
+        'centroid_lat': np.bincount(inverse, weights=cell_areas * lat[y_idx]) / area_sum,
+        'lon_sin': np.bincount(inverse, weights=cell_areas * np.sin(np.deg2rad(lon[x_idx]))),
+        'lon_cos': np.bincount(inverse, weights=cell_areas * np.cos(np.deg2rad(lon[x_idx]))),
+        'deficit': np.bincount(inverse, weights=deficit),
+    })
+
+
+
+def track_drought_clusters(data: xr.DataArray, threshold: float = DROUGHT_THRESHOLD, time_block: int = 24,
+                           wrap_lon: bool = False, min_cells: int = 1) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Links dry cells (SPEI <= threshold) across space and time into coherent drought events using 3D connected-component
+    labelling on the (time, lat, lon) cube.
+
+    The cube is processed in blocks of `time_block` months, so only one block is in memory at a time. Components
+    of consecutive blocks that overlap at the block boundary are stitched together with a union-find structure,
+    which gives the same events as labelling the whole record at once.
+
+    Parameters:
+    data (xr.DataArray): SPEI values with dimensions ('time', 'lat', 'lon'). Dask-backed arrays are read block by block.
+    threshold (float): SPEI value at or below which a cell is in drought. Defaults to -1.0.
+    time_block (int): Number of months loaded and labelled at once. Defaults to 24.
+    wrap_lon (bool): If True, the grid is treated as global and events crossing the dateline are merged. Defaults to False.
+    min_cells (int): Events whose largest extent covers fewer cells are dropped. Defaults to 1.
+
+    Note:
+    - Centroid latitudes are area-weighted means; centroid longitudes are area-weighted means on the circle, so the
+      centroid of an event crossing the dateline lies near the dateline.
+
+    Returns:
+    tuple: A tuple containing:
+        - pd.DataFrame: The event table indexed by event id, with onset, termination, duration, max_area_km2,
+          total_deficit (deficit below the threshold integrated over area and months) and peak_cells.
+        - pd.DataFrame: The trajectory table indexed by (event id, time) with area_km2, cells, centroid_lat,
+          centroid_lon and deficit of the event at each time step.
+    """
+    data = data.transpose('time', 'lat', 'lon')
+    lat = data['lat'].values.astype('float64')
+    lon = data['lon'].values.astype('float64')
+    times = data['time'].values
+    areas = cell_areas_km2(lat, lon)
+
+    parent = {}
+    summaries = []
+    offset = 0
+    previous_last = None
+    for start in range(0, times.size, time_block):
+        stop = min(start + time_block, times.size)
+        values = np.asarray(data.isel(time=slice(start, stop)).values, dtype='float64')
+        labels, dateline_pairs = label_block(values <= threshold, offset, wrap_lon)
+        if dateline_pairs is not None:
+            union_labels(parent, *dateline_pairs)
+
+        # Stitch with the last time step of the previous block where both are dry
+        if previous_last is not None:
+            overlap = (previous_last > 0) & (labels[0] > 0)
+            union_labels(parent, previous_last[overlap], labels[0][overlap])
+
+        summaries.append(summarise_block(labels, values, threshold, areas, lat, lon, times[start:stop]))
+        previous_last = labels[-1].copy()
+        offset = max(offset, int(labels.max()))
+
+    trajectory = pd.concat(summaries, ignore_index=True)
+    if trajectory.empty:
+        empty_events = pd.DataFrame(columns=['onset', 'termination', 'duration', 'max_area_km2', 'total_deficit', 'peak_cells'])
+        return empty_events.rename_axis('event'), trajectory
+
+    trajectory['event'] = [find_root(parent, label) for label in trajectory['label'].tolist()]
+
+    # Labels merged through the dateline or a block boundary share a time step: combine them
+    trajectory['weighted_lat'] = trajectory['centroid_lat'] * trajectory['area_km2']
+    trajectory = trajectory.groupby(['event', 'time'])[['area_km2', 'cells', 'weighted_lat', 'lon_sin', 'lon_cos', 'deficit']].sum()
+    trajectory['centroid_lat'] = trajectory.pop('weighted_lat') / trajectory['area_km2']
+    trajectory['centroid_lon'] = circular_mean_lon(trajectory.pop('lon_sin').values, trajectory.pop('lon_cos').values, lon)
+
+    grouped = trajectory.reset_index().groupby('event')
+    events = pd.DataFrame({
+        'onset': grouped['time'].min(),
+        'termination': grouped['time'].max(),
+        'duration': grouped['time'].count(),
+        'max_area_km2': grouped['area_km2'].max(),
+        'total_deficit': grouped['deficit'].sum(),
+        'peak_cells': grouped['cells'].max(),
+    })
+    events = events[events['peak_cells'] >= min_cells]
+
+    # Renumber the events from 1 in order of onset
+    events = events.sort_values(['onset', 'max_area_km2'], ascending=[True, False])
+    new_ids = pd.Series(np.arange(1, len(events) + 1), index=events.index)
+    events.index = pd.Index(new_ids.values, name='event')
+    trajectory = trajectory[trajectory.index.get_level_values('event').isin(new_ids.index)]
+    trajectory.index = pd.MultiIndex.from_arrays(
+        [new_ids.loc[trajectory.index.get_level_values('event')].values, trajectory.index.get_level_values('time')],
+        names=['event', 'time'])
+    return events, trajectory.sort_index()
@@ -0,0 +1,252 @@
+import numpy as np
+import pandas as pd
+
+
+# Same boundary used by `assign_colors` for the "Moderately dry" category
+DROUGHT_THRESHOLD = -1.0
+WORKING_COPIES = 4              # Float64 arrays of a block alive at once (values, deficit, cumulative deficit, flattened series)
+
+
+
+def to_time_cell_array(data):
+    """
+    Reshape a SPEI cube or a table of regional series into a 2D (time, cell) array.
+
+    Parameters:
+    data (xr.DataArray or pd.DataFrame): Either a DataArray with a 'time' dimension (e.g. time, lat, lon or time, region),
+                                         or a DataFrame indexed by time with one column per region.
+
+    Returns:
+    tuple: A tuple containing:
+        - np.ndarray: The values as a float array of shape (time, cell).
+        - np.ndarray: The time values.
+        - pd.MultiIndex or pd.Index: The labels of each cell (one level per non-time dimension).
+    """
+    if isinstance(data, pd.DataFrame):
+        values = data.to_numpy(dtype='float64')
+        cell_index = pd.Index(data.columns, name=data.columns.name or 'region')
+        return values, data.index.values, cell_index
+
+    if 'time' not in data.dims:
+        raise ValueError("The input data must have a 'time' dimension.")
+    other_dims = [dim for dim in data.dims if dim != 'time']
+    if other_dims:
+        stacked = data.stack(cell=other_dims).transpose('time', 'cell')
+        cell_index = stacked.indexes['cell']
+    else:
+        stacked = data.expand_dims(cell=[0], axis=1)
+        cell_index = pd.Index([0], name='cell')
+    values = np.asarray(stacked.values, dtype='float64')
+    return values, data['time'].values, cell_index
+
+
+
+def find_runs(mask):
+    """
+    Find the runs of consecutive True values along the first axis of a 2D boolean mask, for all columns at once.
+
+    Parameters:
+    mask (np.ndarray): Boolean array of shape (time, cell).
+
+    Returns:
+    tuple: Three 1D integer arrays (cells, starts, ends) with one entry per run, sorted by cell and start.
+           `ends` is exclusive, so the run covers mask[starts:ends, cell].
+    """
+    n_cells = mask.shape[1]
+    padding = np.zeros((1, n_cells), dtype=np.int8)
+    edges = np.diff(np.concatenate([padding, mask.astype(np.int8), padding]), axis=0)
+    # Transposing gives a cell-major ordering, so starts and ends of the same cell pair up
+    start_cells, starts = np.nonzero(edges.T == 1)
+    _, ends = np.nonzero(edges.T == -1)
+    return start_cells, starts, ends
+
+
+
+def detect_drought_events(data, threshold: float = DROUGHT_THRESHOLD, min_duration: int = 1,
+                          memory_budget: float = 256e6) -> pd.DataFrame:
+    """
+    Detects drought events in SPEI time series using run theory, vectorized across all grid cells or regions.
+
+    A drought event is a run of consecutive months with SPEI less than or equal to `threshold`.
+    For every event the onset, termination, duration, severity (cumulative deficit below the threshold),
+    mean intensity (severity / duration) and peak intensity (lowest SPEI value) are reported.
+    Missing values (NaN) interrupt a run. A cube is processed in bands along its first non-time dimension, each band
+    holding every time step, so only one band is in memory at once; the event tables of the bands are concatenated.
+
+    Parameters:
+    data (xr.DataArray or pd.DataFrame): SPEI values, either a cube with a 'time' dimension or a DataFrame
+                                         indexed by time with one column per region (e.g. medians from `compute_stats`).
+    threshold (float): SPEI value at or below which a month is considered in drought. Defaults to -1.0.
+    min_duration (int): Minimum number of months for a run to be reported as an event. Defaults to 1.
+    memory_budget (float): Approximate memory per band of a cube, in bytes. Defaults to 256 MB.
+
+    Returns:
+    pd.DataFrame: The event table indexed by the cell labels (e.g. lat, lon or region) and the onset time, with columns:
+        - termination: Time of the last month in drought.
+        - duration: Number of months in drought.
+        - severity: Sum of (threshold - SPEI) over the event.
+        - intensity: Mean deficit per month (severity / duration).
+        - peak: Lowest SPEI value reached during the event.
+        - peak_time: Time at which the peak was reached.
+    """
+    other_dims = [dim for dim in data.dims if dim != 'time'] if not isinstance(data, pd.DataFrame) else []
+    if len(other_dims) < 2:
+        return detect_block_events(*to_time_cell_array(data), threshold, min_duration)
+
+    band_dim = other_dims[0]
+    cells_per_row = int(np.prod([data.sizes[dim] for dim in other_dims[1:]]))
+    rows = max(1, int(memory_budget / (WORKING_COPIES * 8 * data.sizes['time'] * cells_per_row)))
+    tables = [detect_block_events(*to_time_cell_array(data.isel({band_dim: slice(start, start + rows)})), threshold, min_duration)
+              for start in range(0, data.sizes[band_dim], rows)]
+    return pd.concat(tables)
+
+
+
+def detect_block_events(values, times, cell_index, threshold: float = DROUGHT_THRESHOLD, min_duration: int = 1) -> pd.DataFrame:
+    """
+    Detects the drought events of a block of series held in memory, see `detect_drought_events`.
+
+    Parameters:
+    values (np.ndarray): The values of shape (time, cell), from `to_time_cell_array`.
+    times (np.ndarray): The time values.
+    cell_index (pd.Index or pd.MultiIndex): The labels of each cell.
+    threshold (float): SPEI value at or below which a month is considered in drought.
+    min_duration (int): Minimum number of months for a run to be reported as an event.
+
+    Returns:
+    pd.DataFrame: The event table of the block, as `detect_drought_events`.
+    """
+    n_times, n_cells = values.shape
+
+    cells, starts, ends = find_runs(values <= threshold)
+    durations = ends - starts
+    keep = durations >= min_duration
+    cells, starts, ends, durations = cells[keep], starts[keep], ends[keep], durations[keep]
+
+    # Cumulative deficit along time, so severity is a difference of two lookups per event
+    deficit = np.where(values <= threshold, threshold - values, 0.0)
+    cumulative = np.concatenate([np.zeros((1, n_cells)), np.cumsum(deficit, axis=0)])
+    severity = cumulative[ends, cells] - cumulative[starts, cells]
+
+    # Peak intensity with a segmented reduction over the cell-major flattened series
+    flat = np.append(values.T.ravel(), np.nan)
+    flat_starts = cells * n_times + starts
+    flat_ends = cells * n_times + ends
+    if len(cells):
+        bounds = np.ravel(np.column_stack([flat_starts, flat_ends]))
+        peaks = np.minimum.reduceat(flat, bounds)[::2]
+        # First month of each event where the peak is reached
+        event_ids = np.repeat(np.arange(len(cells)), durations)
+        positions = np.arange(durations.sum()) - np.repeat(np.cumsum(durations) - durations, durations)
+        positions += np.repeat(flat_starts, durations)
+        at_peak = flat[positions] == peaks[event_ids]
+        _, first = np.unique(event_ids[at_peak], return_index=True)
+        peak_offsets = positions[at_peak][first] - flat_starts
+    else:
+        peaks = np.empty(0)
+        peak_offsets = np.empty(0, dtype=int)
+
+    labels = cell_index[cells]
+    if isinstance(labels, pd.MultiIndex):
+        label_arrays = [labels.get_level_values(i) for i in range(labels.nlevels)]
+        names = list(labels.names)
+    else:
+        label_arrays = [labels]
+        names = [labels.name or 'region']
+
+    events = pd.DataFrame({
+        'onset': times[starts],
+        'termination': times[ends - 1],
+        'duration': durations,
+        'severity': severity,
+        'intensity': severity / np.maximum(durations, 1),
+        'peak': peaks,
+        'peak_time': times[starts + peak_offsets],
+    })
+    events.index = pd.MultiIndex.from_arrays(label_arrays + [events.pop('onset')], names=names + ['onset'])
+    return events
+
+
+
+def combine_event_tables(tables: dict) -> pd.DataFrame:
+    """
+    Combines per-cell event tables computed for several areas (e.g. one per country) into a single table.
+
+    Parameters:
+    tables (dict): Dictionary mapping an area name to the event table returned by `detect_drought_events`.
+
+    Returns:
+    pd.DataFrame: The combined table with the area name as the outermost index level.
+    """
+    if not tables:
+        return pd.DataFrame()
+    return pd.concat(tables, names=['area'])
+
+
+
+def write_event_table(events: pd.DataFrame, file_path: str):
+    """
+    Writes an event table to disk. Parquet is used for the '.parquet' extension, CSV otherwise.
+
+    Parameters:
+    events (pd.DataFrame): The event table.
+    file_path (str): The destination path.
+    """
+    if file_path.endswith('.parquet'):
+        events.to_parquet(file_path)
+    else:
+        events.to_csv(file_path)
+
+
+
+def read_event_table(file_path: str) -> pd.DataFrame:
+    """
+    Reads an event table written by `write_event_table`, restoring its index and time columns.
+
+    Parameters:
+    file_path (str): The path of the event table.
+
+    Returns:
+    pd.DataFrame: The event table indexed by region/cell labels and onset time.
+    """
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    events = pd.read_csv(file_path, parse_dates=['onset', 'termination', 'peak_time'])
+    index_columns = list(events.columns[:list(events.columns).index('onset') + 1])
+    return events.set_index(index_columns)
+
+
+
+def query_events(events: pd.DataFrame, regions: list = None, since=None, until=None,
+                 min_duration: int = None, sort_by: str = 'duration', top: int = None) -> pd.DataFrame:
+    """
+    Selects and ranks drought events from an event table.
+
+    Example:
+    >>> query_events(events, regions=african_countries, since='1980', top=10)   # longest droughts in Africa since 1980
+
+    Parameters:
+    events (pd.DataFrame): The event table from `detect_drought_events` or `combine_event_tables`.
+    regions (list, optional): Labels of the outermost index level to keep.
+    since (str or datetime, optional): Keep only events with onset on or after this date.
+    until (str or datetime, optional): Keep only events with onset on or before this date.
+    min_duration (int, optional): Keep only events lasting at least this many months.
+    sort_by (str): Column used to rank the events, in descending order. Defaults to 'duration'.
+    top (int, optional): Number of events to return.
+
+    Returns:
+    pd.DataFrame: The selected events.
+    """
+    selection = events
+    if regions is not None:
+        selection = selection[selection.index.get_level_values(0).isin(regions)]
+    onsets = selection.index.get_level_values('onset')
+    if since is not None:
+        selection = selection[onsets >= pd.Timestamp(since)]
+        onsets = selection.index.get_level_values('onset')
+    if until is not None:
+        selection = selection[onsets <= pd.Timestamp(until)]
+    if min_duration is not None:
+        selection = selection[selection['duration'] >= min_duration]
+    selection = selection.sort_values(sort_by, ascending=sort_by == 'peak')
+    return selection.head(top) if top else selection
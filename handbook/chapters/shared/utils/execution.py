@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+import numpy as np
+import psutil
+import dask
+import xarray as xr
+from utils.chunk_planner import plan_chunks_for_array
+from utils.data_preprocess import compute_spatial_stats
+
+
+DEFAULT_MEMORY_BUDGET = 2e9          # Bytes available to one computation
+WORKING_MEMORY_FACTOR = 4            # Copies of a block alive at once (values, mask, sorted copy for the quantiles)
+SCHEDULERS = ('threads', 'synchronous', 'processes', 'distributed')
+
+
+
+class PeakMemorySampler:
+    """
+    Samples the resident memory of the process (and of its child processes) in a background thread.
+
+    Parameters:
+    interval (float): Seconds between samples. Defaults to 0.05.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.baseline = 0
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def rss(self):
+        """
+        Returns the resident memory of the process and its children, in bytes.
+        """
+        total = self.process.memory_info().rss
+        for child in self.process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def sample(self):
+        while not self.stop_event.is_set():
+            self.peak = max(self.peak, self.rss())
+            self.stop_event.wait(self.interval)
+
+    def start(self):
+        """
+        Starts sampling.
+        """
+        self.baseline = self.peak = self.rss()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops sampling.
+
+        Returns:
+        dict: The baseline and peak resident memory, and their difference, in bytes.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.peak = max(self.peak, self.rss())
+        return {'baseline_rss_bytes': self.baseline, 'peak_rss_bytes': self.peak, 'peak_increase_bytes': self.peak - self.baseline}
+
+
+
+@contextmanager
+def execution_context(memory_budget=DEFAULT_MEMORY_BUDGET, scheduler='threads', num_workers=None, scratch_dir=None,
+                      keep_scratch=False):
+    """
+    Configures dask for a memory-budgeted computation and reports the peak memory when leaving the context.
+
+    With the 'distributed' scheduler a local cluster is started whose workers spill to the scratch directory when
+    they approach their share of the budget. With the other schedulers, the budget is honoured by processing the
+    data in time blocks (see `compute_stats_blocked`) and the scratch directory holds dask's temporary files and the
+    per-block results.
+
+    Parameters:
+    memory_budget (float): Bytes available to the computation. Defaults to 2 GB.
+    scheduler (str): 'threads', 'synchronous', 'processes' or 'distributed'. Defaults to 'threads'.
+    num_workers (int, optional): Number of threads, processes or distributed workers; dask's default if not given.
+    scratch_dir (str, optional): Folder for spilled data; a temporary folder if not given.
+    keep_scratch (bool): If False, a temporary scratch folder is removed on exit. Defaults to False.
+
+    Yields:
+    dict: The execution settings (memory_budget, scheduler, scratch_dir, client), completed on exit with the
+          peak memory report and the elapsed time.
+    """
+    if scheduler not in SCHEDULERS:
+        raise ValueError(f"The scheduler must be one of {', '.join(SCHEDULERS)}.")
+    temporary = scratch_dir is None
+    scratch_dir = tempfile.mkdtemp(prefix='spei_scratch_') if temporary else scratch_dir
+    os.makedirs(scratch_dir, exist_ok=True)
+
+    context = {'memory_budget': memory_budget, 'scheduler': scheduler, 'scratch_dir': scratch_dir, 'client': None}
+    sampler = PeakMemorySampler().start()
+    start_time = time.perf_counter()
+    cluster = None
+    try:
+        settings = {'temporary_directory': scratch_dir}
+        if scheduler == 'distributed':
+            from dask.distributed import Client, LocalCluster
+            n_workers = num_workers or 2
+            cluster = LocalCluster(n_workers=n_workers, threads_per_worker=1, memory_limit=int(memory_budget / n_workers),
+                                   local_directory=scratch_dir, dashboard_address=None)
+            context['client'] = Client(cluster)
+        else:
+            settings['scheduler'] = scheduler
+            if num_workers is not None:
+                settings['num_workers'] = num_workers
+        with dask.config.set(settings):
+            yield context
+    finally:
+        if context['client'] is not None:
+            context['client'].close()
+        # Closed even if the client could not connect to it
+        if cluster is not None:
+            cluster.close()
+        context.update(sampler.stop())
+        context['seconds'] = time.perf_counter() - start_time
+        if temporary and not keep_scratch:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+
+def plan_time_block(data: xr.DataArray, memory_budget=DEFAULT_MEMORY_BUDGET) -> int:
+    """
+    Chooses how many time steps of a cube can be reduced at once within a memory budget.
+
+    Parameters:
+    data (xr.DataArray): The data with a 'time' dimension.
+    memory_budget (float): Bytes available to the computation.
+
+    Returns:
+    int: The number of time steps per block.
+    """
+    bytes_per_step = data.dtype.itemsize * np.prod([size for dim, size in data.sizes.items() if dim != 'time'])
+    return int(max(1, min(data.sizes['time'], memory_budget // (WORKING_MEMORY_FACTOR * bytes_per_step))))
+
+
+
+def compute_stats_blocked(data: xr.DataArray, full_stats: bool = True, memory_budget=DEFAULT_MEMORY_BUDGET,
+                          scratch_dir=None, time_block=None, resume=False) -> dict:
+    """
+    Computes the statistics of `compute_stats` one time block at a time, so only one block is in memory.
+
+    The all-missing rows and columns are found once for the whole selection, as `compute_stats` does, and each
+    block is then reduced by `compute_spatial_stats`: the results are bit-identical to an in-memory run. Block
+    results are written to the scratch folder, so an interrupted run can be resumed.
+
+    Parameters:
+    data (xr.DataArray): The cleaned SPEI data with dimensions ('time', 'lat', 'lon').
+    full_stats (bool): If True, computes all statistics. Defaults to True.
+    memory_budget (float): Bytes available to the computation. Defaults to 2 GB.
+    scratch_dir (str, optional): Folder for the block results; they are kept in memory if not given.
+    time_block (int, optional): Time steps per block; planned from the memory budget if not given.
+    resume (bool): If True, blocks already present in the scratch folder are not recomputed if they were computed
+                   for the same time steps, shape and settings; others are recomputed. Defaults to False.
+
+    Returns:
+    dict: The same dictionary as `compute_stats`.
+    """
+    # Same all-missing rows and columns as compute_stats, found with one streaming reduction
+    present = data.notnull()
+    valid_lat, valid_lon = dask.compute(present.any(['time', 'lon']), present.any(['time', 'lat']))
+    valid_cells = {'lat': np.flatnonzero(valid_lat.values), 'lon': np.flatnonzero(valid_lon.values)}
+
+    time_block = time_block or plan_time_block(data, memory_budget)
+    dims = [dim for dim in data.dims if dim != 'time']
+    blocks = []
+    for index, start in enumerate(range(0, data.sizes['time'], time_block)):
+        block = data.isel(time=slice(start, start + time_block))
+        block_path = os.path.join(scratch_dir, f'stats_block_{index:05d}.npz') if scratch_dir else None
+        fingerprint = block_fingerprint(block, time_block, full_stats, dims)
+        if resume and block_path and saved_block_matches(block_path, fingerprint):
+            blocks.append(block_path)
+            continue
+        # Rechunk, then select the valid latitudes and longitudes one after the other, exactly as compute_stats and
+        # dropna do: the arrays reduced by NumPy then have the same memory layout and their sums the same rounding
+        block = block.chunk(plan_chunks_for_array(block, query='map', memory_budget=memory_budget / WORKING_MEMORY_FACTOR))
+        block = block.isel(lat=valid_cells['lat']).isel(lon=valid_cells['lon'])
+        result = compute_spatial_stats(block, full_stats)
+        if block_path:
+            # None cannot be read back without pickle; an empty array stands for it
+            arrays = {key: np.array([]) if value is None else value for key, value in result.items()}
+            np.savez(block_path + '.tmp.npz', fingerprint=np.array(fingerprint), **arrays)
+            os.replace(block_path + '.tmp.npz', block_path)
+            blocks.append(block_path)
+        else:
+            blocks.append(result)
+
+    results = []
+    for block in blocks:
+        if isinstance(block, str):
+            with np.load(block, allow_pickle=False) as archive:
+                results.append({key: archive[key] for key in archive.files if key != 'fingerprint'})
+        else:
+            results.append(block)
+    stats = {key: np.concatenate([np.asarray([] if result[key] is None else result[key]) for result in results])
+             for key in results[0]}
+    if not stats['times'].size:
+        stats['times'] = None
+    return stats
+
+
+
+def block_fingerprint(block: xr.DataArray, time_block: int, full_stats: bool, dims) -> str:
+    """
+    Describes a time block of `compute_stats_blocked`, so a saved result is only reused for the same block.
+
+    Parameters:
+    block (xr.DataArray): The block, before the all-missing rows and columns are dropped.
+    time_block (int): Time steps per block.
+    full_stats (bool): Whether all statistics are computed.
+    dims (list): The dimensions reduced.
+
+    Returns:
+    str: The first and last time, the shape, a hash of the variable name and coordinates, the block size, the
+         statistics and the dimensions, as JSON.
+    """
+    times = block['time'].values
+    # Two regions of the same shape and period differ only by their coordinates
+    coordinates = hashlib.sha1(str(block.name).encode())
+    for dim in block.dims:
+        if dim != 'time' and dim in block.coords:
+            coordinates.update(dim.encode())
+            coordinates.update(np.ascontiguousarray(block[dim].values).tobytes())
+    return json.dumps({'time_start': str(times[0]), 'time_end': str(times[-1]), 'shape': list(block.shape),
+                       'coordinates': coordinates.hexdigest(), 'time_block': int(time_block),
+                       'full_stats': bool(full_stats), 'dims': list(dims)})
+
+
+
+def saved_block_matches(block_path, fingerprint) -> bool:
+    """
+    Check whether a block result saved by an earlier run was computed for the same block.
+
+    Parameters:
+    block_path (str): The saved result.
+    fingerprint (str): The description of the block, from `block_fingerprint`.
+
+    Returns:
+    bool: True if the result can be reused; a result of another selection or of an older version is not.
+    """
+    if not os.path.exists(block_path):
+        return False
+    try:
+        with np.load(block_path, allow_pickle=False) as archive:
+            return 'fingerprint' in archive.files and str(archive['fingerprint']) == fingerprint
+    except (OSError, ValueError):
+        return False
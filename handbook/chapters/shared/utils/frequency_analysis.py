@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+
+# SPEI values at which return periods are tabulated; lookups round to the nearest grid value
+SPEI_GRID_START = -5.0
+SPEI_GRID_STOP = 5.0
+SPEI_GRID_STEP = 0.01
+
+
+
+def regional_series_from_stats(stats_by_region: dict, statistic: str = 'medians') -> pd.DataFrame:
+    """
+    Builds a table of regional SPEI series from the dictionaries returned by `compute_stats`.
+
+    Parameters:
+    stats_by_region (dict): Dictionary mapping a region name to the result of `compute_stats` for that region.
+    statistic (str): The statistic to use as the regional value. Defaults to 'medians'.
+
+    Returns:
+    pd.DataFrame: A DataFrame indexed by time with one column per region.
+    """
+    return pd.DataFrame({
+        region: pd.Series(values[statistic], index=pd.DatetimeIndex(values['times']))
+        for region, values in stats_by_region.items()
+    }).sort_index()
+
+
+
+def annual_minima(series: pd.DataFrame, min_months: int = 12) -> pd.DataFrame:
+    """
+    Computes the annual minimum SPEI of every region.
+
+    Parameters:
+    series (pd.DataFrame): Monthly SPEI series indexed by time with one column per region.
+    min_months (int): Years with fewer valid months are discarded for that region. Defaults to 12.
+
+    Returns:
+    pd.DataFrame: The annual minima indexed by year with one column per region.
+    """
+    grouped = series.groupby(series.index.year)
+    minima = grouped.min()
+    return minima.where(grouped.count() >= min_months)
+
+
+
+def spei_grid() -> np.ndarray:
+    """
+    Returns the SPEI values at which return periods are tabulated.
+
+    Returns:
+    np.ndarray: Evenly spaced SPEI values from SPEI_GRID_START to SPEI_GRID_STOP.
+    """
+    n_values = int(round((SPEI_GRID_STOP - SPEI_GRID_START) / SPEI_GRID_STEP)) + 1
+    return SPEI_GRID_START + SPEI_GRID_STEP * np.arange(n_values)
+
+
+
+def empirical_non_exceedance(minima: np.ndarray, grid: np.ndarray) -> np.ndarray:
+    """
+    Estimates the probability that the annual minimum is at or below each grid value with Weibull plotting positions.
+
+    Parameters:
+    minima (np.ndarray): The annual minima of one region (NaN values are ignored).
+    grid (np.ndarray): The SPEI values at which the probability is evaluated.
+
+    Returns:
+    np.ndarray: The non-exceedance probabilities; 0 below the lowest recorded minimum.
+    """
+    minima = np.sort(minima[np.isfinite(minima)])
+    if minima.size == 0:
+        return np.full(grid.shape, np.nan)
+    return np.searchsorted(minima, grid, side='right') / (minima.size + 1)
+
+
+
+def gev_non_exceedance(minima: np.ndarray, grid: np.ndarray) -> (np.ndarray, tuple):
+    """
+    Fits a generalised extreme value distribution to the annual minima (as maxima of the negated values) and
+    evaluates the probability that the annual minimum is at or below each grid value.
+
+    Parameters:
+    minima (np.ndarray): The annual minima of one region (NaN values are ignored).
+    grid (np.ndarray): The SPEI values at which the probability is evaluated.
+
+    Returns:
+    tuple: The non-exceedance probabilities and the fitted (shape, loc, scale) parameters.
+    """
+    minima = minima[np.isfinite(minima)]
+    if minima.size < 3:
+        return np.full(grid.shape, np.nan), (np.nan, np.nan, np.nan)
+    parameters = stats.genextreme.fit(-minima)
+    return stats.genextreme.sf(-grid, *parameters), parameters
+
+
+
+def fit_return_period_table(minima: pd.DataFrame, method: str = 'empirical', accumulation_window: str = None) -> dict:
+    """
+    Tabulates, for every region, the return period of an annual minimum at or below each SPEI grid value.
+
+    The table is the cached form of the fitted distributions or empirical CDFs: placing any value on the return-period
+    scale is then a single array lookup (see `lookup_return_periods`).
+
+    Parameters:
+    minima (pd.DataFrame): The annual minima indexed by year with one column per region (see `annual_minima`).
+    method (str): 'empirical' for Weibull plotting positions, or 'gev' for a fitted generalised extreme value
+                  distribution, which also extrapolates beyond the record. Defaults to 'empirical'.
+    accumulation_window (str, optional): The accumulation window the minima were computed for, stored with the table.
+
+    Returns:
+    dict: A dictionary containing:
+        - regions (np.ndarray): The region names, in table order.
+        - grid_start (float), grid_step (float): Definition of the SPEI grid.
+        - return_periods (np.ndarray): Array of shape (region, grid) with return periods in years (inf when the
+          value is below anything the method can estimate).
+        - parameters (np.ndarray): Fitted (shape, loc, scale) per region for 'gev', NaN for 'empirical'.
+        - method (str) and accumulation_window (str).
+    """
+    if method not in ('empirical', 'gev'):
+        raise ValueError("The method must be 'empirical' or 'gev'.")
+    grid = spei_grid()
+    probabilities = np.empty((minima.shape[1], grid.size))
+    parameters = np.full((minima.shape[1], 3), np.nan)
+    for i, region in enumerate(minima.columns):
+        values = minima[region].to_numpy(dtype='float64')
+        if method == 'empirical':
+            probabilities[i] = empirical_non_exceedance(values, grid)
+        else:
+            probabilities[i], parameters[i] = gev_non_exceedance(values, grid)
+
+    with np.errstate(divide='ignore'):
+        return_periods = np.where(probabilities > 0, 1.0 / probabilities, np.inf)
+    return_periods[np.isnan(probabilities)] = np.nan
+    return {
+        'regions': np.asarray(minima.columns, dtype=str),
+        'grid_start': SPEI_GRID_START,
+        'grid_step': SPEI_GRID_STEP,
+        'return_periods': return_periods,
+        'parameters': parameters,
+        'method': method,
+        'accumulation_window': accumulation_window or '',
+    }
+
+
+
+def lookup_return_periods(table: dict, values) -> pd.Series:
+    """
+    Places SPEI values on the return-period scale of their region, for all regions at once.
+
+    Parameters:
+    table (dict): The table returned by `fit_return_period_table` or `load_return_period_table`.
+    values (pd.Series or dict): The current SPEI value of each region, keyed by region name.
+
+    Returns:
+    pd.Series: The return period in years of each value, indexed like `values`; NaN for unknown regions.
+    """
+    values = pd.Series(values, dtype='float64')
+    region_index = pd.Index(table['regions']).get_indexer(values.index.astype(str))
+    n_grid = table['return_periods'].shape[1]
+    grid_index = np.rint((values.to_numpy() - table['grid_start']) / table['grid_step'])
+    grid_index = np.clip(np.nan_to_num(grid_index), 0, n_grid - 1).astype(int)
+    result = table['return_periods'][region_index, grid_index]
+    result[(region_index < 0) | values.isna().to_numpy()] = np.nan
+    return pd.Series(result, index=values.index, name='return_period')
+
+
+
+def save_return_period_table(table: dict, file_path: str):
+    """
+    Saves a return-period table to a compressed NumPy archive.
+
+    Parameters:
+    table (dict): The table returned by `fit_return_period_table`.
+    file_path (str): The destination path (e.g. 'return_periods_spei12.npz').
+    """
+    np.savez_compressed(file_path, **table)
+
+
+
+def load_return_period_table(file_path: str) -> dict:
+    """
+    Loads a return-period table saved by `save_return_period_table`.
+
+    Parameters:
+    file_path (str): The path of the table.
+
+    Returns:
+    dict: The table, ready for `lookup_return_periods`.
+    """
+    with np.load(file_path, allow_pickle=False) as archive:
+        table = {key: archive[key] for key in archive.files}
+    for key in ('grid_start', 'grid_step'):
+        table[key] = float(table[key])
+    for key in ('method', 'accumulation_window'):
+        table[key] = str(table[key])
+    return table
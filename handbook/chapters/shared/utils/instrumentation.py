@@ -0,0 +1,214 @@
+"""
+Lightweight instrumentation of the data pipeline.
+
+Disabled by default: instrumented functions then only check a flag. Typical use in a notebook:
+
+    from utils.instrumentation import enable_instrumentation, instrumentation_report, disable_instrumentation
+
+    enable_instrumentation(log_path='pipeline_log.jsonl')
+    ...  # run the selection as usual
+    report = instrumentation_report()    # per-stage timings, bytes read, counters and cache hit rates
+    disable_instrumentation()
+"""
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+import psutil
+
+
+ENABLED = False
+STATE = {'stages': {}, 'counters': {}, 'caches': {}, 'log_path': None, 'started': None}
+LOCK = threading.Lock()
+NULL_STAGE = nullcontext()
+
+
+
+def enable_instrumentation(log_path=None, reset=True):
+    """
+    Starts recording stage timings and counters.
+
+    Parameters:
+    log_path (str, optional): A JSON-lines file to which every finished stage is appended.
+    reset (bool): If True, previous records are cleared. Defaults to True.
+    """
+    global ENABLED
+    with LOCK:
+        if reset:
+            STATE.update({'stages': {}, 'counters': {}, 'caches': {}, 'started': time.time()})
+        STATE['log_path'] = log_path
+    ENABLED = True
+
+
+
+def disable_instrumentation():
+    """
+    Stops recording; the records are kept until the next `enable_instrumentation`.
+    """
+    global ENABLED
+    ENABLED = False
+
+
+
+def read_bytes():
+    """
+    Returns the number of bytes read by the process so far, including reads served from the page cache where
+    the platform reports them.
+
+    Returns:
+    int: The bytes read, or 0 if the platform does not provide I/O counters.
+    """
+    try:
+        counters = psutil.Process().io_counters()
+    except (AttributeError, psutil.Error):
+        return 0
+    return getattr(counters, 'read_chars', counters.read_bytes)
+
+
+
+@contextmanager
+def _recording_stage(name):
+    start_time = time.perf_counter()
+    start_bytes = read_bytes()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        bytes_read = read_bytes() - start_bytes
+        with LOCK:
+            record = STATE['stages'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes_read': 0})
+            record['calls'] += 1
+            record['seconds'] += seconds
+            record['max_seconds'] = max(record['max_seconds'], seconds)
+            record['bytes_read'] += bytes_read
+            log_path = STATE['log_path']
+        if log_path:
+            with open(log_path, 'a') as file:
+                file.write(json.dumps({'time': time.time(), 'stage': name, 'seconds': seconds, 'bytes_read': bytes_read}) + '\n')
+
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the pipeline; a shared no-op when instrumentation is disabled.
+
+    Nested stages are recorded separately, so the time of an inner stage is also part of the outer one.
+
+    Parameters:
+    name (str): The name of the stage.
+    """
+    return _recording_stage(name) if ENABLED else NULL_STAGE
+
+
+
+def instrumented(name):
+    """
+    Decorator recording every call of a function as a stage.
+
+    Parameters:
+    name (str): The name of the stage.
+
+    Returns:
+    function: The decorator.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _recording_stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+
+def count(name, value=1):
+    """
+    Adds to a counter (e.g. files opened, HTTP requests).
+
+    Parameters:
+    name (str): The name of the counter.
+    value (int): The amount to add. Defaults to 1.
+    """
+    if not ENABLED:
+        return
+    with LOCK:
+        STATE['counters'][name] = STATE['counters'].get(name, 0) + value
+
+
+
+def count_dask_tasks(*collections):
+    """
+    Adds the number of tasks of dask collections about to be computed to the 'dask_tasks' counter.
+
+    Parameters:
+    collections: The dask-backed arrays or DataArrays.
+    """
+    if not ENABLED:
+        return
+    tasks = 0
+    for collection in collections:
+        graph = getattr(collection, '__dask_graph__', lambda: None)()
+        tasks += len(graph) if graph is not None else 0
+    count('dask_tasks', tasks)
+
+
+
+def record_cache(name, hit):
+    """
+    Records a lookup in a cache.
+
+    Parameters:
+    name (str): The name of the cache.
+    hit (bool): True if the value was found in the cache.
+    """
+    if not ENABLED:
+        return
+    with LOCK:
+        record = STATE['caches'].setdefault(name, {'hits': 0, 'misses': 0})
+        record['hits' if hit else 'misses'] += 1
+
+
+
+def instrumentation_report():
+    """
+    Returns the records as a structured report.
+
+    Returns:
+    dict: A dictionary containing:
+        - enabled (bool): Whether instrumentation is running.
+        - elapsed_seconds (float): Time since `enable_instrumentation`.
+        - stages (dict): Per stage, the number of calls, total and longest wall time and bytes read, sorted by
+          total time.
+        - counters (dict): The counters (files_probed, files_opened, dask_tasks, http_requests, ...).
+        - caches (dict): Per cache, the hits, misses and hit rate.
+    """
+    with LOCK:
+        stages = {name: dict(record) for name, record in STATE['stages'].items()}
+        counters = dict(STATE['counters'])
+        caches = {name: dict(record) for name, record in STATE['caches'].items()}
+        started = STATE['started']
+    for record in caches.values():
+        lookups = record['hits'] + record['misses']
+        record['hit_rate'] = record['hits'] / lookups if lookups else None
+    return {
+        'enabled': ENABLED,
+        'elapsed_seconds': time.time() - started if started else 0.0,
+        'stages': dict(sorted(stages.items(), key=lambda item: item[1]['seconds'], reverse=True)),
+        'counters': counters,
+        'caches': caches,
+    }
+
+
+
+def write_instrumentation_report(file_path):
+    """
+    Writes the report of `instrumentation_report` to a JSON file.
+
+    Parameters:
+    file_path (str): The destination path.
+    """
+    with open(file_path, 'w') as file:
+        json.dump(instrumentation_report(), file, indent=2)
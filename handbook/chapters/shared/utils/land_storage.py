@@ -0,0 +1,331 @@
+import os
+import time
+import numpy as np
+import xarray as xr
+from utils.data_preprocess import DATA_ROOT, parse_file_month, list_spei_files, filter_valid_nc_files, process_datarray
+from utils.coordinates_retrieve import generate_coordinate_values, split_bounding_box
+from utils.point_extraction import grid_indices
+from utils.pyramid import stored_years, check_append_order, select_years
+from utils.quantization import quantized_encoding, clip_to_limit, store_is_quantized, open_store
+
+
+LAND_ROOT = '/data1/drought_dataset/spei_land/'
+INVALID_VALUE = -9999.0
+CELL_CHUNK = 65536              # Land cells per chunk of the land-only stores (a 12 x 65536 float32 chunk is 3 MB)
+
+
+
+def get_land_index_path(land_root=LAND_ROOT):
+    """
+    Get the file holding the land index.
+
+    Parameters:
+    land_root (str): The root folder of the land-only storage.
+
+    Returns:
+    str: The path of the index.
+    """
+    return os.path.join(land_root, 'land_index.nc')
+
+
+
+def get_land_store_path(accumulation_window, land_root=LAND_ROOT):
+    """
+    Get the land-only Zarr store of an accumulation window.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    land_root (str): The root folder of the land-only storage.
+
+    Returns:
+    str: The path of the store.
+    """
+    return os.path.join(land_root, f'spei{accumulation_window}_land.zarr')
+
+
+
+def build_land_index(files, variable=None, land_root=LAND_ROOT) -> xr.Dataset:
+    """
+    Finds the cells that hold a valid value in at least one of the given files, and saves their grid positions.
+
+    A few files spread over the record are enough: the sea mask of the ERA5-Drought files does not change over time,
+    and `build_land_store` warns if a later month has valid values outside the index.
+
+    Parameters:
+    files (list): Monthly files to scan, e.g. every 60th file of an accumulation window.
+    variable (str, optional): The SPEI variable; the first variable starting with 'SPEI' if not given.
+    land_root (str): The root folder of the land-only storage.
+
+    Returns:
+    xr.Dataset: The index, with the grid coordinates 'lat' and 'lon' and, along 'cell' in row-major grid order,
+                the positions 'lat_index' and 'lon_index' of the land cells.
+    """
+    if not files:
+        raise ValueError("No files given to build the land index.")
+    valid = None
+    for file in files:
+        with xr.open_dataset(file) as ds:
+            name = variable or next(name for name in ds.data_vars if name.startswith('SPEI'))
+            values = ds[name].values
+            grid = (ds['lat'].values, ds['lon'].values)
+        file_valid = (np.isfinite(values) & (values != INVALID_VALUE)).any(axis=0)
+        valid = file_valid if valid is None else valid | file_valid
+
+    lat_index, lon_index = np.nonzero(valid)
+    index = xr.Dataset(
+        {'lat_index': ('cell', lat_index.astype('int32')), 'lon_index': ('cell', lon_index.astype('int32'))},
+        coords={'lat': grid[0], 'lon': grid[1]},
+        attrs={'land_fraction': float(valid.mean()), 'source_files': len(files)},
+    )
+    os.makedirs(land_root, exist_ok=True)
+    index.to_netcdf(get_land_index_path(land_root))
+    print(f"Land index: {lat_index.size} of {valid.size} cells ({100 * valid.mean():.1f}%) from {len(files)} files")
+    return index
+
+
+
+def load_land_index(land_root=LAND_ROOT) -> xr.Dataset:
+    """
+    Loads the land index saved by `build_land_index`.
+
+    Parameters:
+    land_root (str): The root folder of the land-only storage.
+
+    Returns:
+    xr.Dataset: The index.
+    """
+    with xr.open_dataset(get_land_index_path(land_root)) as index:
+        return index.load()
+
+
+
+def compress_to_land(data: xr.DataArray, land_index: xr.Dataset) -> xr.DataArray:
+    """
+    Keeps only the land cells of gridded data, as a 'cell' dimension replacing 'lat' and 'lon'.
+
+    The data may cover the whole grid or a region of it; only the land cells inside it are kept. Dask-backed data
+    stay lazy.
+
+    Parameters:
+    data (xr.DataArray): The values with 'lat' and 'lon' dimensions.
+    land_index (xr.Dataset): The index from `build_land_index` or `load_land_index`.
+
+    Returns:
+    xr.DataArray: The values with a 'cell' dimension and 'lat' and 'lon' coordinates along it.
+    """
+    cell_lat = land_index['lat'].values[land_index['lat_index'].values]
+    cell_lon = land_index['lon'].values[land_index['lon_index'].values]
+    lat_pos = grid_indices(cell_lat, data['lat'].values)
+    lon_pos = grid_indices(cell_lon, data['lon'].values)
+    inside = (lat_pos >= 0) & (lon_pos >= 0)
+    return data.isel(lat=xr.DataArray(lat_pos[inside], dims='cell'), lon=xr.DataArray(lon_pos[inside], dims='cell'))
+
+
+
+def expand_to_grid(compact: xr.DataArray, lat=None, lon=None) -> xr.DataArray:
+    """
+    Puts land-only values back on a regular grid for mapping, with NaN over the sea. The values are loaded.
+
+    Parameters:
+    compact (xr.DataArray): The values with a 'cell' dimension and 'lat' and 'lon' coordinates along it.
+    lat (np.ndarray, optional): The latitudes of the target grid; by default, the 0.25 degree rows spanning the cells,
+                                in ascending order as selected by `preprocess`.
+    lon (np.ndarray, optional): The longitudes of the target grid; by default, the columns spanning the cells.
+
+    Returns:
+    xr.DataArray: The values with 'lat' and 'lon' dimensions in place of 'cell'.
+    """
+    cell_lat = compact['lat'].values
+    cell_lon = compact['lon'].values
+    if lat is None:
+        lat = np.array(generate_coordinate_values(cell_lat.min(), cell_lat.max()))
+    if lon is None:
+        lon = np.array(generate_coordinate_values(cell_lon.min(), cell_lon.max()))
+    lat_pos = grid_indices(cell_lat, lat)
+    lon_pos = grid_indices(cell_lon, lon)
+    inside = (lat_pos >= 0) & (lon_pos >= 0)
+
+    other_dims = [dim for dim in compact.dims if dim != 'cell']
+    values = compact.transpose(*other_dims, 'cell').values
+    grid = np.full(values.shape[:-1] + (len(lat), len(lon)), np.nan, dtype=values.dtype)
+    grid[..., lat_pos[inside], lon_pos[inside]] = values[..., inside]
+    coords = {dim: compact[dim] for dim in other_dims if dim in compact.coords}
+    return xr.DataArray(grid, coords={**coords, 'lat': lat, 'lon': lon}, dims=other_dims + ['lat', 'lon'],
+                        name=compact.name, attrs=compact.attrs)
+
+
+
+def build_land_store(accumulation_window, start_year, end_year, land_index=None, data_root=DATA_ROOT, land_root=LAND_ROOT,
+                     quantize=False):
+    """
+    Builds (or extends) the land-only store of an accumulation window from the monthly files, one year at a time.
+
+    Values are cleaned as `process_datarray` does before being compressed, so loads from the store need no cleaning.
+    Years already in the store are skipped, so an interrupted build can be resumed and later years added; years
+    before the last stored one are refused (ValueError), since appending them would put the time axis out of order.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    start_year (int): First year to include.
+    end_year (int): Last year to include.
+    land_index (xr.Dataset, optional): The land index; loaded from `land_root` if not given.
+    data_root (str): The root folder of the SPEI archive.
+    land_root (str): The root folder of the land-only storage.
+    quantize (bool): If True, a new store holds int16 codes (utils.quantization) instead of float32. An existing
+                     store keeps its encoding.
+
+    Returns:
+    int: The number of months written.
+    """
+    land_index = land_index if land_index is not None else load_land_index(land_root)
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_land_store_path(accumulation_window, land_root)
+    done = stored_years(store_path)
+    if os.path.exists(store_path):
+        quantize = store_is_quantized(store_path, variable)
+    written = 0
+    for year in range(int(start_year), int(end_year) + 1):
+        if year in done:
+            continue
+        files = filter_valid_nc_files(list_spei_files(accumulation_window, year, year, data_root))
+        if not files:
+            print(f"No readable NetCDF files found for {year}.")
+            continue
+        check_append_order(year, done, store_path)
+
+        start_time = time.time()
+        with xr.open_mfdataset(files, concat_dim='time', combine='nested') as ds:
+            native, _ = process_datarray(ds[variable])
+            native = native.sortby('time').load()
+        compact = compress_to_land(native, land_index).astype('float32')
+        lost = int(native.notnull().sum()) - int(compact.notnull().sum())
+        if lost:
+            print(f"Warning: {lost} valid values of {year} fall outside the land index; rebuild it to keep them.")
+
+        ds = (clip_to_limit(compact) if quantize else compact).to_dataset(name=variable)
+        if os.path.exists(store_path):
+            ds.drop_vars(['lat', 'lon']).to_zarr(store_path, append_dim='time')
+        else:
+            os.makedirs(land_root, exist_ok=True)
+            chunks = (12, min(CELL_CHUNK, ds.sizes['cell']))
+            encoding = {variable: quantized_encoding(chunks) if quantize else {'dtype': 'float32', 'chunks': chunks}}
+            ds.attrs['layout'] = 'land cells in row-major grid order'
+            ds.to_zarr(store_path, mode='w', encoding=encoding)
+        written += compact.sizes['time']
+        done.add(year)
+        print(f"{variable} {year}: {len(files)} files compressed to {compact.sizes['cell']} land cells in {time.time() - start_time:.1f} s")
+    return written
+
+
+
+def rewrite_land_store_months(accumulation_window, files, land_index=None, land_root=LAND_ROOT) -> int:
+    """
+    Rewrites in place the months of the land-only store whose monthly files were replaced. `build_land_store` skips
+    the years already stored, so corrected files would otherwise never reach the store. Months not in the store are
+    left to `append_land_store_months`.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    files (list): The replaced monthly files.
+    land_index (xr.Dataset, optional): The land index; loaded from `land_root` if not given.
+    land_root (str): The root folder of the land-only storage.
+
+    Returns:
+    int: The number of months rewritten.
+    """
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_land_store_path(accumulation_window, land_root)
+    with xr.open_zarr(store_path) as store:
+        stored = {(stamp.year, stamp.month): i for i, stamp in enumerate(store.indexes['time'])}
+    files = [file for file in files if parse_file_month(file) in stored]
+    if not files:
+        return 0
+    land_index = land_index if land_index is not None else load_land_index(land_root)
+    quantized = store_is_quantized(store_path, variable)
+    for file in files:
+        position = stored[parse_file_month(file)]
+        with xr.open_dataset(file) as ds:
+            native, _ = process_datarray(ds[variable].load())
+        compact = compress_to_land(native, land_index).astype('float32')
+        compact = clip_to_limit(compact) if quantized else compact
+        compact.drop_vars(['time', 'lat', 'lon']).to_dataset(name=variable).to_zarr(
+            store_path, region={'time': slice(position, position + 1)})
+    return len(files)
+
+
+
+def append_land_store_months(accumulation_window, land_index=None, data_root=DATA_ROOT, land_root=LAND_ROOT) -> int:
+    """
+    Appends to the land-only store the months of the archive later than its last month, as `update_time_store` does
+    for the time-contiguous store. Unlike `build_land_store`, which skips the years already stored, this also
+    completes a year stored in part.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    land_index (xr.Dataset, optional): The land index; loaded from `land_root` if not given.
+    data_root (str): The root folder of the SPEI archive.
+    land_root (str): The root folder of the land-only storage.
+
+    Returns:
+    int: The number of months appended.
+    """
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_land_store_path(accumulation_window, land_root)
+    with xr.open_zarr(store_path) as store:
+        last = store.indexes['time'].max()
+        attrs = dict(store.attrs)
+    files = filter_valid_nc_files(list_spei_files(accumulation_window, last.year, None, data_root))
+    files = [file for file in files if parse_file_month(file) > (last.year, last.month)]
+    if not files:
+        return 0
+    land_index = land_index if land_index is not None else load_land_index(land_root)
+    quantized = store_is_quantized(store_path, variable)
+    written = 0
+    # One year at a time, as build_land_store, so a store far behind the archive is not read at once
+    for year in sorted({parse_file_month(file)[0] for file in files}):
+        year_files = [file for file in files if parse_file_month(file)[0] == year]
+        with xr.open_mfdataset(year_files, concat_dim='time', combine='nested') as ds:
+            native, _ = process_datarray(ds[variable])
+            native = native.sortby('time').load()
+        compact = compress_to_land(native, land_index).astype('float32')
+        lost = int(native.notnull().sum()) - int(compact.notnull().sum())
+        if lost:
+            print(f"Warning: {lost} valid values of {year} fall outside the land index; rebuild it to keep them.")
+        ds = (clip_to_limit(compact) if quantized else compact).to_dataset(name=variable).assign_attrs(attrs)
+        ds.drop_vars(['lat', 'lon']).to_zarr(store_path, append_dim='time')
+        written += compact.sizes['time']
+    return written
+
+
+
+def load_land_region(bounds, accumulation_window, start_year=None, end_year=None, land_root=LAND_ROOT,
+                     keep_quantized=False) -> xr.DataArray:
+    """
+    Loads the land cells of a region from the land-only store.
+
+    The cells are selected with the grid points of `preprocess` (`generate_coordinate_values`), so the cells are the
+    valid cells of the usual selection.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    accumulation_window (str): The accumulation window in months.
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    land_root (str): The root folder of the land-only storage.
+    keep_quantized (bool): If True, the int16 codes of a quantized store are returned undecoded; `compute_stats`
+                           reduces them directly.
+
+    Returns:
+    xr.DataArray: The lazily loaded, cleaned values with dimensions ('time', 'cell'), ready for `compute_stats`.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    ds = open_store(get_land_store_path(accumulation_window, land_root), f'SPEI{accumulation_window}', keep_quantized)
+    in_lat = np.isin(ds['lat'].values, generate_coordinate_values(min_lat, max_lat))
+    lon_values = [generate_coordinate_values(west, east) for west, _, east, _ in split_bounding_box(bounds, ds['lon'].values)]
+    in_lon = np.isin(ds['lon'].values, np.concatenate(lon_values))
+    cells = np.flatnonzero(in_lat & in_lon)
+    if not cells.size:
+        raise ValueError("No land cell found in the selected area.")
+    # Cells are in row-major order, so a region is a few contiguous runs of cells; a slice reads fewer chunks
+    selector = slice(cells[0], cells[-1] + 1) if cells.size == cells[-1] - cells[0] + 1 else cells
+    return select_years(ds[f'SPEI{accumulation_window}'].isel(cell=selector), start_year, end_year)
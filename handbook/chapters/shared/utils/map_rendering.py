@@ -0,0 +1,337 @@
+"""
+Rendering backend for multi-panel cartopy figures: basemap layers projected once per extent, and figures or single
+panels rendered in worker processes and saved to files.
+
+A figure is described by a plain dictionary, built beforehand with its data already computed, so rendering reads
+nothing and only draws:
+
+    {'name': 'swvl1_2020_annual', 'nrows': 4, 'ncols': 3, 'figsize': (15, 15), 'projection': ccrs.PlateCarree(),
+     'suptitle': None, 'rect': None, 'panels': [{'draw': draw_function, 'basemap': key, ...}, ...]}
+
+`draw_function(ax, panel)` is a module-level function drawing one panel; `key` is returned by `prepare_basemap`.
+The coastlines and borders are then added from the cached paths instead of `ax.coastlines()` and
+`ax.add_feature(cfeature.BORDERS)`, which read, clip and project the Natural Earth geometries again on every panel.
+"""
+import os
+import hashlib
+import pickle
+import numpy as np
+import matplotlib.pyplot as plt
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+import shapely.geometry as sgeom
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib.collections import PathCollection
+from matplotlib.path import Path
+from cartopy.mpl.patch import geos_to_path
+from utils.coordinates_retrieve import split_bounding_box, longitude_span
+
+
+BASEMAP_ROOT = '/data1/drought_dataset/basemaps/'    # Shared folder of projected basemaps, opt-in through cache_root
+# Natural Earth (category, name) of each basemap layer, as drawn by ax.coastlines() and cfeature.BORDERS
+BASEMAP_FEATURES = {
+    'coastline': ('physical', 'coastline'),
+    'borders': ('cultural', 'admin_0_boundary_lines_land'),
+}
+DEFAULT_LAYERS = ('coastline', 'borders')
+BASEMAP_MARGIN = 1.0            # Degrees kept around the extent when clipping, so lines reach the frame
+
+_BASEMAP_CACHE = {}             # key -> {layer: compound matplotlib path}, filled by prepare_basemap or the pool initializer
+
+
+
+def data_bounds(data) -> tuple:
+    """
+    Get the bounds of gridded data, whatever the names of its coordinates ('lon'/'lat' or 'longitude'/'latitude').
+
+    Parameters:
+    data (xr.DataArray or xr.Dataset): The gridded data.
+
+    Returns:
+    tuple: Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    """
+    lon = data['lon'] if 'lon' in data.coords else data['longitude']
+    lat = data['lat'] if 'lat' in data.coords else data['latitude']
+    return float(lon.min()), float(lat.min()), float(lon.max()), float(lat.max())
+
+
+
+def basemap_scale(bounds) -> str:
+    """
+    Get the Natural Earth scale cartopy would pick for an extent with resolution='auto'.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+
+    Returns:
+    str: '110m', '50m' or '10m'.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    # A new scaler each time, as scale_from_extent keeps the last scale in the shared cfeature.auto_scaler
+    scaler = cfeature.AdaptiveScaler('110m', (('50m', 50), ('10m', 15)))
+    return scaler.scale_from_extent((min_lon, min_lon + longitude_span(min_lon, max_lon), min_lat, max_lat))
+
+
+
+def basemap_key(bounds, projection=None, layers=DEFAULT_LAYERS, scale=None) -> tuple:
+    """
+    Get the key of the basemap of an extent: the rounded bounds, the projection, the layers and the scale.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    projection (cartopy.crs.Projection, optional): The projection of the axes. Defaults to PlateCarree.
+    layers (tuple): The layers of BASEMAP_FEATURES to draw.
+    scale (str, optional): The Natural Earth scale; chosen from the extent as cartopy does if not given.
+
+    Returns:
+    tuple: The key.
+    """
+    projection = projection or ccrs.PlateCarree()
+    bounds = tuple(round(float(value), 3) for value in bounds)
+    return bounds, projection.proj4_init, tuple(layers), scale or basemap_scale(bounds)
+
+
+
+def project_layer(layer, bounds, projection, scale) -> Path:
+    """
+    Reads the Natural Earth geometries of a layer around an extent, clips them and projects them to the axes.
+
+    Parameters:
+    layer (str): The layer of BASEMAP_FEATURES.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat); min_lon > max_lon across
+                    the antimeridian.
+    projection (cartopy.crs.Projection): The projection of the axes.
+    scale (str): The Natural Earth scale.
+
+    Returns:
+    matplotlib.path.Path: The lines of the layer as one compound path in projection coordinates, drawn in a single
+                          call as cartopy does; None if no line is near the extent.
+    """
+    category, name = BASEMAP_FEATURES[layer]
+    feature = cfeature.NaturalEarthFeature(category, name, scale)
+    paths = []
+    # A box crossing the antimeridian is clipped on each side; the projection joins them
+    for min_lon, min_lat, max_lon, max_lat in split_bounding_box(bounds):
+        area = sgeom.box(min_lon - BASEMAP_MARGIN, max(min_lat - BASEMAP_MARGIN, -90),
+                         max_lon + BASEMAP_MARGIN, min(max_lat + BASEMAP_MARGIN, 90))
+        for geometry in feature.intersecting_geometries(area.bounds[0::2] + area.bounds[1::2]):
+            clipped = geometry.intersection(area)
+            if clipped.is_empty:
+                continue
+            projected = projection.project_geometry(clipped, ccrs.PlateCarree())
+            paths.extend(path for path in geos_to_path(projected) if len(path.vertices))
+    return Path.make_compound_path(*paths) if paths else None
+
+
+
+def prepare_basemap(bounds, projection=None, layers=DEFAULT_LAYERS, scale=None, cache_root=None) -> tuple:
+    """
+    Projects the basemap layers of an extent once, and keeps them in memory and, if given, in `cache_root` for later
+    sessions.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    projection (cartopy.crs.Projection, optional): The projection of the axes. Defaults to PlateCarree.
+    layers (tuple): The layers of BASEMAP_FEATURES to draw. Defaults to coastlines and borders.
+    scale (str, optional): The Natural Earth scale; chosen from the extent as cartopy does if not given.
+    cache_root (str, optional): The folder of the projected layers, e.g. BASEMAP_ROOT; kept in memory only if None
+                                (the default).
+
+    Returns:
+    tuple: The key of the basemap, to put in the 'basemap' entry of the panels.
+    """
+    projection = projection or ccrs.PlateCarree()
+    key = basemap_key(bounds, projection, layers, scale)
+    if key in _BASEMAP_CACHE:
+        return key
+
+    path = None
+    if cache_root:
+        path = os.path.join(cache_root, hashlib.md5(repr(key).encode()).hexdigest() + '.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as file:
+                _BASEMAP_CACHE[key] = pickle.load(file)
+            return key
+
+    _BASEMAP_CACHE[key] = {layer: project_layer(layer, key[0], projection, key[3]) for layer in layers}
+    if path:
+        os.makedirs(cache_root, exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump(_BASEMAP_CACHE[key], file)
+        os.replace(path + '.tmp', path)
+    return key
+
+
+
+def add_basemap(ax, key, linewidth=1.0, color='black'):
+    """
+    Draws the cached basemap layers on an axes, without reprojecting them.
+
+    Parameters:
+    ax (cartopy.mpl.geoaxes.GeoAxes): The axes, in the projection of the basemap.
+    key (tuple): The key returned by `prepare_basemap`.
+    linewidth (float): The width of the lines.
+    color (str): The color of the lines.
+    """
+    if key not in _BASEMAP_CACHE:
+        raise ValueError("Unknown basemap; call prepare_basemap for this extent first.")
+    for path in _BASEMAP_CACHE[key].values():
+        if path is not None:
+            ax.add_collection(PathCollection([path], facecolor='none', edgecolor=color, linewidth=linewidth,
+                                             transform=ax.transData), autolim=False)
+
+
+
+def get_basemaps(keys) -> dict:
+    """
+    Get the projected layers of basemaps prepared in this process, to hand them to worker processes.
+
+    Parameters:
+    keys (iterable): The keys returned by `prepare_basemap`.
+
+    Returns:
+    dict: key -> projected layers, for `init_worker`.
+    """
+    return {key: _BASEMAP_CACHE[key] for key in keys}
+
+
+
+def init_worker(basemaps):
+    """
+    Initializes a rendering process: non-interactive backend and the basemaps prepared by the parent.
+
+    Parameters:
+    basemaps (dict): key -> projected layers, as in the parent's cache.
+    """
+    plt.switch_backend('Agg')
+    _BASEMAP_CACHE.update(basemaps)
+
+
+
+def render_figure(spec, path=None, dpi=100):
+    """
+    Draws a figure spec, and saves it if a path is given.
+
+    Parameters:
+    spec (dict): The figure, see the module documentation.
+    path (str, optional): The image file to write.
+    dpi (int): The resolution of the saved image.
+
+    Returns:
+    matplotlib.figure.Figure or str: The open figure if no path is given, otherwise the path once the figure is
+                                     saved and closed.
+    """
+    subplot_kw = {'projection': spec['projection']} if spec.get('projection') is not None else {}
+    fig, axes = plt.subplots(nrows=spec['nrows'], ncols=spec['ncols'], figsize=spec['figsize'], subplot_kw=subplot_kw)
+    if spec.get('suptitle'):
+        fig.suptitle(spec['suptitle'], fontsize=16)
+    for ax, panel in zip(np.ravel(axes), spec['panels']):
+        panel['draw'](ax, panel)
+        if panel.get('basemap') is not None:
+            add_basemap(ax, panel['basemap'])
+    fig.tight_layout(rect=spec.get('rect'))
+    if path is None:
+        return fig
+    fig.savefig(path, dpi=dpi)
+    plt.close(fig)
+    return path
+
+
+
+def split_panels(spec) -> list:
+    """
+    Splits a figure spec into one single-panel spec per panel, each with the size of one cell of the grid.
+
+    Parameters:
+    spec (dict): The figure.
+
+    Returns:
+    list: The panel specs, named '<name>_<panel number>'.
+    """
+    width, height = spec['figsize']
+    return [{**spec, 'name': f"{spec['name']}_{i + 1:02d}", 'nrows': 1, 'ncols': 1, 'suptitle': None, 'rect': None,
+             'figsize': (width / spec['ncols'], height / spec['nrows']), 'panels': [panel]}
+            for i, panel in enumerate(spec['panels'])]
+
+
+
+def tile_images(paths, ncols, path) -> str:
+    """
+    Assembles panel images into a grid image, in row-major order.
+
+    Parameters:
+    paths (list): The PNG files of the panels.
+    ncols (int): The number of columns of the grid.
+    path (str): The PNG file to write.
+
+    Returns:
+    str: The path of the grid image.
+    """
+    images = [plt.imread(panel_path) for panel_path in paths]
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+    nrows = -(-len(images) // ncols)
+    grid = np.ones((nrows * height, ncols * width, 4), dtype='float32')
+    for i, image in enumerate(images):
+        if image.shape[2] == 3:
+            image = np.concatenate([image, np.ones(image.shape[:2] + (1,), dtype=image.dtype)], axis=2)
+        row, col = divmod(i, ncols)
+        grid[row * height:row * height + image.shape[0], col * width:col * width + image.shape[1]] = image
+    plt.imsave(path, grid)
+    return path
+
+
+
+def render_figures(specs, output_dir, workers=1, per_panel=False, image_format='png', dpi=100) -> list:
+    """
+    Renders figure specs to image files, in worker processes if `workers` > 1.
+
+    The basemaps the panels refer to are prepared in this process and handed once to each worker, which then only
+    draws. With `per_panel`, every panel is a task of its own, so the panels of one figure render in parallel; they
+    are saved as '<name>_<panel number>' and assembled into '<name>' (PNG only).
+
+    Parameters:
+    specs (list): The figures, see the module documentation.
+    output_dir (str): The folder of the images.
+    workers (int): The number of rendering processes; 1 renders in this process. Defaults to 1.
+    per_panel (bool): If True, renders each panel separately. Defaults to False.
+    image_format (str): The image format, 'png', 'svg' or 'pdf'. Defaults to 'png'.
+    dpi (int): The resolution of the images. Defaults to 100.
+
+    Returns:
+    list: The path of the image of each figure, in the order of `specs`.
+    """
+    if per_panel and image_format != 'png':
+        raise ValueError("Panels can only be assembled into PNG images.")
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [panel_spec for spec in specs for panel_spec in split_panels(spec)] if per_panel else list(specs)
+    paths = [os.path.join(output_dir, f"{task['name']}.{image_format}") for task in tasks]
+
+    if workers <= 1:
+        written = [render_figure(task, path, dpi) for task, path in zip(tasks, paths)]
+    else:
+        basemaps = get_basemaps({panel['basemap'] for task in tasks for panel in task['panels'] if panel.get('basemap') is not None})
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(basemaps,)) as executor:
+            written = list(executor.map(render_figure, tasks, paths, [dpi] * len(tasks)))
+
+    if not per_panel:
+        return written
+    figure_paths, start = [], 0
+    for spec in specs:
+        panel_paths = written[start:start + len(spec['panels'])]
+        start += len(spec['panels'])
+        figure_paths.append(tile_images(panel_paths, spec['ncols'], os.path.join(output_dir, f"{spec['name']}.png")))
+    return figure_paths
+
+
+
+def show_images(paths):
+    """
+    Displays saved PNG or SVG images inline in a notebook.
+
+    Parameters:
+    paths (list): The image files.
+    """
+    from IPython.display import display, Image, SVG
+    for path in paths:
+        display(SVG(filename=path) if path.endswith('.svg') else Image(filename=path))
@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+import dask
+from utils.coordinates_retrieve import nearest_grid_point
+from utils.data_preprocess import DATA_ROOT, list_spei_files, filter_valid_nc_files, process_datarray
+from utils.chunk_planner import plan_chunks_for_files
+from utils.time_store import TIME_STORE_ROOT, get_time_store_path, store_covers_period
+from utils.instrumentation import instrumented
+from utils.quantization import open_store
+
+
+GRID_RESOLUTION = 0.25
+
+
+
+def normalise_points(points) -> pd.DataFrame:
+    """
+    Turns the requested locations into a table with 'lat' and 'lon' columns.
+
+    Parameters:
+    points (pd.DataFrame, dict or list): A table with 'lat' and 'lon' columns (its index names the points and must be
+                                         unique), a dictionary of name -> (lat, lon), or a list of (lat, lon) pairs.
+
+    Returns:
+    pd.DataFrame: The points, indexed by their name or position.
+    """
+    if isinstance(points, pd.DataFrame):
+        if not {'lat', 'lon'} <= set(points.columns):
+            raise ValueError("The points table must have 'lat' and 'lon' columns.")
+        if points.index.has_duplicates:
+            raise ValueError("The points must have unique names.")
+        table = points[['lat', 'lon']].astype('float64')
+    elif isinstance(points, dict):
+        table = pd.DataFrame.from_dict(points, orient='index', columns=['lat', 'lon']).astype('float64')
+    else:
+        table = pd.DataFrame(np.asarray(points, dtype='float64').reshape(-1, 2), columns=['lat', 'lon'])
+    table.index.name = table.index.name or 'point'
+    if ((table['lat'] < -90) | (table['lat'] > 90)).any():
+        raise ValueError("Latitudes must be between -90 and 90.")
+    return table
+
+
+
+def grid_indices(coords, grid, grid_resolution=GRID_RESOLUTION) -> np.ndarray:
+    """
+    Maps coordinates to the positions of their nearest grid points, as `nearest_grid_point` does, in one operation.
+
+    Parameters:
+    coords (np.ndarray): The coordinates of the points.
+    grid (np.ndarray): The coordinates of the grid, in any order.
+    grid_resolution (float): The grid spacing. Defaults to 0.25.
+
+    Returns:
+    np.ndarray: The position in `grid` of each point, or -1 where the nearest grid point is not in the grid.
+    """
+    keys = np.round(np.asarray(grid, dtype='float64') / grid_resolution).astype('int64')
+    point_keys = np.round(nearest_grid_point(np.asarray(coords, dtype='float64'), grid_resolution) / grid_resolution).astype('int64')
+    order = np.argsort(keys)
+    positions = np.clip(np.searchsorted(keys[order], point_keys), 0, keys.size - 1)
+    return np.where(keys[order][positions] == point_keys, order[positions], -1)
+
+
+
+def wrap_longitudes(lons, grid_lon) -> np.ndarray:
+    """
+    Expresses longitudes in the convention of the grid, -180..180 or 0..360.
+
+    Parameters:
+    lons (np.ndarray): The longitudes of the points.
+    grid_lon (np.ndarray): The longitudes of the grid.
+
+    Returns:
+    np.ndarray: The wrapped longitudes.
+    """
+    if np.max(grid_lon) > 180:
+        return np.mod(lons, 360)
+    return np.mod(np.asarray(lons) + 180, 360) - 180
+
+
+
+def chunk_bounds(chunks) -> np.ndarray:
+    """
+    Returns the start of each chunk along a dimension, followed by the length of the dimension.
+
+    Parameters:
+    chunks (tuple): The chunk sizes along the dimension.
+
+    Returns:
+    np.ndarray: The chunk boundaries.
+    """
+    return np.concatenate([[0], np.cumsum(chunks)])
+
+
+
+def group_cells_by_chunk(lat_idx, lon_idx, lat_chunks, lon_chunks) -> dict:
+    """
+    Groups grid cells by the spatial chunk holding them, so each chunk is read once for all its points.
+
+    Parameters:
+    lat_idx (np.ndarray): The latitude positions of the cells.
+    lon_idx (np.ndarray): The longitude positions of the cells.
+    lat_chunks (tuple): The chunk sizes along latitude.
+    lon_chunks (tuple): The chunk sizes along longitude.
+
+    Returns:
+    dict: (lat chunk, lon chunk) -> positions of the cells in that chunk.
+    """
+    lat_chunk = np.searchsorted(chunk_bounds(lat_chunks), lat_idx, side='right') - 1
+    lon_chunk = np.searchsorted(chunk_bounds(lon_chunks), lon_idx, side='right') - 1
+    n_lon_chunks = len(lon_chunks)
+    chunk_ids = lat_chunk * n_lon_chunks + lon_chunk
+    order = np.argsort(chunk_ids, kind='stable')
+    unique_ids, starts = np.unique(chunk_ids[order], return_index=True)
+    return {(int(chunk_id // n_lon_chunks), int(chunk_id % n_lon_chunks)): positions
+            for chunk_id, positions in zip(unique_ids, np.split(order, starts[1:]))}
+
+
+
+def extract_cells(data: xr.DataArray, lat_idx, lon_idx) -> xr.DataArray:
+    """
+    Reads the time series of grid cells, one spatial chunk at a time, with a single computation.
+
+    Parameters:
+    data (xr.DataArray): The dask-backed values with dimensions ('time', 'lat', 'lon').
+    lat_idx (np.ndarray): The latitude positions of the cells.
+    lon_idx (np.ndarray): The longitude positions of the cells.
+
+    Returns:
+    xr.DataArray: The values with dimensions ('time', 'cell'), in the order of the cells.
+    """
+    lat_chunks = data.chunks[data.get_axis_num('lat')]
+    lon_chunks = data.chunks[data.get_axis_num('lon')]
+    lat_starts, lon_starts = chunk_bounds(lat_chunks), chunk_bounds(lon_chunks)
+    groups = group_cells_by_chunk(lat_idx, lon_idx, lat_chunks, lon_chunks)
+
+    pieces = []
+    for (i, j), positions in groups.items():
+        block = data.isel(lat=slice(lat_starts[i], lat_starts[i + 1]), lon=slice(lon_starts[j], lon_starts[j + 1]))
+        rows = xr.DataArray(lat_idx[positions] - lat_starts[i], dims='cell')
+        cols = xr.DataArray(lon_idx[positions] - lon_starts[j], dims='cell')
+        pieces.append(block.isel(lat=rows, lon=cols).assign_coords(cell=positions))
+    values, = dask.compute(xr.concat(pieces, dim='cell').transpose('time', 'cell'))
+    return values.sortby('cell')
+
+
+
+def open_window(accumulation_window, start_year=None, end_year=None, data_root=DATA_ROOT, store_root=TIME_STORE_ROOT):
+    """
+    Opens the whole grid of an accumulation window for point reads: the time-contiguous store if it is complete and
+    holds the whole period, otherwise the monthly files with chunks planned for time series.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    tuple: The lazy values with dimensions ('time', 'lat', 'lon') and True if they are already cleaned.
+    """
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_time_store_path(accumulation_window, store_root)
+    files = list_spei_files(accumulation_window, start_year, end_year, data_root)
+    if store_covers_period(accumulation_window, start_year, end_year, files, data_root, store_root):
+        data = open_store(store_path, variable)[variable]
+        if start_year is not None or end_year is not None:
+            data = data.sel(time=slice(str(start_year) if start_year else None, str(end_year) if end_year else None))
+        return data, True
+
+    files = filter_valid_nc_files(files)
+    if not files:
+        raise ValueError(f"No readable NetCDF files found for {variable}.")
+    ds = xr.open_mfdataset(files, concat_dim='time', combine='nested', parallel=False,
+                           chunks=plan_chunks_for_files(files, query='timeseries'))
+    return ds[variable], False
+
+
+
+@instrumented('extract_points')
+def extract_points(points, accumulation_windows, start_year=None, end_year=None, data_root=DATA_ROOT,
+                   store_root=TIME_STORE_ROOT) -> pd.DataFrame:
+    """
+    Extracts the SPEI time series at a set of locations (stations, farms, ...) for one or more accumulation windows.
+
+    Every point is mapped to its nearest grid point; points sharing a cell are read once, and the cells are grouped
+    by chunk so each chunk is read once for all of them. Values are cleaned as `process_datarray` does.
+
+    Parameters:
+    points (pd.DataFrame, dict or list): The locations, see `normalise_points`.
+    accumulation_windows (list): The accumulation windows in months (e.g. ['1', '12']).
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    pd.DataFrame: A table indexed by (point, time) with the grid cell of each point ('grid_lat', 'grid_lon') and
+                  one 'SPEI<window>' column per accumulation window; NaN for points outside the grid or over sea.
+    """
+    table = normalise_points(points)
+    if isinstance(accumulation_windows, str):
+        accumulation_windows = [accumulation_windows]
+
+    columns = {}
+    grid_cells = None
+    for window in accumulation_windows:
+        data, cleaned = open_window(str(window), start_year, end_year, data_root, store_root)
+        lat_idx = grid_indices(table['lat'].values, data['lat'].values)
+        lon_idx = grid_indices(wrap_longitudes(table['lon'].values, data['lon'].values), data['lon'].values)
+        inside = (lat_idx >= 0) & (lon_idx >= 0)
+        if not inside.any():
+            raise ValueError("None of the points is inside the grid.")
+
+        cell_keys = lat_idx[inside] * data.sizes['lon'] + lon_idx[inside]
+        unique_keys, point_cells = np.unique(cell_keys, return_inverse=True)
+        values = extract_cells(data, unique_keys // data.sizes['lon'], unique_keys % data.sizes['lon'])
+        if not cleaned:
+            values, _ = process_datarray(values)
+
+        series = np.full((len(table), values.sizes['time']), np.nan, dtype='float32')
+        series[inside] = values.values.T[point_cells]
+        index = pd.MultiIndex.from_product([table.index, pd.DatetimeIndex(values['time'].values)], names=[table.index.name, 'time'])
+        columns[f'SPEI{window}'] = pd.Series(series.ravel(), index=index)
+        if grid_cells is None:
+            grid_cells = pd.DataFrame({
+                'grid_lat': np.where(inside, data['lat'].values[np.maximum(lat_idx, 0)], np.nan),
+                'grid_lon': np.where(inside, data['lon'].values[np.maximum(lon_idx, 0)], np.nan),
+            }, index=table.index)
+
+    # Windows may cover different months; the table holds the union with NaN where a window has no value
+    result = pd.DataFrame(columns)
+    cells = grid_cells.iloc[grid_cells.index.get_indexer(result.index.get_level_values(0))]
+    result.insert(0, 'grid_lat', cells['grid_lat'].values)
+    result.insert(1, 'grid_lon', cells['grid_lon'].values)
+    return result
@@ -0,0 +1,401 @@
+import os
+import time
+import numpy as np
+import xarray as xr
+from utils.data_preprocess import (DATA_ROOT, parse_file_month, list_spei_files, filter_valid_nc_files,
+                                   load_and_preprocess_dataset, process_datarray, compute_stats)
+from utils.coordinates_retrieve import split_bounding_box, longitude_span
+from utils.quantization import quantized_encoding, clip_to_limit, store_is_quantized, open_store
+
+
+PYRAMID_ROOT = '/data1/drought_dataset/spei_pyramid/'
+NATIVE_RESOLUTION = 0.25                 # Resolution of the ERA5-Drought files, served from the files themselves
+PYRAMID_RESOLUTIONS = (0.5, 1.0, 2.0)    # Coarsened levels stored in the pyramid
+DEFAULT_CELL_FRACTION = 0.1              # One coarse cell may span at most 10% of the shorter side of the region
+DEFAULT_MAX_ERROR = 0.05                 # Largest measured difference of a regional median or mean, in SPEI units
+
+
+
+def coarsen_area_weighted(data: xr.DataArray, factor: int) -> xr.DataArray:
+    """
+    Coarsens a grid by aggregating blocks of `factor` x `factor` cells into their area-weighted mean.
+
+    Cells are weighted by cos(latitude), which is proportional to their area on a regular lat/lon grid. Missing cells
+    (e.g. sea) are left out of the mean, and a coarse cell is missing only if all its cells are.
+
+    Parameters:
+    data (xr.DataArray): The values on the native grid, with 'lat' and 'lon' dimensions and invalid values as NaN.
+    factor (int): The number of native cells along each side of a coarse cell.
+
+    Returns:
+    xr.DataArray: The coarsened values, with the coordinates of the coarse cell centres.
+    """
+    if factor == 1:
+        return data
+    weights = np.cos(np.deg2rad(data['lat'])).clip(min=0)
+    valid_weights = weights.where(data.notnull(), 0)
+    numerator = (data.fillna(0) * weights).coarsen(lat=factor, lon=factor, boundary='pad').sum()
+    denominator = valid_weights.coarsen(lat=factor, lon=factor, boundary='pad').sum()
+    coarse = (numerator / denominator).where(denominator > 0)
+
+    # Padded blocks have no meaningful mean coordinate, so the centres are derived from the native spacing
+    centres = {}
+    for dim in ('lat', 'lon'):
+        values = data[dim].values
+        step = values[1] - values[0] if values.size > 1 else NATIVE_RESOLUTION
+        centres[dim] = values[0] + step * (factor * np.arange(coarse.sizes[dim]) + (factor - 1) / 2)
+    return coarse.assign_coords(centres).astype(data.dtype).rename(data.name)
+
+
+
+def get_pyramid_path(accumulation_window, resolution, pyramid_root=PYRAMID_ROOT):
+    """
+    Get the Zarr store holding one level of the pyramid of an accumulation window.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    resolution (float): The resolution of the level in degrees.
+
+    Returns:
+    str: The path of the store.
+    """
+    return os.path.join(pyramid_root, f'spei{accumulation_window}', f'level_{resolution:g}deg.zarr')
+
+
+
+def stored_years(store_path):
+    """
+    List the years already written to a pyramid level.
+
+    Parameters:
+    store_path (str): The path of the Zarr store.
+
+    Returns:
+    set: The years present in the store (empty if the store does not exist).
+    """
+    if not os.path.exists(store_path):
+        return set()
+    with xr.open_zarr(store_path) as ds:
+        return set(ds['time'].dt.year.values.tolist())
+
+
+
+def check_append_order(year, done, store_path):
+    """
+    Refuses to append a year before the last year of a store, which would leave its time axis out of order.
+
+    Parameters:
+    year (int): The year about to be appended.
+    done (set): The years already in the store.
+    store_path (str): The path of the store, for the message.
+    """
+    if done and year < max(done):
+        raise ValueError(f"{store_path} already holds {max(done)}; {year} cannot be appended before it. "
+                         "Rebuild the store from its first year to include earlier years.")
+
+
+
+def select_years(data, start_year=None, end_year=None):
+    """
+    Selects the time steps of a range of years, whatever the order of the time axis.
+
+    Parameters:
+    data (xr.DataArray): The values with a 'time' dimension.
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+
+    Returns:
+    xr.DataArray: The selected time steps.
+    """
+    if start_year is None and end_year is None:
+        return data
+    years = data['time'].dt.year.values
+    keep = np.ones(years.size, dtype=bool)
+    if start_year is not None:
+        keep &= years >= int(start_year)
+    if end_year is not None:
+        keep &= years <= int(end_year)
+    return data.isel(time=np.flatnonzero(keep))
+
+
+
+def build_pyramid(accumulation_window, start_year, end_year, resolutions=PYRAMID_RESOLUTIONS, data_root=DATA_ROOT,
+                  pyramid_root=PYRAMID_ROOT, quantize=False):
+    """
+    Builds (or extends) the coarsened levels of the pyramid of an accumulation window from the global monthly files.
+
+    The files are processed one year at a time: the year is read and cleaned once, coarsened to every level and
+    appended to the level stores. Years already present in all stores are skipped, so an interrupted build can
+    be resumed and later years can be added; years before the last stored one are refused (ValueError), since
+    appending them would put the time axis out of order.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    start_year (int): First year to include.
+    end_year (int): Last year to include.
+    resolutions (tuple): The resolutions of the levels in degrees, multiples of 0.25. Defaults to 0.5, 1 and 2.
+    data_root (str): The root folder of the SPEI archive.
+    pyramid_root (str): The root folder of the pyramid.
+    quantize (bool): If True, new levels store int16 codes (utils.quantization) instead of float32. Existing levels
+                     keep their encoding.
+
+    Returns:
+    dict: The number of months written to each level.
+    """
+    factors = {}
+    for resolution in resolutions:
+        factor = resolution / NATIVE_RESOLUTION
+        if factor < 1 or not np.isclose(factor, round(factor)):
+            raise ValueError(f"Pyramid resolutions must be multiples of {NATIVE_RESOLUTION} degrees, got {resolution}.")
+        factors[resolution] = int(round(factor))
+
+    variable = f'SPEI{accumulation_window}'
+    paths = {resolution: get_pyramid_path(accumulation_window, resolution, pyramid_root) for resolution in resolutions}
+    done = {resolution: stored_years(path) for resolution, path in paths.items()}
+    quantized = {resolution: store_is_quantized(path, variable) if os.path.exists(path) else quantize
+                 for resolution, path in paths.items()}
+    written = {resolution: 0 for resolution in resolutions}
+
+    for year in range(int(start_year), int(end_year) + 1):
+        pending = [resolution for resolution in resolutions if year not in done[resolution]]
+        if not pending:
+            continue
+        files = filter_valid_nc_files(list_spei_files(accumulation_window, year, year, data_root))
+        if not files:
+            print(f"No readable NetCDF files found for {year}.")
+            continue
+        for resolution in pending:
+            check_append_order(year, done[resolution], paths[resolution])
+
+        start_time = time.time()
+        with xr.open_mfdataset(files, concat_dim='time', combine='nested') as ds:
+            native, _ = process_datarray(ds[variable])
+            native = native.sortby('time').load()
+        for resolution in pending:
+            coarse = coarsen_area_weighted(native, factors[resolution])
+            coarse = (clip_to_limit(coarse) if quantized[resolution] else coarse).to_dataset()
+            coarse.attrs.update({'resolution_degrees': resolution, 'aggregation': 'cos(latitude) weighted mean'})
+            if os.path.exists(paths[resolution]):
+                coarse.to_zarr(paths[resolution], append_dim='time')
+            else:
+                os.makedirs(os.path.dirname(paths[resolution]), exist_ok=True)
+                chunks = (12, coarse.sizes['lat'], coarse.sizes['lon'])
+                encoding = {variable: quantized_encoding(chunks) if quantized[resolution] else {'dtype': 'float32', 'chunks': chunks}}
+                coarse.to_zarr(paths[resolution], mode='w', encoding=encoding)
+            written[resolution] += coarse.sizes['time']
+            done[resolution].add(year)
+        print(f"{variable} {year}: {len(files)} files added to {len(pending)} levels in {time.time() - start_time:.1f} s")
+    return written
+
+
+
+def rewrite_pyramid_months(accumulation_window, files, resolutions=PYRAMID_RESOLUTIONS, pyramid_root=PYRAMID_ROOT) -> dict:
+    """
+    Rewrites in place the months of the pyramid levels whose monthly files were replaced. `build_pyramid` skips the
+    years already stored, so corrected files would otherwise never reach the levels. Months not in a level are left
+    to `append_pyramid_months`.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    files (list): The replaced monthly files.
+    resolutions (tuple): The resolutions of the levels to update; levels not built are ignored.
+    pyramid_root (str): The root folder of the pyramid.
+
+    Returns:
+    dict: The number of months rewritten in each level.
+    """
+    variable = f'SPEI{accumulation_window}'
+    stored = {}
+    for resolution in resolutions:
+        path = get_pyramid_path(accumulation_window, resolution, pyramid_root)
+        if os.path.exists(path):
+            with xr.open_zarr(path) as store:
+                stored[resolution] = {(stamp.year, stamp.month): i for i, stamp in enumerate(store.indexes['time'])}
+    rewritten = {resolution: 0 for resolution in stored}
+    for file in files:
+        targets = [resolution for resolution, months in stored.items() if parse_file_month(file) in months]
+        if not targets:
+            continue
+        with xr.open_dataset(file) as ds:
+            native, _ = process_datarray(ds[variable].load())
+        for resolution in targets:
+            path = get_pyramid_path(accumulation_window, resolution, pyramid_root)
+            position = stored[resolution][parse_file_month(file)]
+            coarse = coarsen_area_weighted(native, int(round(resolution / NATIVE_RESOLUTION)))
+            coarse = clip_to_limit(coarse) if store_is_quantized(path, variable) else coarse
+            coarse.drop_vars(['time', 'lat', 'lon']).to_dataset(name=variable).to_zarr(
+                path, region={'time': slice(position, position + 1)})
+            rewritten[resolution] += 1
+    return rewritten
+
+
+
+def append_pyramid_months(accumulation_window, resolutions=PYRAMID_RESOLUTIONS, data_root=DATA_ROOT,
+                          pyramid_root=PYRAMID_ROOT) -> dict:
+    """
+    Appends to the pyramid levels the months of the archive later than their last month, as `update_time_store`
+    does for the time-contiguous store. Unlike `build_pyramid`, which skips the years already stored, this also
+    completes a year stored in part.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    resolutions (tuple): The resolutions of the levels to extend; levels not built are ignored.
+    data_root (str): The root folder of the SPEI archive.
+    pyramid_root (str): The root folder of the pyramid.
+
+    Returns:
+    dict: The number of months appended to each level.
+    """
+    variable = f'SPEI{accumulation_window}'
+    # Levels ending on the same month are extended from the same reads
+    levels = {}
+    for resolution in resolutions:
+        path = get_pyramid_path(accumulation_window, resolution, pyramid_root)
+        if os.path.exists(path):
+            with xr.open_zarr(path) as store:
+                last = store.indexes['time'].max()
+            levels.setdefault((last.year, last.month), []).append(resolution)
+
+    written = {resolution: 0 for group in levels.values() for resolution in group}
+    for last, group in levels.items():
+        files = filter_valid_nc_files(list_spei_files(accumulation_window, last[0], None, data_root))
+        files = [file for file in files if parse_file_month(file) > last]
+        # One year at a time, as build_pyramid, so a store far behind the archive is not read at once
+        for year in sorted({parse_file_month(file)[0] for file in files}):
+            year_files = [file for file in files if parse_file_month(file)[0] == year]
+            with xr.open_mfdataset(year_files, concat_dim='time', combine='nested') as ds:
+                native, _ = process_datarray(ds[variable])
+                native = native.sortby('time').load()
+            for resolution in group:
+                path = get_pyramid_path(accumulation_window, resolution, pyramid_root)
+                coarse = coarsen_area_weighted(native, int(round(resolution / NATIVE_RESOLUTION)))
+                coarse = (clip_to_limit(coarse) if store_is_quantized(path, variable) else coarse).to_dataset()
+                coarse.attrs.update({'resolution_degrees': resolution, 'aggregation': 'cos(latitude) weighted mean'})
+                coarse.to_zarr(path, append_dim='time')
+                written[resolution] += coarse.sizes['time']
+    return written
+
+
+
+def choose_pyramid_level(bounds, cell_fraction=DEFAULT_CELL_FRACTION, resolutions=PYRAMID_RESOLUTIONS, level_errors=None,
+                         max_error=DEFAULT_MAX_ERROR):
+    """
+    Chooses the coarsest resolution at which one cell spans at most `cell_fraction` of the shorter side of the region.
+
+    The cell fraction is a geometric rule of thumb. When the errors measured by `pyramid_level_errors` for typical
+    regions are given, levels whose regional median or mean differed from the native one by more than `max_error`
+    are not used either.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    cell_fraction (float): The largest allowed ratio between the cell size and the shorter side of the region.
+                           Smaller values favour accuracy, larger values speed. Defaults to 0.1.
+    resolutions (tuple): The resolutions available in the pyramid.
+    level_errors (dict, optional): The errors of each level, from `pyramid_level_errors`.
+    max_error (float): The largest allowed measured error, in SPEI units. Defaults to 0.05.
+
+    Returns:
+    float: The chosen resolution in degrees; NATIVE_RESOLUTION if no coarsened level is fine enough.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    shorter_side = min(longitude_span(min_lon, max_lon), max_lat - min_lat) + NATIVE_RESOLUTION
+    for resolution in sorted(resolutions, reverse=True):
+        if level_errors is not None:
+            errors = level_errors.get(resolution)
+            if errors is None or max(errors.values()) > max_error:
+                continue
+        if resolution <= cell_fraction * shorter_side:
+            return resolution
+    return NATIVE_RESOLUTION
+
+
+
+def load_pyramid_level(bounds, accumulation_window, resolution, start_year=None, end_year=None, pyramid_root=PYRAMID_ROOT,
+                       keep_quantized=False):
+    """
+    Loads the coarse cells overlapping a region from one level of the pyramid.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    accumulation_window (str): The accumulation window in months.
+    resolution (float): The resolution of the level in degrees.
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    pyramid_root (str): The root folder of the pyramid.
+    keep_quantized (bool): If True, the int16 codes of a quantized level are returned undecoded, for `compute_stats`.
+
+    Returns:
+    xr.DataArray: The lazily loaded values with dimensions ('time', 'lat', 'lon').
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    ds = open_store(get_pyramid_path(accumulation_window, resolution, pyramid_root), f'SPEI{accumulation_window}', keep_quantized)
+    half = resolution / 2
+    lat_overlap = (ds['lat'] + half > min_lat) & (ds['lat'] - half < max_lat)
+    # Across the antimeridian, the columns of the eastern side follow those of the western side
+    lon_positions = np.concatenate([np.flatnonzero(((ds['lon'] + half > west) & (ds['lon'] - half < east)).values)
+                                    for west, _, east, _ in split_bounding_box(bounds, ds['lon'].values)])
+    data = ds[f'SPEI{accumulation_window}'].isel(lat=np.flatnonzero(lat_overlap.values), lon=lon_positions)
+    return select_years(data, start_year, end_year)
+
+
+
+def get_pyramid_stats(bounds, accumulation_window, start_year, end_year, cell_fraction=DEFAULT_CELL_FRACTION, full_stats=True,
+                      data_root=DATA_ROOT, pyramid_root=PYRAMID_ROOT, level_errors=None, max_error=DEFAULT_MAX_ERROR):
+    """
+    Computes the statistics of a region at the coarsest pyramid level allowed by `choose_pyramid_level`, falling back
+    to the native files for small regions or when the level has not been built.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    accumulation_window (str): The accumulation window in months.
+    start_year (int): First year of the period.
+    end_year (int): Last year of the period.
+    cell_fraction (float): See `choose_pyramid_level`. Defaults to 0.1.
+    full_stats (bool): If True, computes all statistics. Defaults to True.
+    data_root (str): The root folder of the SPEI archive.
+    pyramid_root (str): The root folder of the pyramid.
+    level_errors (dict, optional): The measured errors of the levels, see `choose_pyramid_level`.
+    max_error (float): The largest allowed measured error. Defaults to 0.05.
+
+    Returns:
+    tuple: The statistics returned by `compute_stats` and the resolution they were computed at.
+    """
+    resolution = choose_pyramid_level(bounds, cell_fraction, level_errors=level_errors, max_error=max_error)
+    if resolution != NATIVE_RESOLUTION and not os.path.exists(get_pyramid_path(accumulation_window, resolution, pyramid_root)):
+        print(f"Pyramid level {resolution:g} deg not found for SPEI{accumulation_window}, reading the native files.")
+        resolution = NATIVE_RESOLUTION
+
+    if resolution == NATIVE_RESOLUTION:
+        files = filter_valid_nc_files(list_spei_files(accumulation_window, start_year, end_year, data_root))
+        if not files:
+            raise ValueError("No readable NetCDF files found.")
+        data, _ = process_datarray(load_and_preprocess_dataset(files, bounds)[f'SPEI{accumulation_window}'])
+    else:
+        data = load_pyramid_level(bounds, accumulation_window, resolution, start_year, end_year, pyramid_root, keep_quantized=True)
+    return compute_stats(data, full_stats), resolution
+
+
+
+def pyramid_level_errors(data: xr.DataArray, resolutions=PYRAMID_RESOLUTIONS) -> dict:
+    """
+    Measures how far the regional medians and means of each coarsened level are from the native ones, for typical
+    regions; `choose_pyramid_level` leaves out the levels whose errors exceed its `max_error`.
+
+    Parameters:
+    data (xr.DataArray): Cleaned native values of one region, with dimensions ('time', 'lat', 'lon').
+    resolutions (tuple): The resolutions to evaluate.
+
+    Returns:
+    dict: For each resolution, the largest absolute difference of the median and of the mean over time.
+    """
+    data = data.load()
+    native_median = data.median(['lat', 'lon'])
+    native_mean = data.mean(['lat', 'lon'])
+    errors = {}
+    for resolution in resolutions:
+        coarse = coarsen_area_weighted(data, int(round(resolution / NATIVE_RESOLUTION)))
+        errors[resolution] = {
+            'max_median_difference': float(np.abs(coarse.median(['lat', 'lon']) - native_median).max()),
+            'max_mean_difference': float(np.abs(coarse.mean(['lat', 'lon']) - native_mean).max()),
+        }
+    return errors
@@ -0,0 +1,521 @@
+"""
+Local HTTP query service for regional SPEI statistics.
+
+Keeps the file catalog, area bounds, map fields and computed results warm in one process, and coalesces concurrent
+identical requests so they trigger a single computation. From the `handbook/chapters/shared` folder:
+
+    python -m utils.query_server --port 8765
+
+Endpoints (all GET):
+    /stats?country=Madagascar&accumulation_window=12 months&year_range=1980,2024
+    /timeseries?country=Kenya&adm1_subarea=Turkana&accumulation_window=3 months&month=January
+    /tiles/12/202401/{z}/{x}/{y}.png   (SPEI12 map of January 2024, geographic tiling with 2 x 1 tiles at z=0)
+    /current?accumulation_window=12 months&countries=Kenya,Somalia,Ethiopia   (ranking of the latest month, with --recent-months)
+    /health
+"""
+import argparse
+import asyncio
+import io
+import json
+import time
+import numpy as np
+import xarray as xr
+import matplotlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import tornado.web
+from utils.widgets_handler import read_json_to_dict, read_json_to_sorted_dict
+from utils.data_preprocess import DATA_ROOT, parse_file_month, replace_invalid_values
+from utils.batch_runner import PLACEHOLDERS, build_selection, build_catalog, select_catalog_files, compute_window_stats
+from utils.coordinates_retrieve import get_boundaries, calculate_bounding_box
+from utils.instrumentation import record_cache
+from utils.quantization import quantize, dequantize
+from utils.recent_cache import RecentMonthsCache
+
+
+TILE_SIZE = 256
+CATALOG_REFRESH = 300           # Seconds after which the files of a window are listed again, to serve new months
+
+
+
+class CoalescingCache:
+    """
+    Least-recently-used cache of computation results in which concurrent requests for the same key share one
+    computation.
+
+    Parameters:
+    max_items (int): Maximum number of results kept in memory.
+    name (str): Name of the cache in the instrumentation report.
+    keep_none (bool): If False, a None result is returned but not kept, so the next request computes it again
+                      (e.g. a lookup that failed for a transient reason). Defaults to True.
+    """
+    def __init__(self, max_items=256, name='results', keep_none=True):
+        self.max_items = max_items
+        self.name = name
+        self.keep_none = keep_none
+        self.results = OrderedDict()
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, key, compute):
+        """
+        Return the cached result for `key`, joining a running computation or starting `compute` if needed.
+
+        Parameters:
+        key (hashable): The cache key.
+        compute (callable): Coroutine function producing the result.
+
+        Returns:
+        object: The result.
+        """
+        record_cache(self.name, key in self.results)
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+        if key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[key])
+
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        self.in_flight[key] = task
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            self.in_flight.pop(key, None)
+        if result is None and not self.keep_none:
+            return result
+        self.results[key] = result
+        if len(self.results) > self.max_items:
+            self.results.popitem(last=False)
+        return result
+
+    def info(self):
+        """
+        Return the cache counters.
+
+        Returns:
+        dict: Number of items, hits, misses and coalesced requests.
+        """
+        return {'items': len(self.results), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+
+
+def make_state(data_root=DATA_ROOT, workers=4, max_results=256, country_list=None, quantize_fields=False, recent_months=0,
+               recent_root=None, catalog_refresh=CATALOG_REFRESH):
+    """
+    Create the warm in-process state shared by all request handlers.
+
+    Parameters:
+    data_root (str): The root folder of the SPEI archive.
+    workers (int): Number of threads running the computations.
+    max_results (int): Maximum number of results kept in each cache.
+    country_list (list, optional): List of country dictionaries; read from 'country_list.json' if not given.
+    quantize_fields (bool): If True, map fields are cached as int16 codes (utils.quantization), so the field cache
+                            holds twice as many fields in the same memory. Tiles differ by at most 0.0005 SPEI.
+    recent_months (int): If positive, the latest global fields of every accumulation window are kept warm in a
+                         `RecentMonthsCache`, serving their tiles and rankings without reading the archive.
+    recent_root (str, optional): Folder of the memory-mapped copies of the recent months cache.
+    catalog_refresh (float): Seconds after which the files of an accumulation window are listed again, so months
+                             added to the archive are served without a restart. Defaults to 300.
+
+    Returns:
+    dict: The shared state (catalog, bounds, caches and executor).
+    """
+    accumulation_windows = read_json_to_dict('accumulation_windows.json')
+    # Listings and bounds are cached like results, so concurrent first requests share one listing or lookup
+    return {
+        'data_root': data_root,
+        'accumulation_windows': accumulation_windows,
+        'months': read_json_to_dict('months.json'),
+        'country_list': country_list if country_list is not None else read_json_to_sorted_dict('country_list.json'),
+        'catalog': CoalescingCache(2 * len(accumulation_windows), 'catalog'),
+        'catalog_refresh': catalog_refresh,
+        'bounds': CoalescingCache(4096, 'bounds', keep_none=False),
+        'results': CoalescingCache(max_results, 'results'),
+        'fields': CoalescingCache(2 * max_results if quantize_fields else max_results, 'fields'),
+        'quantize_fields': quantize_fields,
+        'recent': RecentMonthsCache(recent_months, list(accumulation_windows.values()), data_root, recent_root,
+                                    quantize=quantize_fields) if recent_months else None,
+        'executor': ThreadPoolExecutor(max_workers=workers),
+    }
+
+
+
+def job_from_query(arguments):
+    """
+    Build a batch-runner job from the query string of a request.
+
+    Parameters:
+    arguments (dict): Query arguments as returned by tornado (lists of bytes).
+
+    Returns:
+    dict: The job dictionary.
+    """
+    values = {key: value[-1].decode() for key, value in arguments.items()}
+    job = {'name': 'query', 'period': {}}
+    for key in ('country', 'adm1_subarea', 'adm2_subarea', 'accumulation_window'):
+        if key in values:
+            job[key] = values[key]
+    if 'accumulation_windows_multiple' in values:
+        job['accumulation_windows_multiple'] = values['accumulation_windows_multiple'].split(',')
+    for kind in ('month', 'year', 'twenty_years'):
+        if kind in values:
+            job['period'][kind] = values[kind]
+    if 'year_range' in values:
+        job['period']['year_range'] = values['year_range'].split(',')
+    return job
+
+
+
+async def run_blocking(state, function, *args):
+    """
+    Run a blocking function on the state's thread pool without blocking the event loop.
+
+    Parameters:
+    state (dict): The shared state.
+    function (callable): The blocking function.
+    args: Positional arguments of the function.
+
+    Returns:
+    object: The result of the function.
+    """
+    return await asyncio.get_running_loop().run_in_executor(state['executor'], function, *args)
+
+
+
+async def get_catalog(state, accumulation_window):
+    """
+    Return the validated files of an accumulation window, listing them again once per `catalog_refresh` seconds.
+    Concurrent requests share one listing.
+
+    Parameters:
+    state (dict): The shared state.
+    accumulation_window (str): The accumulation window in months.
+
+    Returns:
+    list: The readable files sorted by date.
+    """
+    async def list_files():
+        catalog = await run_blocking(state, build_catalog, [accumulation_window], state['data_root'])
+        return catalog[accumulation_window]
+
+    period = int(time.time() // state['catalog_refresh'])
+    return await state['catalog'].get((accumulation_window, period), list_files)
+
+
+
+async def get_bounds(state, selected):
+    """
+    Return the bounding box of a selected area, looking its boundaries up once. Concurrent requests for the same
+    area share one lookup.
+
+    Parameters:
+    state (dict): The shared state.
+    selected (dict): The selected country and subareas.
+
+    Returns:
+    tuple or None: The bounds (min_lon, min_lat, max_lon, max_lat), or None if no boundary was found; a failed
+                   lookup is not cached, so the next request tries again.
+    """
+    def find_bounds():
+        coordinates = get_boundaries(selected, state['country_list'], PLACEHOLDERS)
+        return calculate_bounding_box(coordinates) if coordinates else None
+
+    key = (selected['country'], selected['adm1_subarea'], selected['adm2_subarea'])
+    return await state['bounds'].get(key, lambda: run_blocking(state, find_bounds))
+
+
+
+async def query_stats(state, job, full_stats):
+    """
+    Compute (or fetch from the cache) the statistics of a selection.
+
+    Parameters:
+    state (dict): The shared state.
+    job (dict): The selection, in the batch-runner job format.
+    full_stats (bool): If True, quartiles, minima and maxima are included.
+
+    Returns:
+    dict: Statistics per accumulation window, with JSON-serialisable lists.
+    """
+    btn_name, selected = build_selection(job, PLACEHOLDERS)
+    windows = selected['accumulation_windows_multiple'] if btn_name == 'accumulation_windows_widgets_btn' else [selected['accumulation_window']]
+    unknown = [window for window in windows if window not in state['accumulation_windows']]
+    if unknown:
+        raise tornado.web.HTTPError(400, reason=f"Unknown accumulation window: {', '.join(unknown)}.")
+    # The selected files are part of the key, so a refreshed catalog with new months gives a new result
+    files = {}
+    for window in windows:
+        catalog = await get_catalog(state, state['accumulation_windows'][window])
+        files[window] = select_catalog_files(catalog, btn_name, selected, state['months'])
+    key = ('stats', full_stats, btn_name, selected['country'], selected['adm1_subarea'], selected['adm2_subarea'],
+           tuple(windows), selected['month'], selected['year'], tuple(selected['year_range']), selected['twenty_years'],
+           tuple(tuple(files[window]) for window in windows))
+
+    async def compute():
+        bounds = await get_bounds(state, selected)
+        if bounds is None:
+            raise tornado.web.HTTPError(404, reason='No boundaries found for the selected area.')
+        result = {}
+        for window in windows:
+            window_value = state['accumulation_windows'][window]
+            if not files[window]:
+                raise tornado.web.HTTPError(404, reason=f'No data for {window} in the selected period.')
+            values, report = await run_blocking(state, compute_window_stats, files[window], bounds, window_value, full_stats)
+            result[window] = {key: (np.asarray(value).astype(str).tolist() if key == 'times' else np.asarray(value).tolist())
+                              for key, value in values.items() if value is not None}
+            result[window]['cleaning'] = report
+        return {'selected': selected, 'bounds': [float(b) for b in bounds], 'stats': result}
+
+    return await state['results'].get(key, compute)
+
+
+
+async def get_field(state, accumulation_window, year_month):
+    """
+    Return the global SPEI field of one month, loaded once and kept in memory.
+
+    Parameters:
+    state (dict): The shared state.
+    accumulation_window (str): The accumulation window in months.
+    year_month (tuple): The (year, month) of the field.
+
+    Returns:
+    xr.DataArray: The field with invalid values replaced by NaN, or its int16 codes if `quantize_fields` is set.
+    """
+    async def load():
+        recent = state.get('recent')
+        if recent is not None and year_month in await run_blocking(state, recent.months, accumulation_window):
+            def read_recent():
+                field = recent.field(accumulation_window, year_month, decode=not state.get('quantize_fields'))
+                return field.sortby('lat', ascending=False).sortby('lon')
+
+            return await run_blocking(state, read_recent)
+
+        catalog = await get_catalog(state, accumulation_window)
+        matches = [file for file in catalog if parse_file_month(file) == year_month]
+        if not matches:
+            raise tornado.web.HTTPError(404, reason='No data for the requested month.')
+
+        def read(file):
+            with xr.open_dataset(file) as ds:
+                field = ds[f'SPEI{accumulation_window}'].isel(time=0).load()
+            field, _, _ = replace_invalid_values(field)
+            field = field.sortby('lat', ascending=False).sortby('lon')
+            return quantize(field) if state.get('quantize_fields') else field
+
+        return await run_blocking(state, read, matches[0])
+
+    return await state['fields'].get(('field', accumulation_window, year_month), load)
+
+
+
+def render_tile(field, z, x, y, vmin=-2.0, vmax=2.0, cmap='BrBG'):
+    """
+    Render one 256 x 256 PNG tile of a global field in the geographic tiling scheme (2^(z+1) x 2^z tiles).
+
+    Parameters:
+    field (xr.DataArray): The global field with 'lat' (descending) and 'lon' (ascending) coordinates, possibly
+                          quantized.
+    z (int), x (int), y (int): The tile coordinates, y counted from the north.
+    vmin (float), vmax (float): Colour limits, as in `plot_geographical_distribution`.
+    cmap (str): The matplotlib colormap.
+
+    Returns:
+    bytes: The PNG image; transparent where there is no data.
+    """
+    tile_degrees = 180.0 / 2 ** z
+    west = -180.0 + x * tile_degrees
+    north = 90.0 - y * tile_degrees
+    pixel = tile_degrees / TILE_SIZE
+    lons = west + pixel * (np.arange(TILE_SIZE) + 0.5)
+    lats = north - pixel * (np.arange(TILE_SIZE) + 0.5)
+    field_lons = field['lon'].values
+    if field_lons.max() > 180:
+        lons = np.mod(lons, 360)
+    values = dequantize(field.sel(lat=xr.DataArray(lats, dims='y'), lon=xr.DataArray(lons, dims='x'), method='nearest')).values
+
+    colormap = matplotlib.colormaps[cmap]
+    rgba = colormap(np.clip((values - vmin) / (vmax - vmin), 0, 1), bytes=True)
+    rgba[~np.isfinite(values)] = 0
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode='RGBA').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    """
+    Request handler with access to the shared state and JSON responses.
+    """
+    def initialize(self, state):
+        self.state = state
+
+    def write_json(self, payload):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(payload, default=str))
+
+    def write_error(self, status_code, **kwargs):
+        self.write_json({'error': self._reason})
+
+
+
+class StatsHandler(BaseHandler):
+    """
+    Full statistics (as in `compute_stats`) of a selection.
+    """
+    async def get(self):
+        try:
+            job = job_from_query(self.request.arguments)
+            self.write_json(await query_stats(self.state, job, full_stats=True))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+
+
+class TimeseriesHandler(BaseHandler):
+    """
+    Median time series of a selection (the lightweight `compute_stats` output).
+    """
+    async def get(self):
+        try:
+            job = job_from_query(self.request.arguments)
+            result = await query_stats(self.state, job, full_stats=False)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        self.write_json({window: {key: values[key] for key in ('times', 'medians', 'means') if key in values}
+                         for window, values in result['stats'].items()})
+
+
+
+class TileHandler(BaseHandler):
+    """
+    PNG map tile of the global SPEI field of one month.
+    """
+    async def get(self, accumulation_window, year_month, z, x, y):
+        z, x, y = int(z), int(x), int(y)
+        if not (0 <= x < 2 ** (z + 1) and 0 <= y < 2 ** z):
+            raise tornado.web.HTTPError(404, reason='Tile outside the grid.')
+        year_month = (int(year_month[:4]), int(year_month[4:6]))
+        key = ('tile', accumulation_window, year_month, z, x, y)
+
+        async def compute():
+            field = await get_field(self.state, accumulation_window, year_month)
+            return await run_blocking(self.state, render_tile, field, z, x, y)
+
+        self.set_header('Content-Type', 'image/png')
+        self.write(await self.state['results'].get(key, compute))
+
+
+
+class CurrentHandler(BaseHandler):
+    """
+    Ranking of countries by the SPEI of the latest (or a given recent) month, from the recent months cache.
+    """
+    async def get(self):
+        recent = self.state.get('recent')
+        if recent is None:
+            raise tornado.web.HTTPError(404, reason='The recent months cache is disabled (see --recent-months).')
+        window = self.get_argument('accumulation_window', '12 months')
+        if window not in self.state['accumulation_windows']:
+            raise tornado.web.HTTPError(400, reason=f'Unknown accumulation window: {window}.')
+        window_value = self.state['accumulation_windows'][window]
+        countries = [country for country in self.get_argument('countries', '').split(',') if country]
+        if not countries:
+            raise tornado.web.HTTPError(400, reason='No countries given.')
+        months = await run_blocking(self.state, recent.months, window_value)
+        month = self.get_argument('month', None)
+        year_month = (int(month[:4]), int(month[4:6])) if month else months[-1]
+        if year_month not in months:
+            raise tornado.web.HTTPError(404, reason='The requested month is not among the recent months.')
+
+        async def compute():
+            region_bounds = {}
+            for country in countries:
+                selected = {'country': country, 'adm1_subarea': PLACEHOLDERS['adm1_subarea'], 'adm2_subarea': PLACEHOLDERS['adm2_subarea']}
+                bounds = await get_bounds(self.state, selected)
+                if bounds is not None:
+                    region_bounds[country] = bounds
+            table = await run_blocking(self.state, recent.rank_regions, region_bounds, window_value, year_month)
+            return {'time': table.attrs['time'], 'accumulation_window': window, 'ranking': table.reset_index().to_dict(orient='records')}
+
+        self.write_json(await self.state['results'].get(('current', window_value, year_month, tuple(countries)), compute))
+
+
+
+class HealthHandler(BaseHandler):
+    """
+    Service status with cache counters.
+    """
+    def get(self):
+        recent = self.state.get('recent')
+        self.write_json({'status': 'ok', 'results_cache': self.state['results'].info(), 'fields_cache': self.state['fields'].info(),
+                         'catalog': {window: len(files) for (window, _), files in self.state['catalog'].results.items()},
+                         'recent_months': recent.info() if recent is not None else None})
+
+
+
+def make_app(state):
+    """
+    Create the tornado application serving the query endpoints.
+
+    Parameters:
+    state (dict): The shared state from `make_state`.
+
+    Returns:
+    tornado.web.Application: The application.
+    """
+    return tornado.web.Application([
+        (r'/stats', StatsHandler, {'state': state}),
+        (r'/timeseries', TimeseriesHandler, {'state': state}),
+        (r'/tiles/(\d+)/(\d{6})/(\d+)/(\d+)/(\d+)\.png', TileHandler, {'state': state}),
+        (r'/current', CurrentHandler, {'state': state}),
+        (r'/health', HealthHandler, {'state': state}),
+    ])
+
+
+
+async def serve(port=8765, address='127.0.0.1', **state_kwargs):
+    """
+    Start the query service and run until cancelled.
+
+    Parameters:
+    port (int): The port to listen on.
+    address (str): The address to bind; local only by default.
+    state_kwargs: Keyword arguments passed to `make_state`.
+    """
+    app = make_app(make_state(**state_kwargs))
+    app.listen(port, address=address)
+    print(f"Serving SPEI queries on http://{address}:{port}")
+    await asyncio.Event().wait()
+
+
+
+def main(argv=None):
+    """
+    Command line entry point of the query service.
+
+    Parameters:
+    argv (list, optional): The command line arguments; `sys.argv[1:]` if not given.
+    """
+    parser = argparse.ArgumentParser(description='Serve regional SPEI statistics, time series and map tiles over HTTP.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--data-root', default=DATA_ROOT, help='root folder of the SPEI archive')
+    parser.add_argument('--workers', type=int, default=4, help='number of computation threads')
+    parser.add_argument('--quantize-fields', action='store_true', help='cache map fields as int16 codes (twice as many fields)')
+    parser.add_argument('--recent-months', type=int, default=0, help='latest global months kept warm for every window')
+    parser.add_argument('--recent-root', default=None, help='folder of the memory-mapped copies of the recent months')
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args.port, args.address, data_root=args.data_root, workers=args.workers,
+                      quantize_fields=args.quantize_fields, recent_months=args.recent_months, recent_root=args.recent_root))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+import xarray as xr
+from utils.widgets_handler import read_json_to_dict
+from utils.data_preprocess import (DATA_ROOT, parse_file_month, list_spei_files, is_readable_nc, replace_invalid_values,
+                                   preprocess)
+from utils.drought_events import DROUGHT_THRESHOLD
+from utils.quantization import quantize, dequantize
+from utils.instrumentation import record_cache, count
+
+
+DEFAULT_RECENT_MONTHS = 12       # 7 windows x 12 global 0.25 degree fields take 350 MB in float32, 175 MB quantized
+REFRESH_INTERVAL = 300           # Seconds between two checks of the catalog for newer months
+
+
+
+class RecentMonthsCache:
+    """
+    Keeps the latest global SPEI fields of every accumulation window in memory, for current-conditions maps and
+    rankings served without reading the archive.
+
+    The catalog is checked for newer months at most every `refresh_interval` seconds when the cache is used; only
+    the new months are read, and the oldest ones are dropped. With a `cache_root`, each window is kept in a local
+    .npy file opened memory-mapped, so several processes share one copy and a restart reads only the months
+    published meanwhile.
+
+    Parameters:
+    n_months (int): Number of latest months kept per accumulation window. Defaults to 12.
+    accumulation_windows (list, optional): The accumulation windows in months (e.g. ['1', '12']); all the windows of
+                                           'accumulation_windows.json' if not given.
+    data_root (str): The root folder of the SPEI archive.
+    cache_root (str, optional): Folder of the memory-mapped copies; fields are kept in process memory if not given.
+    quantize (bool): If True, fields are kept as int16 codes (utils.quantization), halving the memory.
+    refresh_interval (float): Seconds between two checks of the catalog. Defaults to 300.
+    """
+    def __init__(self, n_months=DEFAULT_RECENT_MONTHS, accumulation_windows=None, data_root=DATA_ROOT, cache_root=None,
+                 quantize=False, refresh_interval=REFRESH_INTERVAL):
+        if n_months < 1:
+            raise ValueError("The cache must hold at least one month.")
+        self.n_months = int(n_months)
+        self.accumulation_windows = [str(window) for window in
+                                     (accumulation_windows or read_json_to_dict('accumulation_windows.json').values())]
+        self.data_root = data_root
+        self.cache_root = cache_root
+        self.quantize = quantize
+        self.refresh_interval = refresh_interval
+        self.stacks = {}
+        self.last_check = None
+        self.months_read = 0
+        self.lock = threading.RLock()
+        if cache_root:
+            for window in self.accumulation_windows:
+                saved = self.load_saved(window)
+                if saved is not None:
+                    self.stacks[window] = saved
+
+    def stack_paths(self, accumulation_window):
+        """
+        Get the memory-mapped values and the description of the months of a window.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+
+        Returns:
+        tuple: The paths of the .npy values and of the .json description.
+        """
+        stem = os.path.join(self.cache_root, f'spei{accumulation_window}_recent')
+        return stem + '.npy', stem + '.json'
+
+    def load_saved(self, accumulation_window):
+        """
+        Opens the memory-mapped copy of a window left by a previous process, if it matches the settings.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+
+        Returns:
+        xr.DataArray or None: The fields, or None if there is no usable copy.
+        """
+        values_path, description_path = self.stack_paths(accumulation_window)
+        if not (os.path.exists(values_path) and os.path.exists(description_path)):
+            return None
+        with open(description_path) as file:
+            description = json.load(file)
+        if description.get('quantized', False) != self.quantize:
+            return None
+        values = np.load(values_path, mmap_mode='r')
+        return self.make_stack(accumulation_window, values, [tuple(month) for month in description['months']],
+                               np.asarray(description['lat']), np.asarray(description['lon']), description['attrs'])
+
+    def make_stack(self, accumulation_window, values, months, lat, lon, attrs):
+        """
+        Wraps the values of the cached months of a window.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+        values (np.ndarray): The fields, of shape (month, lat, lon).
+        months (list): The (year, month) of each field.
+        lat (np.ndarray): The latitudes of the grid.
+        lon (np.ndarray): The longitudes of the grid.
+        attrs (dict): The attributes of the fields, with the quantization parameters if quantized.
+
+        Returns:
+        xr.DataArray: The fields, with the first day of each month as time.
+        """
+        times = pd.DatetimeIndex([f'{year:04d}-{month:02d}-01' for year, month in months])
+        return xr.DataArray(values, coords={'time': times, 'lat': lat, 'lon': lon}, dims=('time', 'lat', 'lon'),
+                            name=f'SPEI{accumulation_window}', attrs=attrs)
+
+    def latest_files(self, accumulation_window):
+        """
+        Lists the files of the latest months of a window in the catalog, one per month.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+
+        Returns:
+        list: (year, month) and file of the latest `n_months` months, oldest first.
+        """
+        by_month = {}
+        for file in list_spei_files(accumulation_window, data_root=self.data_root):
+            by_month.setdefault(parse_file_month(file), file)
+        months = sorted(by_month)[-self.n_months:]
+        return [(month, by_month[month]) for month in months]
+
+    def read_field(self, accumulation_window, file):
+        """
+        Reads and cleans the global field of one monthly file.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+        file (str): The monthly file.
+
+        Returns:
+        xr.DataArray: The field with NaN in place of invalid values, quantized if the cache is.
+        """
+        with xr.open_dataset(file) as ds:
+            field = ds[f'SPEI{accumulation_window}'].isel(time=0).drop_vars('time').load()
+        field, _, _ = replace_invalid_values(field)
+        field = field.astype('float32')
+        count('recent_months_read')
+        return quantize(field) if self.quantize else field
+
+    def refresh_window(self, accumulation_window) -> int:
+        """
+        Brings the fields of a window up to date with the catalog, reading only the months not yet cached.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+
+        Returns:
+        int: The number of months read from the archive.
+        """
+        wanted = self.latest_files(accumulation_window)
+        current = self.stacks.get(accumulation_window)
+        cached = {} if current is None else {(time.year, time.month): i for i, time in enumerate(pd.DatetimeIndex(current['time'].values))}
+        if not wanted or [month for month, _ in wanted] == list(cached):
+            return 0
+
+        rows, months, read, attrs, grid = [], [], 0, None, None
+        for month, file in wanted:
+            if month in cached:
+                rows.append(np.array(current.values[cached[month]]))
+                attrs, grid = current.attrs, (current['lat'].values, current['lon'].values)
+            elif is_readable_nc(file):
+                field = self.read_field(accumulation_window, file)
+                if grid is not None and (field['lat'].size, field['lon'].size) != (grid[0].size, grid[1].size):
+                    raise ValueError(f"The grid of {file} differs from the grid of the cached months.")
+                rows.append(field.values)
+                attrs, grid = field.attrs, (field['lat'].values, field['lon'].values)
+                read += 1
+            else:
+                continue
+            months.append(month)
+        if not rows or months == list(cached):
+            return 0
+        values = np.stack(rows)
+
+        if self.cache_root:
+            values = self.save(accumulation_window, values, months, grid, attrs)
+        self.stacks[accumulation_window] = self.make_stack(accumulation_window, values, months, grid[0], grid[1], attrs)
+        self.months_read += read
+        print(f"SPEI{accumulation_window}: recent months cache up to {months[-1][0]}-{months[-1][1]:02d} ({read} months read)")
+        return read
+
+    def save(self, accumulation_window, values, months, grid, attrs):
+        """
+        Writes the fields of a window to its memory-mapped copy, replacing the previous one.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+        values (np.ndarray): The fields.
+        months (list): The (year, month) of each field.
+        grid (tuple): The latitudes and longitudes of the grid.
+        attrs (dict): The attributes of the fields.
+
+        Returns:
+        np.ndarray: The fields, memory-mapped read-only.
+        """
+        os.makedirs(self.cache_root, exist_ok=True)
+        values_path, description_path = self.stack_paths(accumulation_window)
+        # Written under temporary names then renamed, so other processes never map a partial file
+        np.save(values_path + '.tmp.npy', values)
+        os.replace(values_path + '.tmp.npy', values_path)
+        description = {'months': months, 'lat': grid[0].tolist(), 'lon': grid[1].tolist(), 'quantized': self.quantize,
+                       'attrs': {key: value.item() if isinstance(value, np.generic) else value for key, value in attrs.items()
+                                 if isinstance(value, (str, int, float, np.generic))}}
+        with open(description_path + '.tmp', 'w') as file:
+            json.dump(description, file)
+        os.replace(description_path + '.tmp', description_path)
+        return np.load(values_path, mmap_mode='r')
+
+    def refresh(self, force=False) -> dict:
+        """
+        Checks the catalog for newer months if the last check is older than `refresh_interval`.
+
+        Parameters:
+        force (bool): If True, checks whatever the time of the last check.
+
+        Returns:
+        dict: The number of months read per accumulation window; empty if the check was skipped.
+        """
+        with self.lock:
+            if not force and self.last_check is not None and time.time() - self.last_check < self.refresh_interval:
+                return {}
+            self.last_check = time.time()
+            return {window: self.refresh_window(window) for window in self.accumulation_windows}
+
+    def fields(self, accumulation_window) -> xr.DataArray:
+        """
+        Get the cached fields of a window, as stored (int16 codes if the cache is quantized).
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+
+        Returns:
+        xr.DataArray: The fields with dimensions ('time', 'lat', 'lon'), oldest first.
+        """
+        accumulation_window = str(accumulation_window)
+        if accumulation_window not in self.accumulation_windows:
+            raise ValueError(f"SPEI{accumulation_window} is not kept in the recent months cache.")
+        self.refresh()
+        with self.lock:
+            if accumulation_window not in self.stacks:
+                self.refresh_window(accumulation_window)
+            if accumulation_window not in self.stacks:
+                raise ValueError(f"No readable files found for SPEI{accumulation_window}.")
+            return self.stacks[accumulation_window]
+
+    def months(self, accumulation_window) -> list:
+        """
+        Get the months held for a window.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+
+        Returns:
+        list: The (year, month) of the cached fields, oldest first.
+        """
+        return [(time.year, time.month) for time in pd.DatetimeIndex(self.fields(accumulation_window)['time'].values)]
+
+    def field(self, accumulation_window, year_month=None, decode=True) -> xr.DataArray:
+        """
+        Get the global field of one cached month.
+
+        Parameters:
+        accumulation_window (str): The accumulation window in months.
+        year_month (tuple, optional): The (year, month); the latest month if not given.
+        decode (bool): If False, quantized fields are returned as int16 codes.
+
+        Returns:
+        xr.DataArray: The field with NaN where there is no data.
+        """
+        fields = self.fields(accumulation_window)
+        months = [(time.year, time.month) for time in pd.DatetimeIndex(fields['time'].values)]
+        hit = year_month is None or tuple(year_month) in months
+        record_cache('recent_months', hit)
+        if not hit:
+            raise KeyError(f"{year_month} is not among the cached months of SPEI{accumulation_window}.")
+        field = fields.isel(time=months.index(tuple(year_month)) if year_month is not None else -1)
+        return dequantize(field) if decode else field
+
+    def rank_regions(self, region_bounds, accumulation_window, year_month=None, threshold=DROUGHT_THRESHOLD) -> pd.DataFrame:
+        """
+        Ranks regions (e.g. countries) by the current SPEI of their bounding box, driest first, from the cache only.
+
+        Parameters:
+        region_bounds (dict): Region name -> bounds (min_lon, min_lat, max_lon, max_lat), e.g. from `resolve_bounds`.
+        accumulation_window (str): The accumulation window in months.
+        year_month (tuple, optional): The (year, month); the latest month if not given.
+        threshold (float): SPEI at or below which a cell is in drought. Defaults to -1.0.
+
+        Returns:
+        pd.DataFrame: Per region, the median and mean SPEI, the share of valid cells in drought and the number of
+                      valid cells, sorted by median with a 'rank' column starting at 1.
+        """
+        field = self.field(accumulation_window, year_month)
+        rows = {}
+        for name, bounds in region_bounds.items():
+            try:
+                values = preprocess(field, bounds).values
+            except ValueError:
+                continue
+            values = values[np.isfinite(values)]
+            if values.size:
+                rows[name] = {'median': float(np.median(values)), 'mean': float(values.mean()),
+                              'drought_fraction': float((values <= threshold).mean()), 'cells': int(values.size)}
+        table = pd.DataFrame.from_dict(rows, orient='index', columns=['median', 'mean', 'drought_fraction', 'cells'])
+        table.index.name = 'region'
+        table = table.sort_values('median')
+        table.insert(0, 'rank', np.arange(1, len(table) + 1))
+        table.attrs['time'] = str(field['time'].values)[:10]
+        return table
+
+    def info(self) -> dict:
+        """
+        Get the months held per window and the number of months read since the start.
+
+        Returns:
+        dict: The latest cached month per window, the number of fields and bytes held and the months read.
+        """
+        with self.lock:
+            latest = {window: str(stack['time'].values[-1])[:7] for window, stack in self.stacks.items()}
+            fields = sum(stack.sizes['time'] for stack in self.stacks.values())
+            nbytes = sum(stack.nbytes for stack in self.stacks.values())
+        return {'latest': latest, 'fields': fields, 'bytes': int(nbytes), 'months_read': self.months_read}
+
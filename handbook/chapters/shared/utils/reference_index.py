@@ -0,0 +1,404 @@
+"""
+Virtual reference index over the monthly SPEI NetCDF files.
+
+Each file is scanned once for the byte ranges of its compressed chunks, and the chunks of all the files of an
+accumulation window are described as one Zarr array in a reference file (the format of fsspec's ReferenceFileSystem,
+as written by kerchunk). The whole record then opens as one lazy array with a single metadata read, and the data are
+still read from the original files. From the `handbook/chapters/shared` folder:
+
+    python -m utils.reference_index 1 3 12 --data-root /data1/drought_dataset/spei/
+
+builds or updates the indexes; files already indexed and unchanged are not scanned again.
+"""
+import argparse
+import base64
+import glob
+import json
+import os
+import sys
+import time
+from collections import Counter
+import h5py
+import netCDF4 as nc
+import numcodecs
+import numpy as np
+import xarray as xr
+import zarr
+from utils.chunk_planner import DEFAULT_MEMORY_BUDGET, TIME_DIMS, plan_chunks
+
+
+INDEX_ROOT = '/data1/drought_dataset/spei_index/'
+INDEX_TIME_UNITS = 'days since 1900-01-01 00:00:00'      # Common units of the time axis of the index
+INDEX_CALENDAR = 'standard'
+NETCDF_ATTRIBUTES = ('_FillValue', '_Netcdf4Coordinates', '_Netcdf4Dimid', 'DIMENSION_LIST', 'REFERENCE_LIST', 'CLASS', 'NAME')
+
+
+
+def get_index_path(accumulation_window, index_root=INDEX_ROOT):
+    """
+    Get the reference file of an accumulation window.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    index_root (str): The root folder of the indexes.
+
+    Returns:
+    str: The path of the reference file; the scanned files are recorded next to it in a '.files.json' file.
+    """
+    return os.path.join(index_root, f'spei{accumulation_window}.refs.json')
+
+
+
+def get_records_path(index_path):
+    """
+    Get the file recording the scanned files of a reference index.
+
+    Parameters:
+    index_path (str): The reference file (see `get_index_path`).
+
+    Returns:
+    str: The path of the '.files.json' records.
+    """
+    return index_path.replace('.refs.json', '') + '.files.json'
+
+
+
+def read_records(index_path):
+    """
+    Reads the records of the files scanned for a reference index.
+
+    Parameters:
+    index_path (str): The reference file.
+
+    Returns:
+    dict: path -> file record from `scan_nc_file`; empty if the index was never built.
+    """
+    records_path = get_records_path(index_path)
+    if not os.path.exists(records_path):
+        return {}
+    with open(records_path) as file:
+        return {entry['path']: entry for entry in json.load(file)}
+
+
+
+def file_layout(entry):
+    """
+    Get what the files of an index must share: grid, dimensions, data type, chunks and compression.
+
+    Parameters:
+    entry (dict): A file record from `scan_nc_file`.
+
+    Returns:
+    str: The layout, as a string that can be counted and compared.
+    """
+    return json.dumps([entry['lat'], entry['lon'], entry['dims'], entry['dtype'], entry['chunks'], entry['codecs']])
+
+
+
+def changed_indexed_files(index_path, year_months=None):
+    """
+    Finds the indexed files that were changed or removed since they were scanned, whose byte ranges are stale.
+
+    Parameters:
+    index_path (str): The reference file.
+    year_months (set, optional): (year, month) tuples; only the files holding these months are checked.
+
+    Returns:
+    list: The paths of the changed or removed files.
+    """
+    changed = []
+    for path, entry in read_records(index_path).items():
+        if year_months is not None:
+            dates = nc.num2date(entry['times'], INDEX_TIME_UNITS, INDEX_CALENDAR)
+            if not {(date.year, date.month) for date in dates} & set(year_months):
+                continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            changed.append(path)
+            continue
+        if entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            changed.append(path)
+    return changed
+
+
+
+def scan_nc_file(file_path, variable):
+    """
+    Records the layout of one NetCDF4 file: its time stamps, grid, and the byte range of every chunk of a variable.
+
+    Contiguous variables are described as one chunk per time step, which is how they are laid out on disk.
+
+    Parameters:
+    file_path (str): The path of the NetCDF4 (HDF5) file.
+    variable (str): The variable to index (e.g. 'SPEI12').
+
+    Returns:
+    dict: The file record (path, size, mtime, times in INDEX_TIME_UNITS, lat, lon, dims, dtype, chunks, codecs,
+          attributes and the [chunk index, byte offset, byte size] of every chunk).
+
+    Raises:
+    ValueError: If the file uses a feature the index cannot describe (checksums, partially filtered chunks,
+                other compression than zlib, or chunks longer than one time step).
+    """
+    with nc.Dataset(file_path, 'r') as dataset:
+        var = dataset.variables[variable]
+        dims = tuple(var.dimensions)
+        time_var = dataset.variables[dims[0]]
+        dates = nc.num2date(time_var[:], time_var.units, getattr(time_var, 'calendar', 'standard'))
+        times = nc.date2num(dates, INDEX_TIME_UNITS, INDEX_CALENDAR)
+        lat = dataset.variables[dims[1]][:].data
+        lon = dataset.variables[dims[2]][:].data
+        attrs = {name: var.getncattr(name) for name in var.ncattrs() if name not in NETCDF_ATTRIBUTES}
+        fill_value = var.getncattr('_FillValue') if '_FillValue' in var.ncattrs() else None
+
+    with h5py.File(file_path, 'r') as file:
+        dset = file[variable]
+        if dset.fletcher32 or dset.scaleoffset or dset.compression not in (None, 'gzip'):
+            raise ValueError(f"Unsupported HDF5 filters in {file_path}.")
+        if dset.chunks is None:
+            step_bytes = dset.dtype.itemsize * int(np.prod(dset.shape[1:]))
+            offset = dset.id.get_offset()
+            chunks = (1,) + dset.shape[1:]
+            refs = [[[t, 0, 0], offset + t * step_bytes, step_bytes] for t in range(dset.shape[0])] if offset is not None else []
+            codecs = {'compressor': None, 'filters': None}
+        else:
+            if dset.chunks[0] != 1:
+                raise ValueError(f"Time chunks longer than one step cannot be concatenated: {file_path}.")
+            chunks = dset.chunks
+            refs = []
+            for index in range(dset.id.get_num_chunks()):
+                info = dset.id.get_chunk_info(index)
+                if info.filter_mask:
+                    raise ValueError(f"Chunks stored with skipped filters are not supported: {file_path}.")
+                refs.append([[offset // size for offset, size in zip(info.chunk_offset, dset.chunks)], info.byte_offset, info.size])
+            codecs = {
+                'compressor': {'id': 'zlib', 'level': int(dset.compression_opts)} if dset.compression == 'gzip' else None,
+                'filters': [{'id': 'shuffle', 'elementsize': dset.dtype.itemsize}] if dset.shuffle else None,
+            }
+        dtype = dset.dtype.newbyteorder('<') if dset.dtype.byteorder == '=' else dset.dtype
+
+    stat = os.stat(file_path)
+    return {
+        'path': os.path.abspath(file_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'times': [float(t) for t in np.atleast_1d(times)],
+        'lat': lat.tolist(),
+        'lon': lon.tolist(),
+        'dims': list(dims),
+        'dtype': dtype.str,
+        'chunks': list(chunks),
+        'codecs': codecs,
+        'fill_value': None if fill_value is None else float(fill_value),
+        'attrs': {name: value.item() if isinstance(value, np.generic) else value for name, value in attrs.items()},
+        'refs': refs,
+    }
+
+
+
+def inline_array(refs, name, values, dims, attrs):
+    """
+    Stores a small uncompressed array (a coordinate) directly in the references.
+
+    Parameters:
+    refs (dict): The references being built.
+    name (str): The array name.
+    values (np.ndarray): The values.
+    dims (list): The dimension names.
+    attrs (dict): The attributes.
+    """
+    store = {}
+    array = zarr.open_array(store, mode='w', shape=values.shape, chunks=values.shape, dtype=values.dtype, compressor=None,
+                            fill_value=None)
+    array[...] = values
+    for key, value in store.items():
+        refs[f'{name}/{key}'] = value.decode() if key.startswith('.') else 'base64:' + base64.b64encode(value).decode()
+    refs[f'{name}/.zattrs'] = json.dumps({**attrs, '_ARRAY_DIMENSIONS': list(dims)})
+
+
+
+def build_references(entries, variable):
+    """
+    Describes the files of an accumulation window as one Zarr group, concatenated along time in date order.
+
+    Parameters:
+    entries (list): File records from `scan_nc_file`, all on the same grid and with the same chunks and codecs.
+    variable (str): The indexed variable.
+
+    Returns:
+    dict: The references (version 1 of the fsspec reference format).
+    """
+    entries = sorted(entries, key=lambda entry: entry['times'][0])
+    first = entries[0]
+    times = np.array([t for entry in entries for t in entry['times']])
+    shape = (times.size, len(first['lat']), len(first['lon']))
+    time_dim, lat_dim, lon_dim = first['dims']
+
+    store = {}
+    codecs = first['codecs']
+    zarr.open_array(
+        store, mode='w', shape=shape, chunks=first['chunks'], dtype=first['dtype'], fill_value=first['fill_value'],
+        compressor=numcodecs.get_codec(codecs['compressor']) if codecs['compressor'] else None,
+        filters=[numcodecs.get_codec(codec) for codec in codecs['filters']] if codecs['filters'] else None,
+    )
+    refs = {'.zgroup': json.dumps({'zarr_format': 2}), f'{variable}/.zarray': store['.zarray'].decode()}
+    refs[f'{variable}/.zattrs'] = json.dumps({**first['attrs'], '_ARRAY_DIMENSIONS': first['dims']})
+
+    position = 0
+    for entry in entries:
+        for (t, i, j), offset, size in entry['refs']:
+            refs[f'{variable}/{position + t}.{i}.{j}'] = [entry['path'], offset, size]
+        position += len(entry['times'])
+
+    inline_array(refs, time_dim, times, [time_dim], {'units': INDEX_TIME_UNITS, 'calendar': INDEX_CALENDAR})
+    inline_array(refs, lat_dim, np.array(first['lat']), [lat_dim], {'units': 'degrees_north'})
+    inline_array(refs, lon_dim, np.array(first['lon']), [lon_dim], {'units': 'degrees_east'})
+    return {'version': 1, 'refs': refs}
+
+
+
+def build_reference_index(files, index_path, variable):
+    """
+    Builds or incrementally updates the reference index of a set of monthly files.
+
+    Files already recorded with the same size and modification time are not scanned again; new and changed files
+    are scanned, removed files are dropped, and the references are rewritten from the records. Files whose grid,
+    chunks or compression differ from those of most files are left out.
+
+    Parameters:
+    files (list): The NetCDF files of one accumulation window.
+    index_path (str): The reference file to write (see `get_index_path`).
+    variable (str): The variable to index (e.g. 'SPEI12').
+
+    Returns:
+    dict: The number of indexed, scanned, removed and skipped files, and the elapsed time.
+    """
+    start_time = time.perf_counter()
+    records_path = get_records_path(index_path)
+    records = read_records(index_path)
+    # On a tie, the files keep the layout of the index already built
+    previous = Counter(file_layout(entry) for entry in records.values())
+
+    files = [os.path.abspath(file) for file in files]
+    removed = set(records) - set(files)
+    for path in removed:
+        del records[path]
+    scanned = skipped = 0
+    for path in files:
+        stat = os.stat(path)
+        entry = records.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+        try:
+            records[path] = scan_nc_file(path, variable)
+            scanned += 1
+        except (OSError, KeyError, ValueError) as error:
+            print(f"Warning: Skipping {path}: {error}")
+            records.pop(path, None)
+            skipped += 1
+
+    entries = list(records.values())
+    if not entries:
+        raise ValueError("No indexable NetCDF files found.")
+    # The index keeps the layout most files share, so one differently written file cannot exclude all the others
+    counts = Counter(file_layout(entry) for entry in entries)
+    reference = max(counts, key=lambda layout: (counts[layout], previous[layout]))
+    mismatched = [entry['path'] for entry in entries if file_layout(entry) != reference]
+    for path in mismatched:
+        print(f"Warning: {path} does not share the grid, chunks or compression of the other files; it is left out of the index.")
+        del records[path]
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    with open(index_path, 'w') as file:
+        json.dump(build_references(list(records.values()), variable), file)
+    with open(records_path, 'w') as file:
+        json.dump(list(records.values()), file)
+    return {'files': len(records), 'scanned': scanned, 'removed': len(removed), 'skipped': skipped + len(mismatched),
+            'seconds': time.perf_counter() - start_time}
+
+
+
+def open_reference_index(index_path):
+    """
+    Opens the record indexed by a reference file as one lazily indexed dataset, without dask.
+
+    Selections (months, region) are applied to the lazy arrays before anything is read; the result is then chunked
+    with `chunk_indexed_dataset`.
+
+    Parameters:
+    index_path (str): The reference file.
+
+    Returns:
+    xarray.Dataset: The dataset.
+    """
+    return xr.open_dataset('reference://', engine='zarr', chunks=None,
+                           backend_kwargs={'consolidated': False, 'storage_options': {'fo': index_path}})
+
+
+
+def chunk_indexed_dataset(ds: xr.Dataset, query='map', memory_budget=DEFAULT_MEMORY_BUDGET) -> xr.Dataset:
+    """
+    Chunks a (selected) indexed dataset with dask, in whole multiples of the chunks of the files.
+
+    Parameters:
+    ds (xarray.Dataset): The dataset from `open_reference_index`, possibly subset.
+    query (str): 'map' or 'timeseries', the access pattern the chunks are planned for. Defaults to 'map'.
+    memory_budget (float): Largest size of a chunk, in bytes. Defaults to 64 MB.
+
+    Returns:
+    xarray.Dataset: The dask-backed dataset.
+    """
+    chunks = {}
+    for var in ds.data_vars.values():
+        if var.ndim and var.dims[0] in TIME_DIMS:
+            storage_chunks = var.encoding.get('chunks') or var.shape
+            chunks.update(plan_chunks(var.dims, var.shape, storage_chunks, var.dtype.itemsize, query, memory_budget))
+    return ds.chunk(chunks)
+
+
+
+def select_months(ds: xr.Dataset, year_months) -> xr.Dataset:
+    """
+    Selects the time steps of given months from an indexed dataset, keeping duplicated time steps.
+
+    Parameters:
+    ds (xarray.Dataset): The dataset from `open_reference_index`.
+    year_months (list): (year, month) tuples, e.g. from `parse_file_month`.
+
+    Returns:
+    xarray.Dataset: The selected time steps.
+    """
+    wanted = {year * 100 + month for year, month in year_months}
+    keys = ds['time'].dt.year.values * 100 + ds['time'].dt.month.values
+    return ds.isel(time=np.flatnonzero(np.isin(keys, list(wanted))))
+
+
+
+def main(argv=None):
+    """
+    Command line entry point: builds or updates the indexes of accumulation windows.
+
+    Parameters:
+    argv (list, optional): The command line arguments; `sys.argv[1:]` if not given.
+
+    Returns:
+    int: The exit code.
+    """
+    parser = argparse.ArgumentParser(description='Build or update the reference indexes of the SPEI archive.')
+    parser.add_argument('accumulation_windows', nargs='+', help='accumulation windows in months (e.g. 1 3 12)')
+    parser.add_argument('--data-root', default='/data1/drought_dataset/spei/', help='root folder of the SPEI archive')
+    parser.add_argument('--index-root', default=INDEX_ROOT, help='folder where the indexes are written')
+    args = parser.parse_args(argv)
+
+    for window in args.accumulation_windows:
+        files = sorted(glob.glob(os.path.join(args.data_root, f'spei{window}', f'SPEI{window}_*.nc')))
+        summary = build_reference_index(files, get_index_path(window, args.index_root), f'SPEI{window}')
+        print(f"SPEI{window}: {summary['files']} files indexed ({summary['scanned']} scanned, {summary['removed']} removed, "
+              f"{summary['skipped']} skipped) in {summary['seconds']:.1f} s")
+    return 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,443 @@
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+import xarray as xr
+import time
+import dask
+from utils.data_preprocess import (DATA_ROOT, parse_file_month, list_spei_files, filter_valid_nc_files, load_and_preprocess_dataset, process_datarray)
+from utils.chunk_planner import plan_chunks_for_files
+
+
+REFERENCE_PERIOD = ('1991', '2020')    # Same reference period as the ERA5-Drought files
+CLIMATOLOGY_ROOT = '/data1/drought_dataset/spei_climatology/'
+
+
+
+def rolling_sum(data: xr.DataArray, window: int, dim: str = 'time') -> xr.DataArray:
+    """
+    Computes the sum over trailing windows of `window` steps with cumulative sums, so the cost does not depend on the
+    window length. A window containing a missing value is missing, as are the first `window - 1` steps.
+
+    Parameters:
+    data (xr.DataArray): The monthly values to accumulate. Dask-backed arrays stay lazy.
+    window (int): The number of months in each window.
+    dim (str): The dimension to accumulate along. Defaults to 'time'.
+
+    Returns:
+    xr.DataArray: The accumulated values, aligned on the last month of each window.
+    """
+    if window < 1:
+        raise ValueError("The accumulation window must be at least 1 month.")
+    missing = data.isnull()
+    totals = data.fillna(0).cumsum(dim)
+    missing_counts = missing.astype('int32').cumsum(dim)
+    windowed = totals - totals.shift({dim: window}, fill_value=0)
+    windowed_missing = missing_counts - missing_counts.shift({dim: window}, fill_value=0)
+    complete = (windowed_missing == 0) & (xr.DataArray(np.arange(data.sizes[dim]), dims=dim) >= window - 1)
+    return windowed.where(complete)
+
+
+
+def fill_missing_months(data: xr.DataArray) -> xr.DataArray:
+    """
+    Puts monthly values on a complete monthly time axis, with missing values for the months absent from the input
+    (e.g. a file missing from the archive or left out as unreadable). `rolling_sum` windows by position, so without
+    this a window would silently sum across the gap.
+
+    Parameters:
+    data (xr.DataArray): The monthly values with a datetime 'time' dimension, at most one value per month.
+
+    Returns:
+    xr.DataArray: The values on every month from the first to the last, time stamped on the first day of the month.
+    """
+    months = data['time'].values.astype('datetime64[M]')
+    full = np.arange(months.min(), months.max() + 1)
+    missing = full.size - np.unique(months).size
+    if missing:
+        print(f"Warning: {missing} months are missing from the base series; the accumulations over them are missing.")
+    data = data.assign_coords(time=months.astype('datetime64[ns]'))
+    if not missing:
+        return data
+    return data.reindex(time=full.astype('datetime64[ns]'))
+
+
+
+def standardise_by_calendar_month(data: xr.DataArray, reference_period: tuple = REFERENCE_PERIOD, climatology: tuple = None) -> xr.DataArray:
+    """
+    Standardises values per calendar month against the mean and standard deviation of a reference period.
+
+    Parameters:
+    data (xr.DataArray): The values to standardise, with a datetime 'time' dimension.
+    reference_period (tuple): The first and last year of the reference period. Defaults to 1991-2020.
+    climatology (tuple, optional): Precomputed (mean, std) DataArrays with a 'month' dimension, e.g. returned by
+                                   `compute_monthly_climatology`. When given, `reference_period` is ignored.
+
+    Returns:
+    xr.DataArray: The standardised anomalies.
+    """
+    if climatology is None:
+        climatology = compute_monthly_climatology(data, reference_period)
+    mean, std = climatology
+    calendar_months = data['time'].dt.month
+    return ((data - mean.sel(month=calendar_months)) / std.sel(month=calendar_months)).drop_vars('month')
+
+
+
+def compute_monthly_climatology(data: xr.DataArray, reference_period: tuple = REFERENCE_PERIOD) -> tuple:
+    """
+    Computes the per-calendar-month mean and standard deviation over a reference period.
+
+    Parameters:
+    data (xr.DataArray): The values, with a datetime 'time' dimension covering the reference period.
+    reference_period (tuple): The first and last year of the reference period.
+
+    Returns:
+    tuple: The (mean, std) DataArrays with a 'month' dimension.
+    """
+    reference = data.sel(time=slice(str(reference_period[0]), str(reference_period[1])))
+    if reference.sizes['time'] == 0:
+        raise ValueError(f"No data available in the reference period {reference_period[0]}-{reference_period[1]}.")
+    grouped = reference.groupby('time.month')
+    return grouped.mean('time'), grouped.std('time')
+
+
+
+def get_climatology_path(window, base_accumulation_window='1', climatology_root=CLIMATOLOGY_ROOT):
+    """
+    Get the file holding the saved climatology of the N-month accumulations of a base accumulation window.
+
+    Parameters:
+    window (int): The accumulation window in months.
+    base_accumulation_window (str): The accumulation window of the base tree. Defaults to '1'.
+    climatology_root (str): The root folder of the saved climatologies.
+
+    Returns:
+    str: The path of the file.
+    """
+    return os.path.join(climatology_root, f'spei{base_accumulation_window}_rolling{int(window)}_climatology.nc')
+
+
+
+def list_climatologies(base_accumulation_window='1', climatology_root=CLIMATOLOGY_ROOT) -> list:
+    """
+    List the windows whose climatology is saved for a base accumulation window.
+
+    Parameters:
+    base_accumulation_window (str): The accumulation window of the base tree.
+    climatology_root (str): The root folder of the saved climatologies.
+
+    Returns:
+    list: The accumulation windows in months, sorted.
+    """
+    pattern = os.path.join(climatology_root, f'spei{base_accumulation_window}_rolling*_climatology.nc')
+    windows = [os.path.basename(path).split('_rolling')[1].split('_')[0] for path in glob.glob(pattern)]
+    return sorted(int(window) for window in windows if window.isdigit())
+
+
+
+def load_climatology(window, base_accumulation_window='1', reference_period=REFERENCE_PERIOD,
+                     climatology_root=CLIMATOLOGY_ROOT) -> tuple:
+    """
+    Loads the climatology saved by `update_climatology`.
+
+    Parameters:
+    window (int): The accumulation window in months.
+    base_accumulation_window (str): The accumulation window of the base tree. Defaults to '1'.
+    reference_period (tuple): The reference period the climatology must have been computed over.
+    climatology_root (str): The root folder of the saved climatologies.
+
+    Returns:
+    tuple or None: The (mean, std) DataArrays with dimensions ('month', 'lat', 'lon'), as `compute_monthly_climatology`,
+                   or None if no climatology is saved for this window and reference period.
+    """
+    path = get_climatology_path(window, base_accumulation_window, climatology_root)
+    if not os.path.exists(path):
+        return None
+    with xr.open_dataset(path) as ds:
+        if ds.attrs.get('reference_period') != f'{reference_period[0]}-{reference_period[1]}':
+            return None
+        ds = ds.load()
+    return ds['mean'], ds['std']
+
+
+
+def window_source_months(window, calendar_month, reference_period, available) -> list:
+    """
+    List the base months whose values enter the N-month accumulations of a calendar month over the reference period.
+
+    Parameters:
+    window (int): The accumulation window in months.
+    calendar_month (int): The calendar month (1-12).
+    reference_period (tuple): The first and last year of the reference period.
+    available (set): The (year, month) tuples of the base files.
+
+    Returns:
+    list: The available source months, as sorted 'YYYYMM' strings.
+    """
+    used = set()
+    for year in range(int(reference_period[0]), int(reference_period[1]) + 1):
+        for lag in range(int(window)):
+            source = divmod(year * 12 + calendar_month - 1 - lag, 12)
+            if (source[0], source[1] + 1) in available:
+                used.add(f'{source[0]:04d}{source[1] + 1:02d}')
+    return sorted(used)
+
+
+
+def update_climatology(window, base_accumulation_window='1', calendar_months=None, reference_period=REFERENCE_PERIOD,
+                       data_root=DATA_ROOT, climatology_root=CLIMATOLOGY_ROOT) -> list:
+    """
+    Saves (or brings up to date) the per-calendar-month mean and standard deviation of the N-month accumulations of
+    a base accumulation window over the reference period, the climatology `get_rolling_xarray_data` standardises
+    with. With a saved climatology, a query reads only its own period instead of the whole reference period.
+
+    The base months entering the accumulations of each calendar month are recorded, so a calendar month is
+    recomputed when those months change in number; months published after the reference period leave it unchanged.
+    Calling it again with nothing new does nothing.
+
+    Parameters:
+    window (int): The accumulation window in months.
+    base_accumulation_window (str): The accumulation window of the base tree. Defaults to '1'.
+    calendar_months (list, optional): Calendar months (1-12) to recompute in any case, e.g. those of rewritten files.
+    reference_period (tuple): The first and last year of the reference period.
+    data_root (str): The root folder of the SPEI archive.
+    climatology_root (str): The root folder of the saved climatologies.
+
+    Returns:
+    list: The calendar months recomputed.
+    """
+    variable = f'SPEI{base_accumulation_window}'
+    path = get_climatology_path(window, base_accumulation_window, climatology_root)
+    # The first accumulations of the reference period also use the months preceding it
+    history_years = int(np.ceil((int(window) - 1) / 12))
+    files = filter_valid_nc_files(list_spei_files(base_accumulation_window, int(reference_period[0]) - history_years,
+                                                  reference_period[1], data_root))
+    if not files:
+        raise ValueError(f"No readable files of {variable} in the reference period {reference_period[0]}-{reference_period[1]}.")
+    available = set(map(parse_file_month, files))
+    used = {str(month): window_source_months(window, month, reference_period, available) for month in range(1, 13)}
+
+    existing = None
+    if os.path.exists(path):
+        with xr.open_dataset(path) as ds:
+            existing = ds.load()
+    sources = json.loads(existing.attrs['source_months']) if existing is not None else {}
+    stale = {month for month in range(1, 13) if used[str(month)] != sources.get(str(month))}
+    pending = sorted((stale | set(calendar_months or [])) & {month for month in range(1, 13) if used[str(month)]})
+    if not pending:
+        return []
+
+    with xr.open_mfdataset(files, concat_dim='time', combine='nested', chunks=plan_chunks_for_files(files)) as ds:
+        base, _ = process_datarray(ds[variable])
+        # Whole time series in bands of latitudes, so the cumulative sums stay within one chunk
+        accumulated = rolling_sum(fill_missing_months(base.sortby('time')).chunk({'time': -1, 'lat': 32}), int(window))
+        accumulated = accumulated.isel(time=np.flatnonzero(np.isin(accumulated['time'].dt.month.values, pending)))
+        means, stds = dask.compute(*compute_monthly_climatology(accumulated, reference_period))
+    print(f"{variable}: climatology of the {window}-month accumulations recomputed for months {pending}")
+
+    template = means.isel(month=0, drop=True)
+    mean = existing['mean'] if existing is not None else xr.full_like(template, np.nan).expand_dims(month=np.arange(1, 13)).copy()
+    std = existing['std'] if existing is not None else mean.copy()
+    for month in pending:
+        mean.loc[{'month': month}] = means.sel(month=month)
+        std.loc[{'month': month}] = stds.sel(month=month)
+
+    climatology = xr.Dataset({'mean': mean, 'std': std}, attrs={
+        'window': int(window),
+        'base_accumulation_window': str(base_accumulation_window),
+        'reference_period': f'{reference_period[0]}-{reference_period[1]}',
+        'source_months': json.dumps({month: used[month] if int(month) in pending else sources[month]
+                                     for month in used if int(month) in pending or month in sources}),
+    })
+    os.makedirs(climatology_root, exist_ok=True)
+    # Written next to the previous file then renamed, so an interrupted update leaves the previous one intact
+    climatology.to_netcdf(path + '.tmp', engine='netcdf4')
+    os.replace(path + '.tmp', path)
+    return pending
+
+
+
+def derive_accumulated_anomaly(base: xr.DataArray, window: int, reference_period: tuple = REFERENCE_PERIOD,
+                               climatology: tuple = None) -> xr.DataArray:
+    """
+    Derives an N-month standardised water-balance anomaly from a monthly base cube.
+
+    The base cube is accumulated over trailing windows of `window` months and standardised per calendar month.
+    With a climatic water balance (precipitation minus potential evapotranspiration) as base, this is a
+    normal-distribution approximation of SPEI-N; with SPEI1 as base, it is the standardised sum of the monthly
+    anomalies. Both are close to, but not identical with, the generalised-logistic SPEI-N of the archive.
+
+    Parameters:
+    base (xr.DataArray): The monthly base values with a datetime 'time' dimension; missing months are filled with
+                         missing values (see `fill_missing_months`).
+    window (int): The accumulation window in months, any positive integer.
+    reference_period (tuple): The first and last year of the reference period. Defaults to 1991-2020.
+    climatology (tuple, optional): Precomputed (mean, std) of the accumulated values per calendar month.
+
+    Returns:
+    xr.DataArray: The standardised accumulated anomalies.
+    """
+    base = fill_missing_months(base.sortby('time'))
+    if base.chunks is not None:
+        base = base.chunk({'time': -1})
+    accumulated = rolling_sum(base, int(window))
+    anomaly = standardise_by_calendar_month(accumulated, reference_period, climatology)
+    return anomaly.rename(f'SPEI{window}')
+
+
+
+def select_year_months(btn_name, selectors, placeholders, months, year_months):
+    """
+    Keeps the (year, month) pairs of an archive listing that match the widget selection, following the same rules as
+    `generate_file_patterns` without globbing the archive again.
+
+    Parameters:
+    btn_name (str): Button name to determine the type of data fetching.
+    selectors (dict): Dictionary containing widget selectors.
+    placeholders (dict): Placeholder values for widgets.
+    months (dict): Dictionary of month abbreviations to numbers.
+    year_months (iterable): The (year, month) pairs available in the archive.
+
+    Returns:
+    list: The selected (year, month) pairs, sorted.
+    """
+    selected_months = {int(month) for month in months.values()}
+    if btn_name == 'year_range_widgets_btn':
+        start_year, end_year = map(int, selectors['year_range'].value)
+        keep = lambda year, month: start_year <= year <= end_year and month in selected_months
+    elif btn_name == 'accumulation_windows_widgets_btn':
+        start_year, end_year = map(int, selectors['twenty_years'].value.split('-'))
+        keep = lambda year, month: start_year <= year <= end_year and month in selected_months
+    else:
+        selected_month = int(months[selectors['month'].value]) if selectors['month'].value != placeholders['month'] else None
+        selected_year = int(selectors['year'].value) if selectors['year'].value != placeholders['year'] else None
+        keep = lambda year, month: (selected_year is None or year == selected_year) and (selected_month is None or month == selected_month)
+    return sorted(year_month for year_month in year_months if keep(*year_month))
+
+
+
+def get_rolling_xarray_data(btn_name, bounds, selectors, placeholders, months, window, base_accumulation_window='1',
+                            reference_period=REFERENCE_PERIOD, data_root=DATA_ROOT, climatology_root=CLIMATOLOGY_ROOT):
+    """
+    On-the-fly counterpart of `get_xarray_data`: serves an arbitrary N-month window from the base accumulation
+    window tree instead of a precomputed `spei{N}` tree.
+
+    The base files are read for the selected period, the `window - 1` months preceding it and, unless the climatology
+    of the window was saved with `update_climatology`, the reference period; then the anomalies are derived with
+    `derive_accumulated_anomaly` and the selected months are returned.
+
+    Parameters:
+    btn_name (str): Button name to determine the type of data fetching.
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    selectors (dict): Dictionary containing widget selectors.
+    placeholders (dict): Placeholder values for widgets.
+    months (dict): Dictionary of month abbreviations to numbers.
+    window (int): The accumulation window in months.
+    base_accumulation_window (str): The accumulation window of the base tree. Defaults to '1'.
+    reference_period (tuple): The first and last year of the reference period.
+    data_root (str): The root folder of the SPEI archive.
+    climatology_root (str, optional): The root folder of the saved climatologies; None to always compute it.
+
+    Returns:
+    xarray.Dataset or None: A dataset with a single `SPEI{window}` variable, or None if no readable files are found.
+    """
+    # One listing of the base tree serves both the selection and the extended read
+    archive_files = {parse_file_month(file): file for file in list_spei_files(base_accumulation_window, data_root=data_root)}
+    requested_months = select_year_months(btn_name, selectors, placeholders, months, archive_files)
+    if not requested_months:
+        print("No readable NetCDF files found.")
+        return None
+
+    # Extend the read to the months needed by the first window and, without a saved climatology, to the reference period
+    climatology = None
+    if climatology_root is not None:
+        climatology = load_climatology(window, base_accumulation_window, reference_period, climatology_root)
+    history_years = int(np.ceil((int(window) - 1) / 12))
+    start_year = requested_months[0][0] - history_years
+    end_year = requested_months[-1][0]
+    if climatology is None:
+        start_year = min(start_year, int(reference_period[0]) - history_years)
+        end_year = max(end_year, int(reference_period[1]))
+
+    try:
+        valid_files = filter_valid_nc_files([file for (year, _), file in sorted(archive_files.items()) if start_year <= year <= end_year])
+        if not valid_files:
+            print("No readable NetCDF files found.")
+            return None
+        base = load_and_preprocess_dataset(valid_files, bounds)[f'SPEI{base_accumulation_window}']
+        base, _ = process_datarray(base)
+        # One chunk along time keeps the cumulative sums from spanning hundreds of one-month chunks
+        base = base.sortby('time').chunk({'time': -1})
+
+        if climatology is not None:
+            climatology = tuple(part.sel(lat=base['lat'], lon=base['lon'], method='nearest')
+                                .assign_coords(lat=base['lat'], lon=base['lon']) for part in climatology)
+        anomaly = derive_accumulated_anomaly(base, window, reference_period, climatology)
+        requested_times = pd.DatetimeIndex(anomaly['time'].values)
+        requested = set(requested_months)
+        keep = [(t.year, t.month) in requested for t in requested_times]
+        return anomaly.isel(time=np.flatnonzero(keep)).to_dataset()
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return None
+
+
+
+def benchmark_rolling_window(bounds, window, start_year, end_year, base_accumulation_window='1', repeat=3,
+                             reference_period=REFERENCE_PERIOD, data_root=DATA_ROOT) -> dict:
+    """
+    Times reading a precomputed `spei{window}` tree against deriving the same window on the fly from the base tree,
+    and reports how close the two results are.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    window (int): An accumulation window available as a precomputed tree (e.g. 12).
+    start_year (int): First year of the period.
+    end_year (int): Last year of the period.
+    base_accumulation_window (str): The accumulation window of the base tree. Defaults to '1'.
+    repeat (int): Number of timed repetitions; the best time is kept. Defaults to 3.
+    reference_period (tuple): The first and last year of the reference period.
+    data_root (str): The root folder of the SPEI archive.
+
+    Returns:
+    dict: A dictionary containing:
+        - precomputed_seconds (float): Best time to load and clean the precomputed window.
+        - rolling_seconds (float): Best time to derive the window from the base tree.
+        - correlation (float): Pearson correlation between the two results over the period.
+        - max_abs_difference (float): Largest absolute difference between the two results.
+    """
+    def load_precomputed():
+        files = filter_valid_nc_files(list_spei_files(str(window), start_year, end_year, data_root))
+        data, _ = process_datarray(load_and_preprocess_dataset(files, bounds)[f'SPEI{window}'])
+        return data.sortby('time').load()
+
+    def load_rolling():
+        history_years = int(np.ceil((int(window) - 1) / 12))
+        files = filter_valid_nc_files(list_spei_files(base_accumulation_window, min(start_year - history_years, int(reference_period[0])),
+                                                      max(end_year, int(reference_period[1])), data_root))
+        base, _ = process_datarray(load_and_preprocess_dataset(files, bounds)[f'SPEI{base_accumulation_window}'])
+        anomaly = derive_accumulated_anomaly(base.sortby('time').chunk({'time': -1}), window, reference_period)
+        return anomaly.sel(time=slice(str(start_year), str(end_year))).load()
+
+    timings = {}
+    results = {}
+    for name, loader in [('precomputed', load_precomputed), ('rolling', load_rolling)]:
+        best = np.inf
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            results[name] = loader()
+            best = min(best, time.perf_counter() - start_time)
+        timings[name] = best
+
+    precomputed, rolling = xr.align(results['precomputed'], results['rolling'])
+    valid = np.isfinite(precomputed.values) & np.isfinite(rolling.values)
+    correlation = float(np.corrcoef(precomputed.values[valid], rolling.values[valid])[0, 1]) if valid.sum() > 1 else np.nan
+    difference = float(np.abs(precomputed.values[valid] - rolling.values[valid]).max()) if valid.any() else np.nan
+    return {
+        'precomputed_seconds': timings['precomputed'],
+        'rolling_seconds': timings['rolling'],
+        'correlation': correlation,
+        'max_abs_difference': difference,
+    }
@@ -0,0 +1,420 @@
+import os
+import time
+import numpy as np
+import xarray as xr
+import dask.array as da
+import zarr
+from utils.data_preprocess import (DATA_ROOT, parse_file_month, list_spei_files, filter_valid_nc_files, preprocess,
+                                   load_and_preprocess_dataset, process_datarray)
+from utils.coordinates_retrieve import generate_coordinate_values, split_bounding_box
+from utils.chunk_planner import read_storage_layout, plan_chunks_for_files
+from utils.quantization import quantized_encoding, clip_to_limit, store_is_quantized, open_store
+
+
+TIME_STORE_ROOT = '/data1/drought_dataset/spei_timeseries/'
+TIME_CHUNK = 1200               # Months per chunk: a century of a cell is read at once
+SPACE_CHUNK = 16                # Cells along each side of a chunk (4 x 4 degrees)
+BAND_ROWS = 64                  # Latitude rows read from the monthly files at once while building the store
+FILE_OPEN_COST_BYTES = 2e6      # Cost of opening a file, counted as the bytes that could be read meanwhile
+CHUNK_READ_COST_BYTES = 2e5     # Cost of locating and decompressing one chunk besides its bytes
+
+
+
+def get_time_store_path(accumulation_window, store_root=TIME_STORE_ROOT):
+    """
+    Get the time-contiguous Zarr store of an accumulation window.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    str: The path of the store.
+    """
+    return os.path.join(store_root, f'spei{accumulation_window}_timeseries.zarr')
+
+
+
+def set_store_attrs(store_path, **attrs):
+    """
+    Updates attributes of a Zarr store and its consolidated metadata, which `xr.open_zarr` reads.
+
+    Parameters:
+    store_path (str): The path of the store.
+    attrs: The attributes to set.
+    """
+    zarr.open_group(store_path, mode='r+').attrs.update(attrs)
+    zarr.consolidate_metadata(store_path)
+
+
+
+def merge_row_ranges(ranges) -> list:
+    """
+    Merges overlapping or adjacent ranges of latitude rows.
+
+    Parameters:
+    ranges (list): (start, stop) ranges of rows.
+
+    Returns:
+    list: The merged ranges, in order.
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+
+def rows_completed(completed, start, stop) -> bool:
+    """
+    Check whether rows start to stop (excluded) all lie in the ranges already written.
+
+    Parameters:
+    completed (list): The merged (start, stop) ranges written.
+    start (int): First row.
+    stop (int): Row after the last one.
+
+    Returns:
+    bool: True if every row is written.
+    """
+    return any(done_start <= start and stop <= done_stop for done_start, done_stop in completed)
+
+
+
+def build_time_store(accumulation_window, start_year=None, end_year=None, data_root=DATA_ROOT, store_root=TIME_STORE_ROOT,
+                     band_rows=BAND_ROWS, quantize=False):
+    """
+    Builds the time-contiguous copy of the cleaned monthly files of an accumulation window, in chunks of
+    TIME_CHUNK months by SPACE_CHUNK x SPACE_CHUNK cells.
+
+    The files are read one band of latitudes at a time, so memory stays bounded by one band of the whole record.
+    The rows written are recorded in the store with its files, so an interrupted build over the same files
+    resumes where it stopped. Months added to the archive later are appended with `update_time_store`.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months (e.g. '12').
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+    band_rows (int): Latitude rows per band, rounded to a multiple of SPACE_CHUNK. Defaults to 64.
+    quantize (bool): If True, stores int16 codes (utils.quantization) instead of float32, halving the store.
+                     Ignored when resuming a build, which keeps the encoding of the store.
+
+    Returns:
+    str: The path of the store.
+    """
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_time_store_path(accumulation_window, store_root)
+    files = filter_valid_nc_files(list_spei_files(accumulation_window, start_year, end_year, data_root))
+    if not files:
+        raise ValueError("No readable NetCDF files found.")
+    band_rows = max(SPACE_CHUNK, band_rows // SPACE_CHUNK * SPACE_CHUNK)
+
+    ds = xr.open_mfdataset(files, concat_dim='time', combine='nested', chunks=plan_chunks_for_files(files), parallel=False)
+    data = ds[variable]
+    # The cleaning of the time axis does not depend on the values, so one cell gives the time axis of the store
+    times = process_datarray(data.isel(lat=slice(0, 1), lon=slice(0, 1)).load())[0]['time'].values
+
+    # A build is resumed only for the same files; the rows written so far are recorded as ranges, so a resumed
+    # build with another band size still writes every row
+    period = {'files': len(files), 'first_month': '%04d-%02d' % parse_file_month(files[0]),
+              'last_month': '%04d-%02d' % parse_file_month(files[-1])}
+    completed = []
+    if os.path.exists(store_path):
+        attrs = zarr.open_group(store_path, mode='r').attrs
+        if all(attrs.get(key) == value for key, value in period.items()):
+            completed = [tuple(rows) for rows in attrs.get('completed_rows', [])]
+    if completed:
+        quantize = store_is_quantized(store_path, variable)
+    else:
+        shape = (times.size, data.sizes['lat'], data.sizes['lon'])
+        chunks = (min(TIME_CHUNK, times.size), SPACE_CHUNK, SPACE_CHUNK)
+        template = xr.Dataset(
+            {variable: (('time', 'lat', 'lon'), da.zeros(shape, chunks=chunks, dtype='float32'), data.attrs)},
+            coords={'time': times, 'lat': data['lat'].values, 'lon': data['lon'].values},
+        )
+        template.attrs.update({**period, 'complete': False, 'completed_rows': [], 'layout': 'time-contiguous'})
+        encoding = quantized_encoding(chunks) if quantize else {'chunks': chunks, 'dtype': 'float32'}
+        template.to_zarr(store_path, mode='w', compute=False, encoding={variable: encoding})
+
+    for start in range(0, data.sizes['lat'], band_rows):
+        stop = min(start + band_rows, data.sizes['lat'])
+        if rows_completed(completed, start, stop):
+            continue
+        start_time = time.time()
+        band, _ = process_datarray(data.isel(lat=slice(start, stop)).load())
+        if not np.array_equal(band['time'].values, times):
+            raise ValueError("The cleaned time axis differs between bands.")
+        band = band.drop_vars(['time', 'lat', 'lon']).astype('float32')
+        band = (clip_to_limit(band) if quantize else band).to_dataset(name=variable)
+        band.to_zarr(store_path, region={'lat': slice(start, stop)})
+        completed = merge_row_ranges(completed + [(start, stop)])
+        set_store_attrs(store_path, completed_rows=[list(rows) for rows in completed])
+        print(f"{variable}: latitude rows {start}-{stop - 1} written in {time.time() - start_time:.1f} s")
+
+    set_store_attrs(store_path, complete=True)
+    ds.close()
+    return store_path
+
+
+
+def update_time_store(accumulation_window, data_root=DATA_ROOT, store_root=TIME_STORE_ROOT):
+    """
+    Appends to the time-contiguous store the months of the archive that are later than its last month.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    int: The number of months appended.
+    """
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_time_store_path(accumulation_window, store_root)
+    with xr.open_zarr(store_path) as store:
+        if not store.attrs.get('complete'):
+            raise ValueError("The time-contiguous store is incomplete; run build_time_store first.")
+        last = store['time'].values[-1].astype('datetime64[M]').astype(object)
+        attrs = dict(store.attrs)
+
+    files = filter_valid_nc_files(list_spei_files(accumulation_window, last.year, None, data_root))
+    files = [file for file in files if parse_file_month(file) > (last.year, last.month)]
+    if not files:
+        return 0
+    with xr.open_mfdataset(files, concat_dim='time', combine='nested', chunks=plan_chunks_for_files(files)) as ds:
+        new, _ = process_datarray(ds[variable].load())
+        new = new.sortby('time').astype('float32')
+    if store_is_quantized(store_path, variable):
+        new = clip_to_limit(new)
+    # Appending replaces the attributes of the store, so they are carried over
+    new = new.to_dataset(name=variable).drop_vars(['lat', 'lon']).assign_attrs(
+        attrs, files=attrs['files'] + len(files), last_month='%04d-%02d' % parse_file_month(files[-1]))
+    new.to_zarr(store_path, append_dim='time')
+    return new.sizes['time']
+
+
+
+def record_missing_months(accumulation_window, files, store_root=TIME_STORE_ROOT) -> int:
+    """
+    Records in the time-contiguous store the months of new monthly files that fall before its last month (late
+    backfills). They cannot be appended, so `store_covers_period` sends the periods holding them to the monthly files
+    until the store is rebuilt with `build_time_store`.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    files (list): The new monthly files.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    int: The number of months recorded as missing.
+    """
+    store_path = get_time_store_path(accumulation_window, store_root)
+    with xr.open_zarr(store_path) as store:
+        stored = {(stamp.year, stamp.month) for stamp in store.indexes['time']}
+        missing = {tuple(month) for month in store.attrs.get('missing_months', [])}
+    last = max(stored)
+    backfills = {parse_file_month(file) for file in files} - stored
+    backfills = {month for month in backfills if month < last} - missing
+    if not backfills:
+        return 0
+    print(f"Warning: {len(backfills)} new months of SPEI{accumulation_window} precede the last month of the time store "
+          "and cannot be appended; queries over them read the monthly files until the store is rebuilt.")
+    set_store_attrs(store_path, missing_months=[list(month) for month in sorted(missing | backfills)])
+    return len(backfills)
+
+
+
+def rewrite_time_store_months(accumulation_window, files, store_root=TIME_STORE_ROOT):
+    """
+    Rewrites in place the months of the time-contiguous store whose monthly files were replaced, e.g. corrected
+    files republished for months already in the store. Months not in the store are left to `update_time_store`.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    files (list): The replaced monthly files.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    int: The number of months rewritten.
+    """
+    variable = f'SPEI{accumulation_window}'
+    store_path = get_time_store_path(accumulation_window, store_root)
+    with xr.open_zarr(store_path) as store:
+        stored = {(stamp.year, stamp.month): i for i, stamp in enumerate(store.indexes['time'])}
+    quantized = store_is_quantized(store_path, variable)
+    rewritten = 0
+    for file in files:
+        position = stored.get(parse_file_month(file))
+        if position is None:
+            continue
+        with xr.open_dataset(file) as ds:
+            month, _ = process_datarray(ds[variable].load())
+        month = month.astype('float32')
+        month = (clip_to_limit(month) if quantized else month).drop_vars(['time', 'lat', 'lon']).to_dataset(name=variable)
+        # Rewriting touches the chunks of one month in every column of the store
+        month.to_zarr(store_path, region={'time': slice(position, position + 1)})
+        rewritten += 1
+    return rewritten
+
+
+
+def estimate_query_costs(bounds, n_months, spatial_chunks=None, time_chunks=(TIME_CHUNK, SPACE_CHUNK, SPACE_CHUNK)):
+    """
+    Estimates the cost of reading a region and period from each layout, as bytes read plus fixed costs per opened
+    file and per chunk.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    n_months (int): The number of months of the period.
+    spatial_chunks (tuple, optional): The (time, lat, lon) chunks of the monthly files; one whole map if not given.
+    time_chunks (tuple): The (time, lat, lon) chunks of the time-contiguous store.
+
+    Returns:
+    dict: The estimated cost of the 'spatial' (monthly files) and 'time' (time-contiguous store) layouts.
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    n_lat = len(generate_coordinate_values(min_lat, max_lat))
+    # A box crossing the antimeridian is read as two blocks of longitudes
+    n_lons = [len(generate_coordinate_values(west, east)) for west, _, east, _ in split_bounding_box(bounds)]
+    overlapping = lambda cells, chunk: int(np.ceil((cells - 1) / chunk)) + 1 if cells > 1 else 1
+    itemsize = 4
+
+    if spatial_chunks is None:
+        spatial_chunks = (1, 721, 1440)
+    spatial_tiles = overlapping(n_lat, spatial_chunks[1]) * sum(overlapping(n_lon, spatial_chunks[2]) for n_lon in n_lons)
+    spatial_chunk_bytes = itemsize * int(np.prod(spatial_chunks[1:]))
+    spatial = n_months * (FILE_OPEN_COST_BYTES + spatial_tiles * (CHUNK_READ_COST_BYTES + spatial_chunk_bytes))
+
+    time_tiles = (overlapping(n_lat, time_chunks[1]) * sum(overlapping(n_lon, time_chunks[2]) for n_lon in n_lons)
+                  * int(np.ceil(n_months / time_chunks[0]) + 1))
+    time_chunk_bytes = itemsize * int(np.prod(time_chunks))
+    temporal = FILE_OPEN_COST_BYTES + time_tiles * (CHUNK_READ_COST_BYTES + time_chunk_bytes)
+    return {'spatial': spatial, 'time': temporal}
+
+
+
+def store_covers_period(accumulation_window, start_year=None, end_year=None, files=None, data_root=DATA_ROOT,
+                        store_root=TIME_STORE_ROOT) -> bool:
+    """
+    Check whether the time-contiguous store is complete and holds every month of a period, so it can answer for it.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    start_year (int, optional): First year of the period; the first month of the archive if not given.
+    end_year (int, optional): Last year of the period; the last month of the archive if not given.
+    files (list, optional): The monthly files of the period, if already listed.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    bool: True if the store covers the first and last months of the period found in the archive (or the whole
+          years asked for when the archive has none of them) and misses none of the months between them.
+    """
+    store_path = get_time_store_path(accumulation_window, store_root)
+    if not os.path.exists(store_path):
+        return False
+    attrs = zarr.open_group(store_path, mode='r').attrs
+    if not attrs.get('complete', False):
+        return False
+    with xr.open_zarr(store_path) as store:
+        stored = store.indexes['time']
+        first, last = (stored[0].year, stored[0].month), (stored[-1].year, stored[-1].month)
+
+    files = list_spei_files(accumulation_window, start_year, end_year, data_root) if files is None else files
+    months = sorted(parse_file_month(file) for file in files)
+    wanted_first = months[0] if months else ((int(start_year), 1) if start_year is not None else first)
+    wanted_last = months[-1] if months else ((int(end_year), 12) if end_year is not None else last)
+    missing = [tuple(month) for month in attrs.get('missing_months', [])]
+    return first <= wanted_first and wanted_last <= last and not any(wanted_first <= month <= wanted_last for month in missing)
+
+
+
+def choose_layout(bounds, start_year, end_year, accumulation_window, data_root=DATA_ROOT, store_root=TIME_STORE_ROOT):
+    """
+    Routes a query to the layout that reads the least: the time-contiguous store for small areas over long periods,
+    the monthly files for large areas over short periods. The store is only used if it covers the period.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    start_year (int): First year of the period.
+    end_year (int): Last year of the period.
+    accumulation_window (str): The accumulation window in months.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    tuple: The layout ('time' or 'spatial'), the matching files (empty for the time layout) and the cost estimates.
+    """
+    files = list_spei_files(accumulation_window, start_year, end_year, data_root)
+    store_path = get_time_store_path(accumulation_window, store_root)
+    if not files and not os.path.exists(store_path):
+        raise ValueError("No data found for the selected period.")
+    spatial_chunks = read_storage_layout(files[0])['chunks'] if files else None
+    time_chunks = (TIME_CHUNK, SPACE_CHUNK, SPACE_CHUNK)
+    if os.path.exists(store_path):
+        time_chunks = tuple(zarr.open_array(os.path.join(store_path, f'SPEI{accumulation_window}'), mode='r').chunks)
+    costs = estimate_query_costs(bounds, max(1, len(files)), spatial_chunks, time_chunks)
+
+    # A store built or updated for fewer months than the period asks for would silently miss some of them
+    store_ready = store_covers_period(accumulation_window, start_year, end_year, files, data_root, store_root)
+    if store_ready and (costs['time'] < costs['spatial'] or not files):
+        return 'time', [], costs
+    if not files:
+        raise ValueError("The time-contiguous store does not cover the selected period and no monthly files were found.")
+    return 'spatial', files, costs
+
+
+
+def load_time_store(bounds, accumulation_window, start_year=None, end_year=None, store_root=TIME_STORE_ROOT,
+                    keep_quantized=False):
+    """
+    Loads the cleaned values of a region and period from the time-contiguous store.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    accumulation_window (str): The accumulation window in months.
+    start_year (int, optional): First year to include.
+    end_year (int, optional): Last year to include.
+    store_root (str): The root folder of the time-contiguous stores.
+    keep_quantized (bool): If True, the int16 codes of a quantized store are returned undecoded, for `compute_stats`.
+
+    Returns:
+    xr.DataArray: The lazily loaded values with dimensions ('time', 'lat', 'lon').
+    """
+    ds = open_store(get_time_store_path(accumulation_window, store_root), f'SPEI{accumulation_window}', keep_quantized)
+    ds = preprocess(ds, bounds)
+    data = ds[f'SPEI{accumulation_window}']
+    if start_year is not None or end_year is not None:
+        data = data.sel(time=slice(str(start_year) if start_year else None, str(end_year) if end_year else None))
+    return data
+
+
+
+def get_routed_data(bounds, accumulation_window, start_year, end_year, data_root=DATA_ROOT, store_root=TIME_STORE_ROOT):
+    """
+    Loads and cleans the values of a region and period from the layout chosen by `choose_layout`.
+
+    Parameters:
+    bounds (tuple): Geographic boundary coordinates (min_lon, min_lat, max_lon, max_lat).
+    accumulation_window (str): The accumulation window in months.
+    start_year (int): First year of the period.
+    end_year (int): Last year of the period.
+    data_root (str): The root folder of the SPEI archive.
+    store_root (str): The root folder of the time-contiguous stores.
+
+    Returns:
+    tuple: The cleaned values with dimensions ('time', 'lat', 'lon') and the layout they were read from.
+    """
+    layout, files, _ = choose_layout(bounds, start_year, end_year, accumulation_window, data_root, store_root)
+    if layout == 'time':
+        return load_time_store(bounds, accumulation_window, start_year, end_year, store_root), layout
+    files = filter_valid_nc_files(files)
+    if not files:
+        raise ValueError("No readable NetCDF files found.")
+    data, _ = process_datarray(load_and_preprocess_dataset(files, bounds)[f'SPEI{accumulation_window}'])
+    return data, layout
@@ -0,0 +1,218 @@
+import numpy as np
+import xarray as xr
+from scipy.special import ndtr
+from utils.drought_events import DROUGHT_THRESHOLD
+
+
+TREND_VARIABLES = ['mk_s', 'mk_z', 'mk_p', 'sen_slope', 'n_valid']
+PETTITT_VARIABLES = ['pettitt_k', 'pettitt_p', 'change_index']
+
+
+
+def mann_kendall_sen_kernel(values):
+    """
+    Computes the Mann-Kendall test and Sen's slope for every series of a block at once.
+
+    The loop runs over the lags between pairs of time steps, while all series of the block are processed by NumPy
+    in each iteration. Missing values are excluded from the pairs they belong to.
+
+    Parameters:
+    values (np.ndarray): Array of shape (..., time).
+
+    Returns:
+    np.ndarray: Array of shape (..., 5) with the S statistic, Z score, two-sided p-value, Sen's slope
+                (units per time step) and number of valid time steps.
+    """
+    n_times = values.shape[-1]
+    valid = np.isfinite(values)
+    n_valid = valid.sum(axis=-1)
+    s_stat = np.zeros(values.shape[:-1])
+    # The pairwise slopes are written into one preallocated array so the block never holds them twice
+    slopes = np.empty(values.shape[:-1] + (n_times * (n_times - 1) // 2,))
+    start = 0
+    for lag in range(1, n_times):
+        differences = values[..., lag:] - values[..., :-lag]
+        s_stat += np.nansum(np.sign(differences), axis=-1)
+        np.divide(differences, lag, out=slopes[..., start:start + n_times - lag])
+        start += n_times - lag
+    with np.errstate(invalid='ignore'):
+        if n_times > 1:
+            sen_slope = np.nanmedian(slopes, axis=-1, overwrite_input=True)
+        else:
+            sen_slope = np.full(values.shape[:-1], np.nan)
+
+    # Normal approximation of the S distribution (without the correction for ties)
+    variance = n_valid * (n_valid - 1) * (2 * n_valid + 5) / 18.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z_score = np.where(s_stat > 0, s_stat - 1, np.where(s_stat < 0, s_stat + 1, 0)) / np.sqrt(variance)
+    z_score = np.where(n_valid >= 3, z_score, np.nan)
+    p_value = 2 * (1 - ndtr(np.abs(z_score)))
+    return np.stack([s_stat, z_score, p_value, sen_slope, n_valid.astype('float64')], axis=-1)
+
+
+
+def pettitt_kernel(values):
+    """
+    Computes the Pettitt change-point test for every series of a block at once, using ranks so the cost is linear in time.
+
+    Parameters:
+    values (np.ndarray): Array of shape (..., time). Series with missing values yield NaN.
+
+    Returns:
+    np.ndarray: Array of shape (..., 3) with the K statistic, its approximate p-value and the index of the last
+                time step before the change point.
+    """
+    n_times = values.shape[-1]
+    ranks = np.argsort(np.argsort(values, axis=-1), axis=-1) + 1.0
+    steps = np.arange(1, n_times + 1)
+    u_stat = 2 * np.cumsum(ranks, axis=-1) - steps * (n_times + 1)
+    k_stat = np.abs(u_stat).max(axis=-1)
+    change_index = np.abs(u_stat).argmax(axis=-1).astype('float64')
+    p_value = np.minimum(1.0, 2 * np.exp(-6 * k_stat ** 2 / (n_times ** 3 + n_times ** 2)))
+    complete = np.isfinite(values).all(axis=-1)
+    result = np.stack([k_stat, p_value, change_index], axis=-1)
+    return np.where(complete[..., None], result, np.nan)
+
+
+
+def annual_series(data: xr.DataArray, month: int = None) -> xr.DataArray:
+    """
+    Reduces a monthly SPEI cube to one value per year, which keeps the pairwise trend statistics affordable.
+
+    Parameters:
+    data (xr.DataArray): Monthly SPEI values with a datetime 'time' dimension.
+    month (int, optional): If given, the value of this calendar month is used (e.g. 12 for SPEI12 in December);
+                           otherwise the annual mean is used.
+
+    Returns:
+    xr.DataArray: The annual series with a 'year' dimension.
+    """
+    if month is not None:
+        selected = data.sel(time=data['time'].dt.month == month)
+        return selected.assign_coords(year=selected['time'].dt.year).swap_dims({'time': 'year'}).drop_vars('time')
+    return data.groupby('time.year').mean('time')
+
+
+
+def spatial_blocks(data: xr.DataArray, dim: str, memory_budget: float, pairwise: bool = True) -> dict:
+    """
+    Chooses square spatial chunks so one block holding every time step, and the working arrays of the kernel,
+    fits in the memory budget.
+
+    Parameters:
+    data (xr.DataArray): The input data with 'lat' and 'lon' dimensions.
+    dim (str): The time-like dimension kept in one chunk.
+    memory_budget (float): Memory allowed per block, in bytes.
+    pairwise (bool): True if the kernel holds the differences of all pairs of time steps (Sen's slope),
+                     False if it only holds a few arrays of the series length. Defaults to True.
+
+    Returns:
+    dict: The chunk sizes for `dim`, 'lat' and 'lon'.
+    """
+    n_times = data.sizes[dim]
+    bytes_per_cell = 8 * max(4 * n_times, n_times * (n_times - 1) / 2 if pairwise else 0)
+    side = int(max(1, np.sqrt(memory_budget / bytes_per_cell)))
+    return {dim: -1, 'lat': min(side, data.sizes['lat']), 'lon': min(side, data.sizes['lon'])}
+
+
+
+def compute_trend_map(data: xr.DataArray, dim: str = 'year', memory_budget: float = 256e6) -> xr.Dataset:
+    """
+    Computes per-cell Mann-Kendall trend statistics and Sen's slope over the whole grid as a blocked dask computation.
+
+    Parameters:
+    data (xr.DataArray): Values with dimensions (dim, 'lat', 'lon'), e.g. from `annual_series`.
+    dim (str): The time-like dimension along which trends are computed. Defaults to 'year'.
+    memory_budget (float): Approximate memory per block, in bytes. Defaults to 256 MB.
+
+    Returns:
+    xr.Dataset: A lazy dataset on the ('lat', 'lon') grid with variables mk_s, mk_z, mk_p, sen_slope (per `dim` step)
+                and n_valid.
+    """
+    data = data.astype('float64').chunk(spatial_blocks(data, dim, memory_budget))
+    result = xr.apply_ufunc(
+        mann_kendall_sen_kernel, data,
+        input_core_dims=[[dim]],
+        output_core_dims=[['statistic']],
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={'output_sizes': {'statistic': len(TREND_VARIABLES)}},
+    )
+    return result.assign_coords(statistic=TREND_VARIABLES).to_dataset(dim='statistic')
+
+
+
+def compute_change_point_map(data: xr.DataArray, dim: str = 'year', memory_budget: float = 256e6) -> xr.Dataset:
+    """
+    Computes the per-cell Pettitt change-point test over the whole grid as a blocked dask computation.
+
+    Parameters:
+    data (xr.DataArray): Values with dimensions (dim, 'lat', 'lon').
+    dim (str): The time-like dimension along which change points are searched. Defaults to 'year'.
+    memory_budget (float): Approximate memory per block, in bytes. Defaults to 256 MB.
+
+    Returns:
+    xr.Dataset: A lazy dataset on the ('lat', 'lon') grid with variables pettitt_k, pettitt_p and change_point
+                (the last `dim` value before the change).
+    """
+    data = data.astype('float64').chunk(spatial_blocks(data, dim, memory_budget, pairwise=False))
+    result = xr.apply_ufunc(
+        pettitt_kernel, data,
+        input_core_dims=[[dim]],
+        output_core_dims=[['statistic']],
+        dask='parallelized',
+        output_dtypes=['float64'],
+        dask_gufunc_kwargs={'output_sizes': {'statistic': len(PETTITT_VARIABLES)}},
+    )
+    result = result.assign_coords(statistic=PETTITT_VARIABLES).to_dataset(dim='statistic')
+    coordinate = data[dim].values
+    index = result['change_index']
+    result['change_point'] = xr.apply_ufunc(
+        lambda idx: np.where(np.isfinite(idx), coordinate[np.nan_to_num(idx).astype(int)], np.nan),
+        index, dask='parallelized', output_dtypes=['float64'])
+    return result.drop_vars('change_index')
+
+
+
+def compute_drought_frequency_change(data: xr.DataArray, reference_period: tuple, comparison_period: tuple,
+                                     threshold: float = DROUGHT_THRESHOLD) -> xr.Dataset:
+    """
+    Computes, for every cell, the fraction of months in drought (SPEI <= threshold) in two periods and its change.
+
+    Parameters:
+    data (xr.DataArray): Monthly SPEI values with dimensions ('time', 'lat', 'lon').
+    reference_period (tuple): First and last year of the reference period (e.g. ('1951', '1980')).
+    comparison_period (tuple): First and last year of the comparison period (e.g. ('1991', '2020')).
+    threshold (float): SPEI value at or below which a month is in drought. Defaults to -1.0.
+
+    Returns:
+    xr.Dataset: A lazy dataset with variables reference_frequency, comparison_frequency and frequency_change.
+    """
+    def frequency(period):
+        subset = data.sel(time=slice(str(period[0]), str(period[1])))
+        return (subset <= threshold).where(subset.notnull()).mean('time')
+
+    reference = frequency(reference_period)
+    comparison = frequency(comparison_period)
+    return xr.Dataset({
+        'reference_frequency': reference,
+        'comparison_frequency': comparison,
+        'frequency_change': comparison - reference,
+    }, attrs={
+        'threshold': threshold,
+        'reference_period': f'{reference_period[0]}-{reference_period[1]}',
+        'comparison_period': f'{comparison_period[0]}-{comparison_period[1]}',
+    })
+
+
+
+def save_raster(dataset: xr.Dataset, file_path: str):
+    """
+    Computes and writes a map-ready dataset on the ('lat', 'lon') grid to a compressed NetCDF file, block by block.
+
+    Parameters:
+    dataset (xr.Dataset): The dataset to persist, e.g. from `compute_trend_map`.
+    file_path (str): The destination NetCDF path.
+    """
+    encoding = {name: {'zlib': True, 'complevel': 4, 'dtype': 'float32'} for name in dataset.data_vars}
+    dataset.transpose('lat', 'lon', ...).to_netcdf(file_path, encoding=encoding)
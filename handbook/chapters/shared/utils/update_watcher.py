@@ -0,0 +1,421 @@
+"""
+Update watcher for the SPEI archive.
+
+Polls the folders of the accumulation windows for new, replaced and removed monthly files, validates them, and
+pushes only those months through the cleaning stage into the derived products that exist:
+
+    index         the reference index of the window (utils.reference_index)
+    time_store    the time-contiguous store: new months appended, replaced months rewritten (utils.time_store)
+    pyramid       the coarsened levels: replaced months rewritten, new months appended (utils.pyramid)
+    land_store    the land-only store, as the pyramid (utils.land_storage)
+    climatology   the saved climatologies of rolling windows over this base window (utils.rolling_accumulation)
+
+Only products already built are updated. New months earlier than the last month of a store cannot be appended to
+it; they are reported, and the time store routes queries over them to the monthly files until it is rebuilt. On
+the first pass over a window, the files whose month every built store already holds are taken as processed.
+
+From the `handbook/chapters/shared` folder:
+
+    python -m utils.update_watcher 1 3 12 --interval 300
+
+or with `--once` for a single pass, e.g. from cron. The files seen and the products updated for them are recorded
+in a JSON state file after every step, so a pass interrupted midway resumes with the steps left, and running a pass
+again with nothing new does nothing. The recent months cache of the query service (utils.recent_cache) checks the
+catalog by itself and needs no step here.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import xarray as xr
+from utils.data_preprocess import DATA_ROOT, parse_file_month, list_spei_files, is_readable_nc, file_signature
+from utils.reference_index import INDEX_ROOT, get_index_path, build_reference_index
+from utils.time_store import (TIME_STORE_ROOT, get_time_store_path, update_time_store, rewrite_time_store_months,
+                              record_missing_months)
+from utils.pyramid import PYRAMID_ROOT, PYRAMID_RESOLUTIONS, get_pyramid_path, append_pyramid_months, rewrite_pyramid_months
+from utils.land_storage import (LAND_ROOT, get_land_index_path, get_land_store_path, append_land_store_months,
+                                rewrite_land_store_months)
+from utils.rolling_accumulation import REFERENCE_PERIOD, CLIMATOLOGY_ROOT, list_climatologies, update_climatology
+
+
+WATCHER_STATE = '/data1/drought_dataset/spei_watcher_state.json'
+POLL_INTERVAL = 300             # Seconds between two scans of the archive
+SETTLE_SECONDS = 60             # A file must be unchanged this long before it is processed, so partial copies wait
+PRODUCTS = ('index', 'time_store', 'pyramid', 'land_store', 'climatology')
+
+
+
+def load_state(state_path=WATCHER_STATE) -> dict:
+    """
+    Loads the state of the watcher, or an empty state on the first run.
+
+    Parameters:
+    state_path (str): The JSON state file.
+
+    Returns:
+    dict: Per accumulation window, the processed files ('files'), the unreadable ones ('invalid') and the pass
+          in progress ('pending').
+    """
+    if not os.path.exists(state_path):
+        return {'files': {}, 'invalid': {}, 'pending': {}}
+    with open(state_path) as file:
+        return json.load(file)
+
+
+
+def save_state(state, state_path=WATCHER_STATE):
+    """
+    Saves the state of the watcher, replacing the previous file only once the new one is complete.
+
+    Parameters:
+    state (dict): The state.
+    state_path (str): The JSON state file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+    with open(state_path + '.tmp', 'w') as file:
+        json.dump(state, file, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+
+
+def scan_window(accumulation_window, state, data_root=DATA_ROOT, settle_seconds=SETTLE_SECONDS) -> dict:
+    """
+    Compares the files of an accumulation window with those already processed.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    state (dict): The state of the watcher.
+    data_root (str): The root folder of the SPEI archive.
+    settle_seconds (float): Files modified more recently than this are left for a later pass.
+
+    Returns:
+    dict: The 'new', 'changed' and 'removed' files, the settled but unreadable files ('invalid', with their
+          signatures) and the number of files still being written ('unsettled').
+    """
+    known = state['files'].get(accumulation_window, {})
+    invalid = state['invalid'].get(accumulation_window, {})
+    listed = list_spei_files(accumulation_window, data_root=data_root)
+    changes = {'new': [], 'changed': [], 'removed': sorted(set(known) - set(listed)), 'invalid': {}, 'unsettled': 0}
+    now = time.time()
+    for path in listed:
+        signature = file_signature(path)
+        if known.get(path) == signature or invalid.get(path) == signature:
+            continue
+        if now - signature['mtime'] < settle_seconds:
+            changes['unsettled'] += 1
+        elif not is_readable_nc(path):
+            changes['invalid'][path] = signature
+        else:
+            changes['changed' if path in known else 'new'].append(path)
+    return changes
+
+
+
+def stored_months(store_path) -> set:
+    """
+    List the months held by a Zarr store of the products.
+
+    Parameters:
+    store_path (str): The store.
+
+    Returns:
+    set: The (year, month) pairs in the store.
+    """
+    with xr.open_zarr(store_path) as store:
+        return {(stamp.year, stamp.month) for stamp in store.indexes['time']}
+
+
+
+def product_stores(accumulation_window, roots) -> list:
+    """
+    List the Zarr stores of an accumulation window that are already built (time store, pyramid levels, land store).
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    roots (dict): The root folders of the products.
+
+    Returns:
+    list: The paths of the stores.
+    """
+    paths = [get_time_store_path(accumulation_window, roots['time_store']),
+             get_land_store_path(accumulation_window, roots['land_store'])]
+    paths += [get_pyramid_path(accumulation_window, resolution, roots['pyramid']) for resolution in PYRAMID_RESOLUTIONS]
+    return [path for path in paths if os.path.exists(path)]
+
+
+
+def seed_state(accumulation_window, state, data_root=DATA_ROOT, roots=None) -> int:
+    """
+    On the first pass over an accumulation window, records as processed the files whose month every built store
+    already holds. Otherwise a watcher started next to built products would find the whole archive new and rewrite
+    every stored month.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    state (dict): The state of the watcher, updated in place.
+    data_root (str): The root folder of the SPEI archive.
+    roots (dict, optional): The root folders of the products; the default folders if not given.
+
+    Returns:
+    int: The number of files recorded.
+    """
+    if accumulation_window in state['files']:
+        return 0
+    stores = product_stores(accumulation_window, {**default_roots(), **(roots or {})})
+    if not stores:
+        return 0
+    stored = set.intersection(*map(stored_months, stores))
+    state['files'][accumulation_window] = {path: file_signature(path) for path in list_spei_files(accumulation_window, data_root=data_root)
+                                           if parse_file_month(path) in stored}
+    return len(state['files'][accumulation_window])
+
+
+
+def report_backfills(variable, files, store_paths) -> int:
+    """
+    Warns about new months earlier than the last month of stores extended by appending, which cannot be inserted
+    into them; the stores must be rebuilt to include them.
+
+    Parameters:
+    variable (str): The SPEI variable, for the message.
+    files (list): The new monthly files.
+    store_paths (list): The stores.
+
+    Returns:
+    int: The number of months missing from at least one store.
+    """
+    missing = set()
+    for path in store_paths:
+        stored = stored_months(path)
+        backfills = {month for month in map(parse_file_month, files) if month not in stored and month < max(stored)}
+        if backfills:
+            print(f"Warning: {len(backfills)} new months of {variable} precede the last month of {path} and cannot be "
+                  "appended; rebuild it to include them.")
+        missing |= backfills
+    return len(missing)
+
+
+
+def run_product_step(step, accumulation_window, pending, files, data_root, roots):
+    """
+    Updates one derived product of an accumulation window with the files of a pass.
+
+    Parameters:
+    step (str): The product, one of PRODUCTS.
+    accumulation_window (str): The accumulation window in months.
+    pending (dict): The 'new', 'changed' and 'removed' files of the pass.
+    files (list): All the processed files of the window once the pass is done.
+    data_root (str): The root folder of the SPEI archive.
+    roots (dict): The root folders of the products ('index', 'time_store', 'pyramid', 'land_store', 'climatology').
+
+    Returns:
+    object: A short summary of the update, or None if the product does not exist or is not concerned.
+    """
+    variable = f'SPEI{accumulation_window}'
+    updated = pending['new'] + pending['changed']
+
+    if step == 'index':
+        if not files:
+            return None
+        summary = build_reference_index(files, get_index_path(accumulation_window, roots['index']), variable)
+        return {key: summary[key] for key in ('files', 'scanned', 'removed')}
+
+    if step == 'time_store':
+        store_path = get_time_store_path(accumulation_window, roots['time_store'])
+        if not os.path.exists(store_path):
+            return None
+        return {'missing': record_missing_months(accumulation_window, pending['new'], roots['time_store']),
+                'rewritten': rewrite_time_store_months(accumulation_window, updated, roots['time_store']),
+                'appended': update_time_store(accumulation_window, data_root, roots['time_store'])}
+
+    if step == 'pyramid':
+        resolutions = [resolution for resolution in PYRAMID_RESOLUTIONS
+                       if os.path.exists(get_pyramid_path(accumulation_window, resolution, roots['pyramid']))]
+        if not resolutions or not updated:
+            return None
+        paths = [get_pyramid_path(accumulation_window, resolution, roots['pyramid']) for resolution in resolutions]
+        # Replaced months are rewritten in place and the months after the last stored one appended, even within a year
+        return {'missing': report_backfills(variable, pending['new'], paths),
+                'rewritten': rewrite_pyramid_months(accumulation_window, updated, resolutions, roots['pyramid']),
+                'appended': append_pyramid_months(accumulation_window, resolutions, data_root, roots['pyramid'])}
+
+    if step == 'land_store':
+        store_path = get_land_store_path(accumulation_window, roots['land_store'])
+        if not os.path.exists(store_path) or not updated:
+            return None
+        if not os.path.exists(get_land_index_path(roots['land_store'])):
+            return None
+        return {'missing': report_backfills(variable, pending['new'], [store_path]),
+                'rewritten': rewrite_land_store_months(accumulation_window, updated, land_root=roots['land_store']),
+                'appended': append_land_store_months(accumulation_window, data_root=data_root, land_root=roots['land_store'])}
+
+    if step == 'climatology':
+        windows = list_climatologies(accumulation_window, roots['climatology'])
+        summary = {}
+        for window in windows:
+            # The accumulations of the reference period also use the months preceding it
+            first = int(REFERENCE_PERIOD[0]) - int(np.ceil((window - 1) / 12))
+            last = int(REFERENCE_PERIOD[1])
+            in_period = [parse_file_month(file) for file in updated + pending['removed'] if first <= parse_file_month(file)[0] <= last]
+            if not in_period:
+                continue
+            # Replaced files do not change the list of months, so the calendar months they enter are recomputed explicitly
+            replaced = sorted({(month - 1 + lag) % 12 + 1 for year, month in map(parse_file_month, pending['changed'])
+                               if first <= year <= last for lag in range(window)})
+            summary[window] = update_climatology(window, accumulation_window, replaced, data_root=data_root,
+                                                 climatology_root=roots['climatology'])
+        return summary or None
+
+    raise ValueError(f"Unknown product: {step}. Choose among {', '.join(PRODUCTS)}.")
+
+
+
+def process_window(accumulation_window, state, state_path=WATCHER_STATE, data_root=DATA_ROOT, products=PRODUCTS,
+                   settle_seconds=SETTLE_SECONDS, roots=None) -> dict:
+    """
+    Runs one pass over an accumulation window: finishes the pass left pending by an interrupted run, if any, or scans
+    for changes, then updates each product and records every completed step in the state.
+
+    Parameters:
+    accumulation_window (str): The accumulation window in months.
+    state (dict): The state of the watcher, updated in place.
+    state_path (str): The JSON state file.
+    data_root (str): The root folder of the SPEI archive.
+    products (tuple): The products to update, in order. Defaults to all.
+    settle_seconds (float): See `scan_window`.
+    roots (dict, optional): The root folders of the products; the default folders if not given.
+
+    Returns:
+    dict: The numbers of new, changed, removed and invalid files and the summary of each product step.
+    """
+    roots = {**default_roots(), **(roots or {})}
+    pending = state['pending'].get(accumulation_window)
+    if pending is None:
+        seeded = seed_state(accumulation_window, state, data_root, roots)
+        if seeded:
+            print(f"SPEI{accumulation_window}: {seeded} files already in the built stores recorded as processed")
+            save_state(state, state_path)
+        changes = scan_window(accumulation_window, state, data_root, settle_seconds)
+        for path, signature in changes['invalid'].items():
+            print(f"Warning: {path} cannot be read; it is skipped until it changes.")
+            state['invalid'].setdefault(accumulation_window, {})[path] = signature
+        if not (changes['new'] or changes['changed'] or changes['removed']):
+            if changes['invalid']:
+                save_state(state, state_path)
+            return {'new': 0, 'changed': 0, 'removed': 0, 'invalid': len(changes['invalid']), 'unsettled': changes['unsettled'], 'steps': {}}
+        pending = {key: changes[key] for key in ('new', 'changed', 'removed')}
+        pending.update({'signatures': {path: file_signature(path) for path in changes['new'] + changes['changed']},
+                        'done': [], 'invalid': len(changes['invalid']), 'unsettled': changes['unsettled']})
+        state['pending'][accumulation_window] = pending
+        save_state(state, state_path)
+
+    known = state['files'].get(accumulation_window, {})
+    files = sorted((set(known) - set(pending['removed'])) | set(pending['signatures']))
+    steps = {}
+    for step in products:
+        if step in pending['done']:
+            continue
+        start_time = time.perf_counter()
+        steps[step] = run_product_step(step, accumulation_window, pending, files, data_root, roots)
+        pending['done'].append(step)
+        save_state(state, state_path)
+        if steps[step] is not None:
+            print(f"SPEI{accumulation_window} {step}: {steps[step]} in {time.perf_counter() - start_time:.1f} s")
+
+    for path in pending['removed']:
+        known.pop(path, None)
+        state['invalid'].get(accumulation_window, {}).pop(path, None)
+    known.update(pending['signatures'])
+    state['files'][accumulation_window] = known
+    del state['pending'][accumulation_window]
+    save_state(state, state_path)
+    return {'new': len(pending['new']), 'changed': len(pending['changed']), 'removed': len(pending['removed']),
+            'invalid': pending['invalid'], 'unsettled': pending['unsettled'], 'steps': steps}
+
+
+
+def default_roots() -> dict:
+    """
+    Get the default root folders of the derived products.
+
+    Returns:
+    dict: The root folder of each product.
+    """
+    return {'index': INDEX_ROOT, 'time_store': TIME_STORE_ROOT, 'pyramid': PYRAMID_ROOT, 'land_store': LAND_ROOT,
+            'climatology': CLIMATOLOGY_ROOT}
+
+
+
+def watch(accumulation_windows, state_path=WATCHER_STATE, data_root=DATA_ROOT, products=PRODUCTS, interval=POLL_INTERVAL,
+          settle_seconds=SETTLE_SECONDS, roots=None, passes=None):
+    """
+    Scans the archive every `interval` seconds and updates the products of each accumulation window.
+
+    A failing window is reported and retried at the next pass; the other windows go on.
+
+    Parameters:
+    accumulation_windows (list): The accumulation windows in months (e.g. ['1', '12']).
+    state_path (str): The JSON state file.
+    data_root (str): The root folder of the SPEI archive.
+    products (tuple): The products to update. Defaults to all.
+    interval (float): Seconds between two passes. Defaults to 300.
+    settle_seconds (float): See `scan_window`.
+    roots (dict, optional): The root folders of the products.
+    passes (int, optional): Number of passes before returning; runs until interrupted if not given.
+
+    Returns:
+    list: The summaries of the passes, one dictionary per pass mapping each window to its summary.
+    """
+    history = []
+    while passes is None or len(history) < passes:
+        if history:
+            time.sleep(interval)
+        state = load_state(state_path)
+        summaries = {}
+        for window in accumulation_windows:
+            try:
+                summaries[window] = process_window(str(window), state, state_path, data_root, products, settle_seconds, roots)
+            except Exception as e:
+                print(f"SPEI{window}: update failed, retried at the next pass: {e}")
+                summaries[window] = {'error': str(e)}
+        history.append(summaries)
+    return history
+
+
+
+def main(argv=None):
+    """
+    Command line entry point of the watcher.
+
+    Parameters:
+    argv (list, optional): The command line arguments; `sys.argv[1:]` if not given.
+
+    Returns:
+    int: The exit code; 1 if a window failed in a single pass.
+    """
+    parser = argparse.ArgumentParser(description='Update the derived SPEI products when new monthly files arrive.')
+    parser.add_argument('accumulation_windows', nargs='+', help='accumulation windows in months (e.g. 1 3 12)')
+    parser.add_argument('--data-root', default=DATA_ROOT, help='root folder of the SPEI archive')
+    parser.add_argument('--state', default=WATCHER_STATE, help='JSON file recording the processed files')
+    parser.add_argument('--products', nargs='+', default=list(PRODUCTS), choices=PRODUCTS, help='products to update')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='seconds between two scans')
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS, help='seconds a file must be unchanged before it is read')
+    parser.add_argument('--once', action='store_true', help='run a single pass and exit')
+    for product in PRODUCTS:
+        parser.add_argument(f'--{product.replace("_", "-")}-root', default=default_roots()[product], help=f'root folder of the {product}')
+    args = parser.parse_args(argv)
+
+    roots = {product: getattr(args, f'{product}_root') for product in PRODUCTS}
+    try:
+        history = watch(args.accumulation_windows, args.state, args.data_root, tuple(args.products), args.interval,
+                        args.settle, roots, passes=1 if args.once else None)
+    except KeyboardInterrupt:
+        return 0
+    return int(any('error' in summary for summary in history[-1].values()))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
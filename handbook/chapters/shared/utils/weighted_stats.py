@@ -0,0 +1,220 @@
+import numpy as np
+import xarray as xr
+import dask
+import dask.array as da
+import shapely
+from shapely.geometry import Polygon
+from utils.coordinates_retrieve import cell_areas_km2
+
+
+# Bins of the weighted histograms used for quantiles; values outside the range fall in the first or last bin
+HISTOGRAM_START = -5.0
+HISTOGRAM_STOP = 5.0
+HISTOGRAM_STEP = 0.005
+
+
+
+def grid_weights(data: xr.DataArray, kind: str = 'cos_lat') -> xr.DataArray:
+    """
+    Computes the weight of each cell of a regular lat/lon grid, proportional to its surface area.
+
+    Parameters:
+    data (xr.DataArray): The data whose 'lat' and 'lon' coordinates define the grid.
+    kind (str): 'cos_lat' for cos(latitude) weights, or 'area' for cell areas in square kilometres.
+                Both give the same statistics on a regular grid. Defaults to 'cos_lat'.
+
+    Returns:
+    xr.DataArray: The weights with dimensions ('lat', 'lon').
+    """
+    lat = data['lat'].values
+    lon = data['lon'].values
+    if kind == 'cos_lat':
+        values = np.repeat(np.cos(np.deg2rad(lat)).clip(min=0)[:, None], lon.size, axis=1)
+    elif kind == 'area':
+        values = cell_areas_km2(lat, lon)
+    else:
+        raise ValueError("The kind of weights must be 'cos_lat' or 'area'.")
+    return xr.DataArray(values, coords={'lat': data['lat'], 'lon': data['lon']}, dims=('lat', 'lon'), name='weights')
+
+
+
+def polygon_from_coordinates(coordinates):
+    """
+    Builds a shapely geometry from the coordinates returned by `get_boundaries`.
+
+    Parameters:
+    coordinates (list): List of polygons, each a list of rings (the exterior first, then holes) of [lon, lat] points.
+
+    Returns:
+    shapely.Geometry: The union of the polygons.
+    """
+    polygons = [Polygon(rings[0], holes=rings[1:]) for rings in coordinates if rings and len(rings[0]) >= 3]
+    if not polygons:
+        raise ValueError("No polygon found in the coordinates.")
+    return shapely.union_all(polygons)
+
+
+
+def coverage_fractions(geometry, data: xr.DataArray, supersample: int = 4) -> xr.DataArray:
+    """
+    Estimates the fraction of each grid cell covered by a polygon, by testing `supersample` x `supersample` points
+    spread regularly inside every cell.
+
+    Parameters:
+    geometry (shapely.Geometry): The area, e.g. from `polygon_from_coordinates`.
+    data (xr.DataArray): The data whose 'lat' and 'lon' coordinates define the grid.
+    supersample (int): Number of test points along each side of a cell. Defaults to 4 (1/16 resolution).
+
+    Returns:
+    xr.DataArray: The covered fractions (0 to 1) with dimensions ('lat', 'lon').
+    """
+    lat = data['lat'].values.astype('float64')
+    lon = data['lon'].values.astype('float64')
+    dlat = np.abs(np.diff(lat)).min() if lat.size > 1 else 0.25
+    dlon = np.abs(np.diff(lon)).min() if lon.size > 1 else 0.25
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+    point_lat = (lat[:, None] + offsets[None, :] * dlat).ravel()
+    point_lon = (lon[:, None] + offsets[None, :] * dlon).ravel()
+    x, y = np.meshgrid(point_lon, point_lat)
+
+    shapely.prepare(geometry)
+    inside = shapely.contains_xy(geometry, x, y)
+    fractions = inside.reshape(lat.size, supersample, lon.size, supersample).mean(axis=(1, 3))
+    return xr.DataArray(fractions, coords={'lat': data['lat'], 'lon': data['lon']}, dims=('lat', 'lon'), name='coverage')
+
+
+
+def histogram_edges() -> np.ndarray:
+    """
+    Returns the edges of the histogram bins used for weighted quantiles.
+
+    Returns:
+    np.ndarray: Evenly spaced edges from HISTOGRAM_START to HISTOGRAM_STOP.
+    """
+    n_bins = int(round((HISTOGRAM_STOP - HISTOGRAM_START) / HISTOGRAM_STEP))
+    return HISTOGRAM_START + HISTOGRAM_STEP * np.arange(n_bins + 1)
+
+
+
+def weighted_histogram_kernel(values, weights, n_bins):
+    """
+    Accumulates, for each time step of a block, the weights of the valid cells falling in each histogram bin.
+
+    Parameters:
+    values (np.ndarray): Block of shape (time, lat, lon).
+    weights (np.ndarray): Weights of shape (1, lat, lon).
+    n_bins (int): Number of histogram bins.
+
+    Returns:
+    np.ndarray: Array of shape (time, 1, 1, n_bins) so the blocks can be summed over the spatial block axes.
+    """
+    n_times = values.shape[0]
+    values = values.reshape(n_times, -1)
+    weights = np.broadcast_to(weights.reshape(1, -1), values.shape)
+    valid = np.isfinite(values) & (weights > 0)
+    bins = np.clip(((values - HISTOGRAM_START) / HISTOGRAM_STEP).astype('int64', copy=False), 0, n_bins - 1)
+    # One bincount over (time, bin) pairs fills the whole block at once
+    flat_index = (np.arange(n_times)[:, None] * n_bins + bins)[valid]
+    histogram = np.bincount(flat_index, weights=weights[valid], minlength=n_times * n_bins)
+    return histogram.reshape(n_times, 1, 1, n_bins)
+
+
+
+def weighted_histograms(data: xr.DataArray, weights: xr.DataArray) -> da.Array:
+    """
+    Builds the per-time-step weighted histograms of a dask-backed cube block by block, keeping its spatial chunks.
+
+    Parameters:
+    data (xr.DataArray): Values with dimensions ('time', 'lat', 'lon').
+    weights (xr.DataArray): Weights with dimensions ('lat', 'lon').
+
+    Returns:
+    dask.array.Array: Lazy array of shape (time, bins).
+    """
+    values = data.transpose('time', 'lat', 'lon').data
+    if not isinstance(values, da.Array):
+        values = da.from_array(values, chunks=(values.shape[0], -1, -1))
+    weight_blocks = da.from_array(weights.transpose('lat', 'lon').values[None], chunks=((1,),) + values.chunks[1:])
+    n_bins = histogram_edges().size - 1
+    blocks = da.map_blocks(
+        weighted_histogram_kernel, values, weight_blocks, n_bins,
+        new_axis=3,
+        chunks=(values.chunks[0], (1,) * len(values.chunks[1]), (1,) * len(values.chunks[2]), (n_bins,)),
+        dtype='float64',
+    )
+    return blocks.sum(axis=(1, 2))
+
+
+
+def quantiles_from_histograms(histograms: np.ndarray, quantile: float) -> np.ndarray:
+    """
+    Reads a quantile from cumulative weighted histograms, interpolating linearly inside the bin that holds it.
+
+    Parameters:
+    histograms (np.ndarray): Array of shape (time, bins) of summed weights.
+    quantile (float): The quantile, between 0 and 1.
+
+    Returns:
+    np.ndarray: The quantile for each time step; NaN where no cell is valid. The error is below one bin width.
+    """
+    edges = histogram_edges()
+    cumulative = np.cumsum(histograms, axis=1)
+    totals = cumulative[:, -1]
+    target = quantile * totals
+    index = np.minimum((cumulative < target[:, None]).sum(axis=1), histograms.shape[1] - 1)
+    rows = np.arange(histograms.shape[0])
+    before = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0.0)
+    in_bin = histograms[rows, index]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        position = np.where(in_bin > 0, (target - before) / in_bin, 0.5)
+    result = edges[index] + np.clip(position, 0, 1) * HISTOGRAM_STEP
+    return np.where(totals > 0, result, np.nan)
+
+
+
+def compute_weighted_stats(data: xr.DataArray, weights=None, full_stats: bool = True, coverage: xr.DataArray = None) -> dict:
+    """
+    Area-weighted counterpart of `compute_stats`: each cell counts in proportion to its surface area, optionally
+    multiplied by the fraction of the cell inside the selected area.
+
+    The mean is an exact weighted mean; the median and quartiles are read from weighted histograms with a bin width
+    of HISTOGRAM_STEP. Each histogram is computed per spatial chunk and the chunks are summed, so the spatial
+    dimensions are never rechunked into one block.
+
+    Parameters:
+    data (xr.DataArray): The cleaned values with dimensions ('time', 'lat', 'lon').
+    weights (xr.DataArray or str, optional): Cell weights with dimensions ('lat', 'lon'), or 'cos_lat' / 'area' for
+                                             `grid_weights`. Defaults to 'cos_lat'.
+    full_stats (bool): If True, computes all statistics; otherwise only medians. Defaults to True.
+    coverage (xr.DataArray, optional): Fraction of each cell inside the area, e.g. from `coverage_fractions`.
+
+    Returns:
+    dict: The same keys as `compute_stats` (times, medians, and if full_stats means, q1s, q3s, mins, maxs).
+    """
+    if weights is None or isinstance(weights, str):
+        weights = grid_weights(data, weights or 'cos_lat')
+    if coverage is not None:
+        weights = weights * coverage
+    weights = weights.fillna(0)
+
+    # Cells outside the area do not contribute to the minima and maxima either
+    masked = data.where(weights > 0)
+    histograms = weighted_histograms(masked, weights)
+    if full_stats:
+        valid_weights = weights.where(masked.notnull(), 0)
+        mean = (masked.fillna(0) * weights).sum(['lat', 'lon']) / valid_weights.sum(['lat', 'lon'])
+        histograms, mean, min_val, max_val = dask.compute(histograms, mean, masked.min(['lat', 'lon']), masked.max(['lat', 'lon']))
+        return {
+            'means': mean.values,
+            'q1s': quantiles_from_histograms(histograms, 0.25),
+            'q3s': quantiles_from_histograms(histograms, 0.75),
+            'mins': min_val.values,
+            'maxs': max_val.values,
+            'times': data['time'].values,
+            'medians': quantiles_from_histograms(histograms, 0.5),
+        }
+    histograms, = dask.compute(histograms)
+    return {
+        'times': data['time'].values,
+        'medians': quantiles_from_histograms(histograms, 0.5),
+    }
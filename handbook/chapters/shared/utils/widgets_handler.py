@@ -3,6 +3,7 @@ import pandas as pd
 import json
 import os
 import time
+import threading
 
 
 def get_file_path(file_name):
@@ -157,7 +158,76 @@ def update_subareas(change, country_list, placeholders, adm1_subarea_selector, a
             adm2_subarea_selector.options = ['No adm2 subareas']
 
 
-            
+
+def debounce(wait):
+    """
+    Decorator delaying a function until `wait` seconds have passed without a new call; only the last call runs.
+
+    Args:
+    wait (float): The quiet period in seconds.
+
+    Returns:
+    function: The decorator. The decorated function runs on a timer thread and returns None.
+    """
+    def decorator(function):
+        state = {'timer': None}
+        lock = threading.Lock()
+
+        def debounced(*args, **kwargs):
+            with lock:
+                if state['timer'] is not None:
+                    state['timer'].cancel()
+                state['timer'] = threading.Timer(wait, function, args, kwargs)
+                state['timer'].start()
+
+        debounced.__name__ = function.__name__
+        debounced.__doc__ = function.__doc__
+        return debounced
+    return decorator
+
+
+
+def make_debounced_update_subareas(country_list, placeholders, adm1_subarea_selector, adm2_subarea_selector, wait=0.3):
+    """
+    Create a country selector observer that repopulates the subarea selectors only once the selection has settled,
+    so scrolling through the countries does not rebuild the long subarea lists of each one.
+
+    Args:
+    country_list (list): A list of country dictionaries.
+    placeholders (dict): A dictionary containing placeholder texts for the selectors.
+    adm1_subarea_selector (object): The selector object for adm1 subareas.
+    adm2_subarea_selector (object): The selector object for adm2 subareas.
+    wait (float, optional): The quiet period in seconds. Default is 0.3.
+
+    Returns:
+    function: The observer, to register with `country_selector.observe(observer, names='value')`.
+    """
+    @debounce(wait)
+    def observer(change):
+        update_subareas(change, country_list, placeholders, adm1_subarea_selector, adm2_subarea_selector)
+    return observer
+
+
+
+def cancel_jobs_on_change(selectors, runner):
+    """
+    Register on every selector an observer that cancels the job running in a `CallbackRunner` (utils.async_callbacks)
+    as soon as a selection changes, since its result would no longer match the selectors.
+
+    Args:
+    selectors (dict): Dictionary containing widget selectors.
+    runner (object): The runner of the notebook, with a `cancel()` method.
+
+    Returns:
+    function: The observer, to remove with `selector.unobserve(observer, names='value')`.
+    """
+    def observer(change):
+        runner.cancel()
+    for selector in selectors.values():
+        selector.observe(observer, names='value')
+    return observer
+
+
 
 def month_year_interaction(btn_name, month_selector, year_selector, selected, placeholders):
     """